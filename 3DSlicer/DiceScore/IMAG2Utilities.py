@@ -1,16 +1,41 @@
 import os
-import qt
-import ctk
-import slicer
+import csv
+import sys
+import glob
+import json
+import time
 import os.path
+import argparse
 import unittest
-import tempfile
+import functools
+import itertools
 import numpy as np
 import nibabel as nib
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+#the logic and the command line tool do not need 3D Slicer
+try:
+    import qt
+    import ctk
+    import vtk
+    import slicer
+except ImportError:
+    qt = ctk = vtk = slicer = None
 
 __author__ = 'Alessandro Delmonte'
 __email__ = 'delmonte.ale92@gmail.com'
 
+BLOCK = 2 ** 22
+LABEL_COLUMNS = ('label', 'dice', 'iou', 'sensitivity', 'volume_difference')
+METRIC_COLUMNS = ('dice', 'iou', 'sensitivity', 'specificity', 'volume_difference', 'tp', 'fp', 'fn', 'tn')
+SURFACE_COLUMNS = ('hausdorff', 'hd95', 'assd')
+REFERENCE_CACHE = 4
+CHUNK_PAIRS = 16
+SLAB = 16
+DIRECT_CODES = 2 ** 16
+LOOKUP_LABELS = 2 ** 24
+
 
 class IMAG2Utilities:
     def __init__(self, parent):
@@ -58,7 +83,6 @@ class IMAG2UtilitiesWidget:
             self.developerMode = settings.value('Developer/DeveloperMode') is True
 
         self.logic = IMAG2UtilitiesLogic()
-        self.tmp = tempfile.mkdtemp()
 
         if not parent:
             self.parent = slicer.qMRMLWidget()
@@ -129,6 +153,20 @@ class IMAG2UtilitiesWidget:
         self.cut_to_bbox.setChecked(False)
         dice_form_layout.addRow(self.cut_to_bbox)
 
+        self.bbox_margin = qt.QSpinBox()
+        self.bbox_margin.setRange(0, 1000)
+        self.bbox_margin.setValue(0)
+        self.bbox_margin.setSuffix(' voxels')
+        dice_form_layout.addRow('BBox margin', self.bbox_margin)
+
+        self.surface = qt.QCheckBox('Surface distances (Hausdorff, HD95, ASSD)')
+        self.surface.setChecked(False)
+        dice_form_layout.addRow(self.surface)
+
+        self.multi_label = qt.QCheckBox('Per label')
+        self.multi_label.setChecked(False)
+        dice_form_layout.addRow(self.multi_label)
+
         self.dice_button = qt.QPushButton('Compute DICE')
         self.dice_button.enabled = True
         self.dice_button.connect('clicked(bool)', self.on_dice_button)
@@ -139,6 +177,12 @@ class IMAG2UtilitiesWidget:
             "DICE = ... ; IOU = ...")
         dice_form_layout.addRow(self.dice_result)
 
+        self.label_table = qt.QTableWidget()
+        self.label_table.setColumnCount(len(LABEL_COLUMNS))
+        self.label_table.setHorizontalHeaderLabels([column.capitalize().replace('_', ' ') for column in LABEL_COLUMNS])
+        self.label_table.visible = False
+        dice_form_layout.addRow(self.label_table)
+
         self.layout.addStretch(1)
 
         if self.developerMode:
@@ -186,24 +230,39 @@ class IMAG2UtilitiesWidget:
 
     def on_dice_button(self):
         if self.mask1Node and self.mask2Node:
-            mask1_path = os.path.join(self.tmp, 'mask1.nii')
-            properties = {'useCompression': 0}
-            slicer.util.saveNode(self.mask1Node, mask1_path, properties)
-
-            mask2_path = os.path.join(self.tmp, 'mask2.nii')
-            properties = {'useCompression': 0}
-            slicer.util.saveNode(self.mask2Node, mask2_path, properties)
-
-            mask1, _ = load_nii(mask1_path)
-            mask2, _ = load_nii(mask2_path)
-
-            mask1 = mask1.astype(np.uint8)
-            mask2 = mask2.astype(np.uint8)
-
-            self.dice_result.setText(
-                "DICE = {:.2f} ; IOU = {:.2f}".format(self.logic.dice(mask1, mask2, self.cut_to_bbox.isChecked()),
-                                                      self.logic.dice(mask1, mask2, self.cut_to_bbox.isChecked(), iou=True)
-                                                      ))
+            mask1, affine1 = node_array(self.mask1Node)
+            mask2, affine2 = node_array(self.mask2Node)
+            try:
+                self.logic.check_geometry(mask1, affine1, mask2, affine2)
+            except ValueError as e:
+                slicer.util.errorDisplay(str(e))
+                return
+
+            if self.multi_label.isChecked():
+                self.show_label_metrics(self.logic.label_metrics(mask1, mask2, self.cut_to_bbox.isChecked(),
+                                                                 self.bbox_margin.value))
+                return
+
+            self.label_table.visible = False
+            metrics = self.logic.overlap_metrics(mask1, mask2, self.cut_to_bbox.isChecked(), self.bbox_margin.value)
+            text = ("DICE = {dice:.2f} ; IOU = {iou:.2f}\nSensitivity = {sensitivity:.2f} ; "
+                    "Specificity = {specificity:.2f} ; Volume difference = {volume_difference:.2f}".format(**metrics))
+            if self.surface.isChecked():
+                #the arrays are indexed KJI
+                spacing = np.linalg.norm(affine1[:3, :3], axis=0)[::-1]
+                text += "\nHausdorff = {hausdorff:.2f} mm ; HD95 = {hd95:.2f} mm ; ASSD = {assd:.2f} mm".format(
+                    **self.logic.surface_distances(mask1, mask2, spacing))
+            self.dice_result.setText(text)
+
+    def show_label_metrics(self, metrics):
+        self.dice_result.setText('{} labels'.format(len(metrics)))
+        self.label_table.setRowCount(len(metrics))
+        for row, (label, values) in enumerate(sorted(metrics.items())):
+            for column, key in enumerate(LABEL_COLUMNS):
+                value = label if key == 'label' else values[key]
+                text = '{:.2f}'.format(value) if isinstance(value, float) else str(value)
+                self.label_table.setItem(row, column, qt.QTableWidgetItem(text))
+        self.label_table.visible = True
 
     def on_reload(self):
         print('\n' * 2)
@@ -235,20 +294,196 @@ class IMAG2UtilitiesWidget:
 
 class IMAG2UtilitiesLogic:
     @staticmethod
-    def dice(m1, m2, cut=False, iou=False):
+    def check_geometry(m1, affine1, m2, affine2, tolerance=1e-4):
+        """
+        The masks must be sampled on the same voxel grid
+        :param affine1: voxel to RAS matrix of m1
+        :param tolerance: largest difference between the matrix coefficients (mm)
+        """
+        if m1.shape != m2.shape:
+            raise ValueError('The masks have different dimensions: {} and {}'.format(m1.shape, m2.shape))
+        if not np.allclose(affine1, affine2, rtol=0, atol=tolerance):
+            raise ValueError('The masks are not aligned: different IJK to RAS matrices\n{}\n{}'.format(affine1,
+                                                                                                        affine2))
+
+    @staticmethod
+    def dice(m1, m2, cut=False, iou=False, margin=0):
+        metrics = IMAG2UtilitiesLogic.overlap_metrics(m1, m2, cut, margin)
+        return metrics['iou'] if iou else metrics['dice']
+
+    @staticmethod
+    def cut_to_bbox(m1, m2, margin=0):
+        """
+        :return: views of m1 and m2 cropped to the bounding box of m1 (unchanged if m1 is empty)
+        """
+        bbox = IMAG2UtilitiesLogic.bounding_box(m1, margin)
+        if bbox is None:
+            return m1, m2
+        return m1[bbox], m2[bbox]
+
+    @staticmethod
+    def bounding_box(mask, margin=0, block=BLOCK):
+        """
+        Bounding box of the non zero voxels, from the projections of the mask on each axis (any), computed by slabs
+        along the first axis
+        :param margin: voxels added on each side, within the volume
+        :return: tuple of slices (last voxel included), None if the mask is empty
+        """
+        if not mask.size:
+            return None
+        rows = np.zeros(mask.shape[0], dtype=bool)
+        projection = np.zeros(mask.shape[1:], dtype=bool)
+        step = max(1, block // max(1, int(np.prod(mask.shape[1:]))))
+        for start in range(0, mask.shape[0], step):
+            slab = np.not_equal(mask[start:start + step], 0)
+            rows[start:start + step] = slab.reshape(len(slab), -1).any(axis=1)
+            projection |= slab.any(axis=0)
+        if not rows.any():
+            return None
+
+        bbox = []
+        for axis, length in enumerate(mask.shape):
+            if axis == 0:
+                hits = rows
+            else:
+                hits = projection.any(axis=tuple(i for i in range(projection.ndim) if i != axis - 1))
+            first, last = (int(i) for i in np.flatnonzero(hits)[[0, -1]])
+            bbox.append(slice(max(first - margin, 0), min(last + 1 + margin, length)))
+        return tuple(bbox)
+
+    @staticmethod
+    def overlap_metrics(m1, m2, cut=False, margin=0):
+        """
+        Overlap of two binary masks (non zero voxels), m1 being the reference
+        :param cut: only the bounding box of m1, enlarged by margin voxels, is compared
+        :return: dict of dice, iou, sensitivity, specificity, volume_difference (m2 relative to m1), in %, and of the
+        voxel counts tp, fp, fn, tn
+        """
         if cut:
-            x, y, z = np.where(m1)
-            x = sorted(x)
-            y = sorted(y)
-            z = sorted(z)
-            bbox = (slice(x[0], x[-1]), slice(y[0], y[-1]), slice(z[0], z[-1]))
-            mask = np.zeros(m1.shape)
-            mask[bbox] = m2[bbox]
-            m2 = mask
-        if iou:
-            return 100 * (m1*m2).sum()/float((np.logical_or(m1, m2)).sum())
-        else:
-            return 100 * (m1*m2).sum() * 2.0 / float(m1.sum() + m2.sum())
+            m1, m2 = IMAG2UtilitiesLogic.cut_to_bbox(m1, m2, margin)
+        return count_metrics(IMAG2UtilitiesLogic.overlap_counts(m1, m2))
+
+    @staticmethod
+    def overlap_counts(m1, m2, block=BLOCK):
+        """
+        True/false positives/negatives of m2 against m1, in a single pass over both masks: they are read by slabs
+        along the first axis, so the temporaries (two boolean slabs and their intersection) take at most
+        3 * max(block, voxels of one slice) bytes, whatever the size of the volumes
+        :param block: voxels per slab
+        :return: dict of tp, fp, fn, tn
+        """
+        step = max(1, block // max(1, int(np.prod(m1.shape[1:]))))
+        tp, n1, n2 = 0, 0, 0
+        for start in range(0, m1.shape[0] if m1.ndim else 1, step):
+            a = np.not_equal(m1[start:start + step], 0)
+            b = np.not_equal(m2[start:start + step], 0)
+            n1 += int(np.count_nonzero(a))
+            n2 += int(np.count_nonzero(b))
+            tp += int(np.count_nonzero(np.logical_and(a, b, out=a)))
+        return {'tp': tp, 'fp': n2 - tp, 'fn': n1 - tp, 'tn': int(m1.size) - n1 - n2 + tp}
+
+    @staticmethod
+    def surface_distances(m1, m2, spacing=None):
+        """
+        Distances between the surfaces (voxels with a background 6-neighbor) of two binary masks: each surface voxel
+        of a mask is matched to the closest surface voxel of the other with a KD-tree, within the bounding box of both
+        masks
+        :param spacing: voxel size along each axis of the arrays (mm), 1 by default
+        :return: dict of hausdorff, hd95 (largest of the 95th percentiles of the distances in both directions) and
+        assd (average symmetric surface distance), in mm, nan if a mask is empty
+        """
+        spacing = np.ones(m1.ndim) if spacing is None else np.asarray(spacing, dtype=np.float64)
+        bbox1 = IMAG2UtilitiesLogic.bounding_box(m1)
+        bbox2 = IMAG2UtilitiesLogic.bounding_box(m2)
+        if bbox1 is None or bbox2 is None:
+            return {'hausdorff': float('nan'), 'hd95': float('nan'), 'assd': float('nan')}
+        bbox = tuple(slice(min(a.start, b.start), max(a.stop, b.stop)) for a, b in zip(bbox1, bbox2))
+
+        surface1 = surface(np.not_equal(m1[bbox], 0))
+        surface2 = surface(np.not_equal(m2[bbox], 0))
+        distances12 = surface_distances_to(surface1, surface2, spacing)
+        distances21 = surface_distances_to(surface2, surface1, spacing)
+        return {'hausdorff': float(max(distances12.max(), distances21.max())),
+                'hd95': float(max(np.percentile(distances12, 95), np.percentile(distances21, 95))),
+                'assd': float((distances12.sum() + distances21.sum()) / (len(distances12) + len(distances21)))}
+
+    @staticmethod
+    def label_metrics(m1, m2, cut=False, margin=0, background=0):
+        """
+        Overlap of each label of two label maps, m1 being the reference
+        :param cut: only the bounding box of the labels of m1, enlarged by margin voxels, is compared
+        :return: dict of dict of dice, iou, sensitivity, volume_difference (in %), tp, fp, fn, by label (background
+        excluded)
+        """
+        if cut:
+            m1, m2 = IMAG2UtilitiesLogic.cut_to_bbox(m1, m2, margin)
+        return confusion_metrics(*IMAG2UtilitiesLogic.label_confusion(m1, m2), background=background)
+
+    @staticmethod
+    def label_confusion(m1, m2, block=BLOCK):
+        """
+        Confusion matrix of two label maps (non negative integers) in a single pass, by slabs along the first axis:
+        the labels of each slab are renumbered 0..n-1 through lookup tables (unless the label values are small), then
+        the pairs of codes are counted with one bincount. The memory depends on the slab size and the number of
+        labels, not on the size of the volumes.
+        :param block: voxels per slab
+        :return: sorted labels present in m1 or m2, confusion matrix (voxels of label i in m1 and j in m2)
+        """
+        labels = np.empty(0, dtype=np.int64)
+        confusion = np.zeros((0, 0), dtype=np.int64)
+        step = max(1, block // max(1, int(np.prod(m1.shape[1:]))))
+        for start in range(0, m1.shape[0] if m1.ndim else 1, step):
+            a = label_values(m1[start:start + step])
+            b = label_values(m2[start:start + step])
+            n1 = int(a.max()) + 1 if a.size else 0
+            n2 = int(b.max()) + 1 if b.size else 0
+            if n1 * n2 <= DIRECT_CODES:
+                #small label values are their own codes
+                counts = np.bincount(np.multiply(a, n2, dtype=np.intp) + b, minlength=n1 * n2).reshape(n1, n2)
+                labels1, labels2 = np.flatnonzero(counts.any(axis=1)), np.flatnonzero(counts.any(axis=0))
+                counts = counts[np.ix_(labels1, labels2)]
+            else:
+                labels1, codes1 = renumber(a)
+                labels2, codes2 = renumber(b)
+                counts = np.bincount(codes1 * len(labels2) + codes2, minlength=len(labels1) * len(labels2)).reshape(
+                    len(labels1), len(labels2))
+            labels, confusion = add_confusion(labels, confusion, labels1, labels2, counts)
+        return labels, confusion
+
+    @staticmethod
+    def file_metrics(reference, segmentation, labels=False, slab=SLAB, threads=1, background=0):
+        """
+        Out of core overlap of two NIfTI masks sampled on the same voxel grid: the volumes are read by slabs along
+        the last axis (the slowest on disk) through the nibabel array proxies, memory-mapped when not compressed,
+        and the counts of the slabs are added up. The peak memory depends on the slab size and on the number of
+        threads, and the results are the same as overlap_metrics / label_metrics on the whole volumes.
+        :param labels: label_metrics instead of overlap_metrics
+        :param slab: slices per slab
+        :param threads: slabs read and counted at the same time
+        """
+        img1 = nib.load(reference, keep_file_open=True)
+        img2 = nib.load(segmentation, keep_file_open=True)
+        IMAG2UtilitiesLogic.check_geometry(img1.dataobj, img1.affine, img2.dataobj, img2.affine)
+
+        def slab_counts(start):
+            m1 = np.asanyarray(img1.dataobj[..., start:start + slab])
+            m2 = np.asanyarray(img2.dataobj[..., start:start + slab])
+            if labels:
+                return IMAG2UtilitiesLogic.label_confusion(m1, m2)
+            return IMAG2UtilitiesLogic.overlap_counts(m1, m2)
+
+        label_list = np.empty(0, dtype=np.int64)
+        confusion = np.zeros((0, 0), dtype=np.int64)
+        counts = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+        with ThreadPoolExecutor(threads) as executor:
+            for result in executor.map(slab_counts, range(0, img1.shape[-1], slab)):
+                if labels:
+                    label_list, confusion = add_confusion(label_list, confusion, result[0], result[0], result[1])
+                else:
+                    counts = {k: counts[k] + result[k] for k in counts}
+        if labels:
+            return confusion_metrics(label_list, confusion, background)
+        return count_metrics(counts)
 
 
 class IMAG2UtilitiesTest(unittest.TestCase):
@@ -263,9 +498,400 @@ class IMAG2UtilitiesTest(unittest.TestCase):
         return 'IMAG2Utilities test class'
 
     def run_test(self, scenario=None):
-        pass
+        """
+        Scores of synthetic masks and label maps, known in advance (no 3D Slicer needed)
+        """
+        self.test_overlap()
+        self.test_labels()
+        self.test_surface()
+
+    def test_overlap(self):
+        #two 10 voxel cubes overlapping by half along the first axis
+        m1 = np.zeros((30, 20, 20), dtype=np.uint8)
+        m2 = np.zeros_like(m1)
+        m1[5:15, 5:15, 5:15] = 1
+        m2[10:20, 5:15, 5:15] = 1
+        metrics = IMAG2UtilitiesLogic.overlap_metrics(m1, m2)
+        self.assertEqual((metrics['tp'], metrics['fp'], metrics['fn']), (500, 500, 500))
+        self.assertAlmostEqual(metrics['dice'], 50.)
+        self.assertAlmostEqual(metrics['iou'], 100. / 3)
+        self.assertAlmostEqual(metrics['volume_difference'], 0.)
+        self.assertEqual(IMAG2UtilitiesLogic.overlap_metrics(m1, m2, cut=True)['tn'], 0)
+
+    def test_labels(self):
+        m1 = np.array([[0, 1, 1, 2], [2, 2, 3, 3]], dtype=np.uint64)
+        m2 = np.array([[0, 1, 2, 2], [2, 2, 3, 0]], dtype=np.uint64)
+        metrics = IMAG2UtilitiesLogic.label_metrics(m1, m2)
+        self.assertEqual(sorted(metrics), [1, 2, 3])
+        self.assertAlmostEqual(metrics[1]['dice'], 200. / 3)
+        self.assertEqual((metrics[2]['tp'], metrics[2]['fp'], metrics[2]['fn']), (3, 1, 0))
+        self.assertAlmostEqual(metrics[3]['sensitivity'], 50.)
+
+    def test_surface(self):
+        #a 3 voxel cube and the same cube moved by 2 voxels along an axis of 2 mm voxels
+        m1 = np.zeros((10, 10, 10), dtype=np.uint8)
+        m2 = np.zeros_like(m1)
+        m1[2:5, 2:5, 2:5] = 1
+        m2[4:7, 2:5, 2:5] = 1
+        metrics = IMAG2UtilitiesLogic.surface_distances(m1, m2, (2., 1., 1.))
+        self.assertAlmostEqual(metrics['hausdorff'], 4.)
+        self.assertAlmostEqual(metrics['hd95'], 4.)
+        self.assertLess(metrics['assd'], 4.)
+
+
+def percent(numerator, denominator):
+    return 100. * numerator / denominator if denominator else float('nan')
+
+
+def count_metrics(counts):
+    """
+    :param counts: dict of tp, fp, fn, tn
+    :return: counts with dice, iou, sensitivity, specificity, volume_difference, in %
+    """
+    tp, fp, fn, tn = counts['tp'], counts['fp'], counts['fn'], counts['tn']
+    metrics = {'dice': percent(2 * tp, 2 * tp + fp + fn), 'iou': percent(tp, tp + fp + fn),
+               'sensitivity': percent(tp, tp + fn), 'specificity': percent(tn, tn + fp),
+               'volume_difference': percent(fp - fn, tp + fn)}
+    metrics.update(counts)
+    return metrics
+
+
+def confusion_metrics(labels, confusion, background=0):
+    """
+    :return: dict of dict of dice, iou, sensitivity, volume_difference (in %), tp, fp, fn, by label (background
+    excluded)
+    """
+    n1, n2 = confusion.sum(axis=1), confusion.sum(axis=0)
+    metrics = {}
+    for i, label in enumerate(labels):
+        if label == background:
+            continue
+        tp = int(confusion[i, i])
+        fp, fn = int(n2[i]) - tp, int(n1[i]) - tp
+        metrics[int(label)] = {'dice': percent(2 * tp, 2 * tp + fp + fn), 'iou': percent(tp, tp + fp + fn),
+                               'sensitivity': percent(tp, tp + fn), 'volume_difference': percent(fp - fn, tp + fn),
+                               'tp': tp, 'fp': fp, 'fn': fn}
+    return metrics
+
+
+def add_confusion(labels, confusion, labels1, labels2, counts):
+    """
+    Add the counts of the label pairs (labels1[i], labels2[j]) to the confusion matrix of labels, extended to the new
+    labels
+    :return: labels, confusion matrix
+    """
+    new_labels = np.union1d(labels, np.union1d(labels1, labels2))
+    if len(new_labels) > len(labels):
+        grown = np.zeros((len(new_labels), len(new_labels)), dtype=np.int64)
+        kept = np.searchsorted(new_labels, labels)
+        grown[np.ix_(kept, kept)] = confusion
+        labels, confusion = new_labels, grown
+    confusion[np.ix_(np.searchsorted(labels, labels1), np.searchsorted(labels, labels2))] += counts
+    return labels, confusion
+
+
+def surface(mask):
+    """
+    :param mask: boolean array, the voxels outside are background
+    :return: boolean array of the voxels of the mask with at least one face neighbor in the background
+    """
+    padded = np.pad(mask, 1)
+    interior = mask.copy()
+    for axis in range(mask.ndim):
+        for shift in (0, 2):
+            neighbors = [slice(1, -1)] * mask.ndim
+            neighbors[axis] = slice(shift, shift + mask.shape[axis])
+            interior &= padded[tuple(neighbors)]
+    return mask & ~interior
+
+
+def surface_distances_to(source, target, spacing):
+    """
+    :return: distance (mm) of each voxel of source to the closest voxel of target, the voxels of both are at 0 and
+    are not searched
+    """
+    searched = source & ~target
+    tree = cKDTree(np.argwhere(target) * spacing, balanced_tree=False, compact_nodes=False)
+    return np.concatenate([np.zeros(np.count_nonzero(source) - np.count_nonzero(searched)),
+                           tree.query(np.argwhere(searched) * spacing, workers=-1)[0]])
+
+
+def label_values(labels):
+    """
+    :return: flat integer labels, which numpy can mix with intp (uint64 is cast to int64)
+    """
+    labels = np.ravel(labels)
+    if labels.dtype.kind == 'b':
+        return labels.view(np.uint8)
+    if labels.dtype == np.uint64:
+        if labels.size and labels.max() > np.iinfo(np.int64).max:
+            raise ValueError('The label values must be below 2^63')
+        return labels.astype(np.int64)
+    if labels.dtype.kind not in 'iu':
+        if not np.array_equal(labels, np.rint(labels)):
+            raise ValueError('The label maps must contain integer labels')
+        labels = labels.astype(np.int64)
+    if labels.dtype.kind == 'i' and labels.size and labels.min() < 0:
+        raise ValueError('The label maps must not contain negative labels')
+    return labels
+
+
+def renumber(labels):
+    """
+    :return: sorted distinct labels, code of each voxel (index of its label)
+    """
+    if labels.size and labels.max() >= LOOKUP_LABELS:
+        #the lookup table would be too large
+        values, codes = np.unique(labels, return_inverse=True)
+        return values, codes.ravel()
+    present = np.bincount(labels) if labels.size else np.zeros(0, dtype=np.intp)
+    values = np.flatnonzero(present)
+    lookup = np.zeros(len(present), dtype=np.intp)
+    lookup[values] = np.arange(len(values))
+    return values, lookup[labels]
+
+
+def node_array(node):
+    """
+    :param node: volume node
+    :return: voxel array (KJI view of the image data of the node, not a copy), IJK to RAS matrix
+    """
+    matrix = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(matrix)
+    return slicer.util.arrayFromVolume(node), slicer.util.arrayFromVTKMatrix(matrix)
 
 
 def load_nii(filename):
+    """
+    :return: voxel array (memory-mapped when the file is not compressed), voxel to RAS matrix, in the closest
+    canonical orientation
+    """
     img = nib.as_closest_canonical(nib.load(filename))
-    return img.get_data(), img.affine
+    return np.asanyarray(img.dataobj), img.affine
+
+
+@functools.lru_cache(maxsize=REFERENCE_CACHE)
+def load_reference(filename):
+    #the same reference is often scored against many segmentations
+    return load_nii(filename)
+
+
+def main():
+    args = setup()
+
+    try:
+        pairs = collect_pairs(args.references, args.segmentations)
+    except ValueError as e:
+        sys.exit(str(e))
+    if args.labels:
+        columns = ['reference', 'segmentation'] + list(LABEL_COLUMNS) + ['tp', 'fp', 'fn']
+    else:
+        columns = ['reference', 'segmentation'] + list(METRIC_COLUMNS) + (list(SURFACE_COLUMNS) if args.surface else [])
+    columns += ['load_seconds', 'seconds', 'error']
+
+    start = time.time()
+    errors = 0
+    options = {'cut': args.cut, 'margin': args.margin, 'surface': args.surface, 'labels': args.labels,
+               'slab': args.slab, 'threads': args.threads}
+    with ResultWriter(args.output, columns) as writer, ProcessPoolExecutor(args.jobs) as executor:
+        #consecutive pairs go to the same worker, whose reference cache is then reused
+        results = executor.map(score_pair, *zip(*pairs), itertools.repeat(options),
+                               chunksize=max(1, min(CHUNK_PAIRS, len(pairs) // (4 * args.jobs))))
+        for (reference, segmentation), rows in zip(pairs, results):
+            for row in rows:
+                writer.write(row)
+            if rows[0]['error']:
+                errors += 1
+                print('{} / {}: {}'.format(reference, segmentation, rows[0]['error']))
+            elif args.labels:
+                print('{} / {}: {} labels'.format(reference, segmentation, len(rows)))
+            else:
+                print('{} / {}: DICE = {:.2f} ; IOU = {:.2f}'.format(reference, segmentation, rows[0]['dice'],
+                                                                    rows[0]['iou']))
+
+    elapsed = time.time() - start
+    print('{} pairs scored in {:.1f} s ({:.2f} pairs/s), {} errors'.format(len(pairs) - errors, elapsed,
+                                                                          len(pairs) / max(elapsed, 1e-9), errors))
+    if errors:
+        sys.exit(1)
+
+
+def score_pair(reference, segmentation, options):
+    """
+    :param options: dict of cut, margin, surface, labels, slab, threads (see IMAG2UtilitiesLogic), out of core
+    when slab is set
+    :return: list of rows (one per label with labels), with the loading and total times (s) and the error message
+    """
+    start = time.time()
+    row = {'reference': reference, 'segmentation': segmentation, 'error': ''}
+    try:
+        if options['slab']:
+            #out of core, the volumes are read while counting
+            row['load_seconds'] = 0.
+            metrics = IMAG2UtilitiesLogic.file_metrics(reference, segmentation, options['labels'], options['slab'],
+                                                       options['threads'])
+        else:
+            m1, affine1 = load_reference(reference)
+            m2, affine2 = load_nii(segmentation)
+            IMAG2UtilitiesLogic.check_geometry(m1, affine1, m2, affine2)
+            row['load_seconds'] = time.time() - start
+            if options['labels']:
+                metrics = IMAG2UtilitiesLogic.label_metrics(m1, m2, options['cut'], options['margin'])
+            else:
+                metrics = IMAG2UtilitiesLogic.overlap_metrics(m1, m2, options['cut'], options['margin'])
+                if options['surface']:
+                    metrics.update(IMAG2UtilitiesLogic.surface_distances(m1, m2,
+                                                                         np.linalg.norm(affine1[:3, :3], axis=0)))
+        if options['labels']:
+            rows = [dict(row, label=label, **values) for label, values in sorted(metrics.items())] or [row]
+        else:
+            rows = [dict(row, **metrics)]
+    except (OSError, ValueError, nib.filebasedimages.ImageFileError) as e:
+        row['error'] = str(e)
+        rows = [row]
+    for r in rows:
+        r['seconds'] = time.time() - start
+    return rows
+
+
+def collect_pairs(references, segmentations):
+    """
+    Pairs of masks: two folders are matched by relative path (.nii or .nii.gz), a single reference is compared to all
+    the segmentations, two lists are matched in order
+    :param references: NIfTI file, folder (searched recursively) or text file with one path per line
+    :return: list of (reference, segmentation)
+    """
+    reference_files = nifti_files(references)
+    segmentation_files = nifti_files(segmentations)
+    if os.path.isdir(references) and os.path.isdir(segmentations):
+        by_name = {nifti_name(f, references): f for f in reference_files}
+        pairs = [(by_name[nifti_name(f, segmentations)], f) for f in segmentation_files
+                 if nifti_name(f, segmentations) in by_name]
+        for f in segmentation_files:
+            if nifti_name(f, segmentations) not in by_name:
+                print('{}: no reference'.format(f))
+    elif len(reference_files) == 1:
+        pairs = [(reference_files[0], f) for f in segmentation_files]
+    elif len(reference_files) == len(segmentation_files):
+        pairs = list(zip(reference_files, segmentation_files))
+    else:
+        raise ValueError('{} references for {} segmentations'.format(len(reference_files), len(segmentation_files)))
+    if not pairs:
+        raise ValueError('No pair of masks to compare')
+    return pairs
+
+
+def nifti_name(filename, root):
+    name = os.path.relpath(filename, root)
+    return name[:-len('.gz')] if name.endswith('.gz') else name
+
+
+def nifti_files(path):
+    if os.path.isdir(path):
+        return sorted(f for pattern in ('*.nii', '*.nii.gz')
+                      for f in glob.glob(os.path.join(glob.escape(path), '**', pattern), recursive=True))
+    if path.endswith(('.nii', '.nii.gz')):
+        return [path]
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class ResultWriter:
+    """
+    Rows written as they come: CSV, JSON array (.json) or nothing if filename is None
+    """
+    def __init__(self, filename, columns):
+        self.filename = filename
+        self.columns = columns
+        self.count = 0
+        self.fileobj = open(filename, 'w', newline='') if filename else None
+        self.json = bool(filename) and filename.endswith('.json')
+        if self.fileobj and self.json:
+            self.fileobj.write('[')
+        elif self.fileobj:
+            self.csv = csv.DictWriter(self.fileobj, columns, extrasaction='ignore')
+            self.csv.writeheader()
+
+    def __repr__(self):
+        return 'ResultWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row):
+        if not self.fileobj:
+            return
+        if self.json:
+            #NaN and infinities (scores of empty masks) are not valid JSON, they are written as null
+            self.fileobj.write(('\n' if not self.count else ',\n') + json.dumps(
+                {k: json_value(row.get(k)) for k in self.columns}, allow_nan=False))
+        else:
+            self.csv.writerow(row)
+        self.fileobj.flush()
+        self.count += 1
+
+    def close(self):
+        if self.fileobj:
+            if self.json:
+                self.fileobj.write('\n]\n')
+            self.fileobj.close()
+
+
+def json_value(value):
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        return None
+    return value
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Overlap scores of segmentations against reference masks (NIfTI)')
+    parser.add_argument('references', help='Reference mask, folder of masks or text file listing them')
+    parser.add_argument('segmentations', help='Segmentation, folder of segmentations or text file listing them')
+    parser.add_argument('-o', '--output', help='Results file, CSV or JSON (.json)')
+    parser.add_argument('-j', '--jobs', help='Worker processes (default: 1)', type=check_positive, default=1)
+    parser.add_argument('--cut', help='Compare only the bounding box of the reference', action='store_true')
+    parser.add_argument('--margin', help='Margin of the bounding box (voxels, default: 0)', type=check_non_negative,
+                        default=0)
+    parser.add_argument('--surface', help='Surface distances (Hausdorff, HD95, ASSD), not with --labels',
+                        action='store_true')
+    parser.add_argument('--labels', help='Scores of each label of label maps', action='store_true')
+    parser.add_argument('--slab', help='Out of core: read the volumes by slabs of SLAB slices (masks on the same '
+                                       'voxel grid, not with --cut or --surface)', type=check_positive)
+    parser.add_argument('-t', '--threads', help='Slabs read at the same time, out of core, for uncompressed files '
+                                              '(default: 1)',
+                        type=check_positive, default=1)
+
+    args = parser.parse_args()
+    if args.slab and (args.cut or args.surface):
+        parser.error('--slab does not support --cut and --surface')
+    if args.surface and args.labels:
+        parser.error('--surface does not support --labels')
+    return args
+
+
+def check_positive(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('Must be a positive integer: %s' % value)
+    return value
+
+
+def check_non_negative(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 0:
+        raise argparse.ArgumentTypeError('Must be a non negative integer: %s' % value)
+    return value
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
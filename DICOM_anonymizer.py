@@ -2,84 +2,931 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import random
+import copy
+import stat
+import hmac
+import json
+import time
+import queue
 import string
+import sqlite3
+import tarfile
+import zipfile
+import hashlib
 import pydicom
 import os.path
 import argparse
-from os import walk
+import tempfile
+import threading
+import posixpath
+from io import BytesIO
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from multiprocessing import Manager
+from concurrent.futures import ThreadPoolExecutor
 from joblib import Parallel, delayed, cpu_count
+from joblib.externals.loky import get_reusable_executor
+from pydicom.uid import UID
+from pydicom.dataelem import DataElement
+from pydicom.datadict import DicomDictionary, dictionary_VR, tag_for_keyword
 
 
 __author__ = 'Alessandro Delmonte'
 __email__ = 'delmonte.ale92@gmail.com'
 
+VR_RULES = {'PN': 'ANONYMOUS', 'DA': '20000101', 'TM': '000000', 'SH': '(??)'}
+TAG_RULES = {tag_for_keyword(keyword): '(??)' for keyword in
+             ('PatientID', 'InstitutionName', 'SeriesDescription', 'ProtocolName')}
+DELETED_TAGS = frozenset(tag_for_keyword(keyword) for keyword in ('PatientWeight', 'AdditionalPatientHistory'))
+PATIENT_NAME = tag_for_keyword('PatientName')
+#the anonymized files are marked as such (PS3.15 E.1.1), and never pseudonymized twice
+PATIENT_IDENTITY_REMOVED = tag_for_keyword('PatientIdentityRemoved')
+DEIDENTIFICATION_METHOD = tag_for_keyword('DeidentificationMethod')
+METHOD = 'DICOM_anonymizer HMAC pseudonyms'
+PLACEHOLDERS = frozenset(TAG_RULES.values())
+CLASS_UID_TAGS = frozenset(tag for tag, entry in DicomDictionary.items() if entry[0] == 'UI' and
+                           any(word in entry[4] for word in ('Class', 'TransferSyntax', 'CodingScheme', 'Creator',
+                                                             'MappingResource', 'Context')))
+MEDIA_STORAGE_SOP_INSTANCE_UID = tag_for_keyword('MediaStorageSOPInstanceUID')
+DEFLATED = '1.2.840.10008.1.2.1.99'
+COPY_BUFFER = 2 ** 20
+TMP_SUFFIX = '.anon.tmp'
+STAGES = ('read', 'rewrite', 'write')
+MAX_REPORTED_ERRORS = 20
+#read once: os.umask can only be queried by setting it, which would race with the writer threads
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+#pseudonymizers of the worker (process or thread) by settings, their caches outlive the tasks
+WORKER = threading.local()
+TAR_MODES = (('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tar.xz', 'xz'),
+             ('.txz', 'xz'))
+
 
 def main():
-    dir_path, q = setup()
+    args = setup()
 
-    if q:
+    if args.quiet:
         sys.stdout = open(os.devnull, 'w')
         sys.stderr = open(os.devnull, 'w')
 
-    print('Parallel computing enabled')
-    with Parallel(n_jobs=cpu_count(), backend='threading') as parallel:
-        parallel(delayed(anonymize)(root, files) for root, _, files in walk(dir_path))
+    key = read_key(args.key_file) if args.key_file else None
+    manifest = Manifest(args.manifest, args.DICOM_Folder, key) if args.manifest and not args.output else None
+    if key is None:
+        key = manifest.key if manifest else os.urandom(16)
+    secrets = [args.key_file] if args.key_file else [args.manifest] if manifest else []
+    for filename in secrets:
+        if is_inside(filename, args.DICOM_Folder):
+            print('Warning: {} holds the pseudonymization key and is inside the anonymized folder: keep it out of '
+                  'the shared data, the key gives the pseudonym of any known PatientID'.format(filename))
+    if args.pseudonym_store:
+        create_store(args.pseudonym_store)
+
+    print('Parallel computing enabled ({} workers, {} backend)'.format(args.jobs, args.backend))
+    start = time.time()
+    stats = {'files': 0, 'bytes': 0, 'errors': 0, 'unchanged': 0, 'timings': {stage: 0.0 for stage in STAGES}}
+    if args.output:
+        anonymize_archive(args, key, stats)
+    else:
+        anonymize_tree(args, key, manifest, stats)
+    stats['seconds'] = time.time() - start
+    stats['files_per_s'] = stats['files'] / max(stats['seconds'], 1e-9)
+    stats['mb_per_s'] = stats['bytes'] / 2 ** 20 / max(stats['seconds'], 1e-9)
 
+    print('Anonymized {} files in {:.1f} s ({:.1f} files/s, {:.1f} MB/s)'.format(
+        stats['files'], stats['seconds'], stats['files_per_s'], stats['mb_per_s']))
+    print('Worker time: ' + ', '.join('{} {:.1f} s'.format(stage, stats['timings'][stage]) for stage in STAGES))
+    if stats['unchanged']:
+        print('Left {} files already pseudonymized unchanged'.format(stats['unchanged']))
+    if stats['errors']:
+        print('Failed to anonymize {} files'.format(stats['errors']))
+    if manifest:
+        stats['skipped'] = manifest.skipped
+        print('Skipped {} files already anonymized'.format(manifest.skipped))
+        manifest.close()
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(stats, f, indent=2)
 
-def anonymize(root, files):
-    files = [os.path.join(root, file) for file in files]
-    random_string = ''.join(random.choice(string.ascii_uppercase) for _ in range(8))
-    for file in files:
+
+def anonymize_tree(args, key, manifest, stats):
+    dir_path, n_jobs = args.DICOM_Folder, args.jobs
+
+    files = prefetch(scan_tree(dir_path), 2 * n_jobs * args.chunk_size)
+    if manifest:
+        files = manifest.pending(files)
+    chunks = chunk_items(((file, size) for file, size, _ in files), args.chunk_size, args.chunk_mb * 2 ** 20)
+
+    manager = Manager() if args.max_writers else None
+    slots = manager.BoundedSemaphore(args.max_writers) if args.max_writers else None
+
+    with Parallel(n_jobs=n_jobs, backend=args.backend, batch_size=1, pre_dispatch='2*n_jobs',
+                  return_as=results_mode(args.backend)) as parallel:
+        for records, errors, timings, unchanged in parallel(
+                delayed(anonymize)(chunk, dir_path, key, args.full, args.fsync_batch, slots, args.pseudonym_store,
+                                   not args.keep_uids, manifest and manifest.filename) for chunk in chunks):
+            update_stats(stats, len(records), sum(record[1] for record in records), errors, timings, unchanged)
+
+    if manager:
+        manager.shutdown()
+
+
+def anonymize_archive(args, key, stats):
+    """
+    Archive to archive: the members are read in order, anonymized in memory by the workers and written in the
+    same order. The next members are only read when the writer has consumed a task, so at most 2 * jobs tasks
+    (chunk_size members or chunk_mb MB each) are in memory
+    """
+    infos = deque()
+
+    def tasks():
+        members = ((member, len(member[1] or b'')) for member in read_archive(args.DICOM_Folder))
+        for chunk in chunk_items(members, args.chunk_size, args.chunk_mb * 2 ** 20):
+            infos.append([(info, data is not None) for info, data in chunk])
+            yield anonymize_members, [(member_name(info), data) for info, data in chunk], key, \
+                args.pseudonym_store, not args.keep_uids
+
+    executor = ThreadPoolExecutor(args.jobs) if args.backend == 'threading' else \
+        get_reusable_executor(max_workers=args.jobs)
+    with ArchiveWriter(args.output) as writer, executor:
+        for outputs, errors, timings, unchanged in bounded_map(executor, tasks(), 2 * args.jobs):
+            start = time.perf_counter()
+            for (info, is_file), data in zip(infos.popleft(), outputs):
+                if data is not None:
+                    writer.add(info, data)
+                elif not is_file:
+                    writer.add(info)
+            timings['write'] += time.perf_counter() - start
+            update_stats(stats, sum(data is not None for data in outputs) - unchanged,
+                         sum(len(data) for data in outputs if data is not None), errors, timings, unchanged)
+
+
+def bounded_map(executor, tasks, window):
+    """
+    Results of the tasks in order, the next task is only taken from tasks (and submitted) when the caller has
+    consumed a result, so at most window tasks are submitted and not consumed
+    :param tasks: iterable of (function, arg, ...)
+    """
+    futures = deque()
+    try:
+        for function, *arguments in tasks:
+            futures.append(executor.submit(function, *arguments))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def results_mode(backend):
+    """
+    :return: return_as of Parallel, the results as they come except with the multiprocessing backend, which only
+    returns them all at the end
+    """
+    return 'list' if backend == 'multiprocessing' else 'generator'
+
+
+def update_stats(stats, files, size, errors, timings, unchanged=0):
+    stats['files'] += files
+    stats['unchanged'] += unchanged
+    stats['bytes'] += size
+    for path, error in errors[:max(MAX_REPORTED_ERRORS - stats['errors'], 0)]:
+        print('Failed: {} ({})'.format(path, error), file=sys.stderr)
+    stats['errors'] += len(errors)
+    for stage in STAGES:
+        stats['timings'][stage] += timings[stage]
+
+
+def scan_tree(dir_path):
+    """
+    Depth-first os.scandir traversal, files of the same folder are yielded together
+    :param dir_path: root folder
+    :return: generator of (path, size, mtime_ns)
+    """
+    stack = [dir_path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and not entry.name.endswith(TMP_SUFFIX):
+                        entry_stat = entry.stat()
+                        yield entry.path, entry_stat.st_size, entry_stat.st_mtime_ns
+                except OSError:
+                    pass
+
+
+def prefetch(iterable, maxsize):
+    """
+    Run a producer in a background thread, keeping at most maxsize items in memory
+    """
+    items = queue.Queue(maxsize)
+    end = object()
+
+    def producer():
         try:
-            ds = pydicom.dcmread(file)
+            for item in iterable:
+                items.put(item)
+        finally:
+            items.put(end)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            return
+        yield item
+
+
+def chunk_items(items, chunk_size, chunk_bytes):
+    """
+    Group the files (or archive members) in tasks of at most chunk_size items or about chunk_bytes bytes
+    :param items: iterable of (item, size)
+    :return: generator of item lists
+    """
+    chunk, total = [], 0
+    for item, size in items:
+        chunk.append(item)
+        total += size
+        if len(chunk) >= chunk_size or total >= chunk_bytes:
+            yield chunk
+            chunk, total = [], 0
+    if chunk:
+        yield chunk
+
+
+def read_archive(filename):
+    """
+    Members of a zip or tar archive (tar is read as a stream)
+    :return: generator of (ZipInfo or TarInfo, bytes), bytes is None for the directories and links
+    """
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                yield info, None if info.is_dir() else archive.read(info)
+    else:
+        with tarfile.open(filename, 'r|*') as archive:
+            for info in archive:
+                yield info, archive.extractfile(info).read() if info.isfile() else None
+
 
-            ds.walk(del_callback)
+def member_name(info):
+    return info.filename if isinstance(info, zipfile.ZipInfo) else info.name
 
-            ds.data_element('PatientName').value = random_string
-            ds.data_element('PatientID').value = "(??)"
-            ds.data_element('InstitutionName').value = "(??)"
-            ds.data_element('SeriesDescription').value = "(??)"
-            ds.data_element('ProtocolName').value = "(??)"
 
-            for tag in ['PatientWeight', 'AdditionalPatientHistory']:
-                if tag in ds:
-                    delattr(ds, tag)
+class ArchiveWriter:
+    """
+    Sequential writer of a zip (stored) or tar archive (compression given by the extension)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if filename.lower().endswith('.zip'):
+            self.archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            compression = next((mode for extension, mode in TAR_MODES if filename.lower().endswith(extension)), '')
+            self.archive = tarfile.open(filename, 'w|' + compression)
 
-            os.remove(file)
-            ds.save_as(file)
-        except:
+    def __repr__(self):
+        return 'ArchiveWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.archive.close()
+
+    def add(self, info, data=None):
+        """
+        :param info: ZipInfo or TarInfo of the input member
+        :param data: new content, None for the directories and links (only kept from tar to tar)
+        """
+        if isinstance(self.archive, zipfile.ZipFile):
+            if data is None:
+                return
+            if isinstance(info, zipfile.ZipInfo):
+                date_time, mode = info.date_time, info.external_attr
+            else:
+                date_time, mode = time.localtime(info.mtime)[:6], (info.mode & 0xFFFF) << 16
+            new_info = zipfile.ZipInfo(member_name(info), date_time=date_time)
+            new_info.external_attr = mode
+            self.archive.writestr(new_info, data)
+        else:
+            if isinstance(info, tarfile.TarInfo):
+                new_info = copy.copy(info)
+            elif data is not None:
+                new_info = tarfile.TarInfo(info.filename)
+                new_info.mtime = time.mktime(info.date_time + (0, 0, -1))
+                new_info.mode = (info.external_attr >> 16) & 0o7777 or 0o644
+            else:
+                return
+            if data is None:
+                self.archive.addfile(new_info)
+            else:
+                new_info.size = len(data)
+                self.archive.addfile(new_info, BytesIO(data))
+
+
+class Pseudonymizer:
+    """
+    Keyed deterministic pseudonyms (HMAC-SHA256): the same patient gets the same name and the same instance UID
+    the same new UID in every worker and every run sharing the key. Results are kept in a LRU cache, new
+    mappings are appended to the optional SQLite store (shared by all the processes) on flush
+    """
+    def __init__(self, key, store=None, remap_uids=True, cache_size=65536):
+        self.key = key
+        self.store = store
+        self.remap_uids = remap_uids
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.new = []
+
+    def __repr__(self):
+        return 'Pseudonymizer(store={}, remap_uids={}, cache_size={})'.format(self.store, self.remap_uids,
+                                                                              self.cache_size)
+
+    def patient_name(self, ds, default=''):
+        """
+        :param ds: dataset, identified by PatientID, or StudyInstanceUID when missing
+        :param default: identity of the datasets without both
+        """
+        identity = next((value for value in (ds.get('PatientID'), ds.get('StudyInstanceUID'))
+                         if value and str(value) not in PLACEHOLDERS), default)
+        return self.lookup('patient', str(identity))
+
+    def uid(self, uid):
+        """
+        New UID (2.25 form) for the instance UIDs, the registered DICOM UIDs are kept
+        """
+        if not self.remap_uids or not uid or not UID(uid).is_private:
+            return uid
+        return self.lookup('uid', str(uid))
+
+    def lookup(self, kind, value):
+        try:
+            pseudonym = self.cache[kind, value]
+            self.cache.move_to_end((kind, value))
+            return pseudonym
+        except KeyError:
             pass
 
+        digest = hmac.new(self.key, '{}:{}'.format(kind, value).encode('utf-8'), hashlib.sha256).digest()
+        if kind == 'uid':
+            pseudonym = '2.25.{}'.format(int.from_bytes(digest[:16], 'big'))
+        else:
+            pseudonym = ''.join(string.ascii_uppercase[b % 26] for b in bytearray(digest[:8]))
+
+        self.cache[kind, value] = pseudonym
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        if self.store:
+            self.new.append((kind, value, pseudonym))
+        return pseudonym
+
+    def flush(self):
+        if self.store and self.new:
+            db = sqlite3.connect(self.store, timeout=60)
+            with db:
+                db.executemany('INSERT OR IGNORE INTO pseudonyms VALUES (?, ?, ?)', self.new)
+            db.close()
+        self.new = []
+
+
+def create_store(filename):
+    db = sqlite3.connect(filename)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS pseudonyms (kind TEXT, original TEXT, pseudonym TEXT, '
+               'PRIMARY KEY (kind, original))')
+    db.commit()
+    db.close()
+
+
+def read_key(filename):
+    """
+    Pseudonymization key stored in filename, created if missing
+    """
+    if not os.path.isfile(filename):
+        with os.fdopen(create_private(filename), 'wb') as f:
+            f.write(os.urandom(32))
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def create_private(filename):
+    """
+    :return: descriptor of the new file, readable by its owner only
+    """
+    return os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+
+
+def is_inside(filename, dir_path):
+    return os.path.commonpath([os.path.realpath(filename), os.path.realpath(dir_path)]) == \
+        os.path.realpath(dir_path)
+
+
+class Manifest:
+    """
+    SQLite record of the anonymized files (relative path, size, mtime, content hash, pseudonym) and of the
+    pseudonymization key (unless it comes from a key file), so that a re-run only processes new or modified files
+    with the same pseudonyms. The key makes the manifest secret: it is created readable by its owner only.
+    """
+    def __init__(self, filename, dir_path, key=None):
+        self.filename = os.path.abspath(filename)
+        self.dir_path = dir_path
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+        if not os.path.isfile(self.filename):
+            os.close(create_private(self.filename))
+        #the workers record the files they replace in the same database
+        self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                        'hash TEXT, pseudonym TEXT)')
+
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+        if key is not None:
+            self.key = key
+        elif row:
+            self.key = bytes(row[0])
+        else:
+            self.key = os.urandom(16)
+            self.db.execute("INSERT INTO meta VALUES ('key', ?)", (self.key,))
+        self.db.commit()
+
+    def __repr__(self):
+        return 'Manifest(filename={}, dir_path={})'.format(self.filename, self.dir_path)
+
+    def pending(self, files):
+        """
+        Filter out the files already anonymized: same size and mtime, or same size and content hash
+        """
+        for file, size, mtime_ns in files:
+            if os.path.abspath(file).startswith(self.filename):
+                continue
+            path = os.path.relpath(file, self.dir_path)
+            with self.lock:
+                row = self.db.execute('SELECT size, mtime_ns, hash FROM files WHERE path = ?', (path,)).fetchone()
+            if row and row[0] == size and (row[1] == mtime_ns or row[2] == file_hash(file)):
+                if row[1] != mtime_ns:
+                    with self.lock, self.db:
+                        self.db.execute('UPDATE files SET mtime_ns = ? WHERE path = ?', (mtime_ns, path))
+                self.skipped += 1
+                continue
+            yield file, size, mtime_ns
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def anonymize(files, dir_path, key, full=False, fsync_batch=0, slots=None, store=None, remap_uids=True,
+              manifest=None):
+    """
+    :param manifest: SQLite manifest, each file is recorded in it as soon as it is replaced
+    :return: list of (relative path, size, mtime_ns, hash, pseudonym) of the anonymized files, list of
+    (relative path, error) of the failed ones, seconds spent in each stage, number of files left unchanged because
+    they were already pseudonymized
+    """
+    pseudonymizer = worker_pseudonymizer(key, store, remap_uids)
+    writer = AtomicWriter(fsync_batch, slots)
+    timings = {stage: 0.0 for stage in STAGES}
+    written = {}
+    records = []
+    errors = []
+    unchanged = 0
+
+    def replaced(file):
+        path, digest, patient_name = written.pop(file)
+        file_stat = os.stat(file)
+        records.append((path, file_stat.st_size, file_stat.st_mtime_ns, digest, patient_name))
+        if manifest:
+            #a crash after this point does not anonymize the file again on resume
+            try:
+                db = worker_manifest(manifest)
+                with db:
+                    db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', records[-1])
+            except sqlite3.Error as error:
+                errors.append((path, 'anonymized, not recorded in the manifest: {!r}'.format(error)))
+
+    def commit():
+        writer.flush(replaced)
+        for file, error in writer.errors:
+            errors.append((written.pop(file)[0], error))
+        writer.errors = []
+
+    for file in files:
+        path = os.path.relpath(file, dir_path)
+        try:
+            if full:
+                digest, patient_name = anonymize_file_full(file, pseudonymizer, writer, os.path.dirname(path),
+                                                           timings)
+            else:
+                digest, patient_name = anonymize_file(file, pseudonymizer, writer, os.path.dirname(path), timings)
+            written[file] = (path, digest, patient_name)
+        except AlreadyPseudonymized:
+            unchanged += 1
+        except Exception as error:
+            errors.append((path, repr(error)))
+        if len(writer.pending) >= max(fsync_batch, 1):
+            commit()
+    commit()
+    pseudonymizer.flush()
+    timings['write'] += writer.seconds
+    return records, errors, timings, unchanged
+
+
+def anonymize_members(members, key, store=None, remap_uids=True):
+    """
+    In memory anonymization of archive members
+    :param members: list of (name, bytes), bytes is None for the directories and links
+    :return: list of anonymized bytes (None for the failures, directories and links, the original bytes for the
+    members already pseudonymized), list of (name, error) of the failed members, seconds spent in each stage,
+    number of members already pseudonymized
+    """
+    pseudonymizer = worker_pseudonymizer(key, store, remap_uids)
+    timings = {stage: 0.0 for stage in STAGES}
+    outputs = []
+    errors = []
+    unchanged = 0
+    for name, data in members:
+        if data is None:
+            outputs.append(None)
+            continue
+        try:
+            src = BytesIO(data)
+            header, raw_pixels, _ = anonymize_stream(src, pseudonymizer, posixpath.dirname(name), timings)
+            outputs.append(header + data[src.tell():] if raw_pixels else header)
+        except AlreadyPseudonymized:
+            outputs.append(data)
+            unchanged += 1
+        except Exception as error:
+            outputs.append(None)
+            errors.append((name, repr(error)))
+    pseudonymizer.flush()
+    return outputs, errors, timings, unchanged
+
+
+def worker_manifest(filename):
+    """
+    :return: connection of the current worker to the manifest, opened on its first task
+    """
+    connections = WORKER.__dict__.setdefault('manifests', {})
+    if filename not in connections:
+        connections[filename] = sqlite3.connect(filename, timeout=60)
+    return connections[filename]
+
+
+def worker_pseudonymizer(key, store=None, remap_uids=True):
+    """
+    :return: Pseudonymizer of the current worker for these settings, created on its first task and reused by the
+    next ones
+    """
+    pseudonymizers = WORKER.__dict__.setdefault('pseudonymizers', {})
+    if (key, store, remap_uids) not in pseudonymizers:
+        pseudonymizers[key, store, remap_uids] = Pseudonymizer(key, store, remap_uids)
+    return pseudonymizers[key, store, remap_uids]
+
+
+def lap(timings, stage, start):
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] += now - start
+    return now
+
+
+def file_hash(file):
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AtomicWriter:
+    """
+    Write stage: the new content goes to a temporary file in the same folder, renamed over the original only
+    once complete, so an interrupted run never loses a file. With fsync_batch > 0 the temporary files are
+    flushed to disk by batches of fsync_batch files before the renames, followed by a single fsync per folder.
+    slots is an optional (shared) semaphore capping the number of concurrent writers.
+    """
+    def __init__(self, fsync_batch=0, slots=None):
+        self.fsync_batch = fsync_batch
+        self.slots = slots
+        self.pending = []
+        self.errors = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'AtomicWriter(fsync_batch={}, slots={})'.format(self.fsync_batch, self.slots)
+
+    def write(self, file, header, tail=None):
+        """
+        :param file: destination
+        :param header: bytes
+        :param tail: optional file object, copied after the header up to its end
+        :return: sha1 of the written content
+        """
+        start = time.perf_counter()
+        digest = hashlib.sha1(header)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), prefix='.', suffix=TMP_SUFFIX)
+        try:
+            #mkstemp creates the file with mode 0600, the replaced file keeps the mode of the original
+            os.chmod(tmp, file_mode(file))
+            with self.slots if self.slots is not None else nullcontext(), os.fdopen(fd, 'wb') as dst:
+                dst.write(header)
+                if tail is not None:
+                    for block in iter(lambda: tail.read(COPY_BUFFER), b''):
+                        digest.update(block)
+                        dst.write(block)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.pending.append((tmp, file))
+        return digest.hexdigest()
+
+    def flush(self, replaced_callback=None):
+        """
+        Rename the pending temporary files over their destinations, the failures are appended to errors
+        :param replaced_callback: called with each file right after it is replaced
+        :return: list of the replaced files
+        """
+        start = time.perf_counter()
+        pending, self.pending = self.pending, []
+        replaced = []
+        for tmp, file in pending:
+            try:
+                if self.fsync_batch:
+                    fsync_path(tmp)
+                os.replace(tmp, file)
+                replaced.append(file)
+            except OSError as error:
+                self.errors.append((file, repr(error)))
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                continue
+            if replaced_callback:
+                replaced_callback(file)
+        if self.fsync_batch:
+            for folder in set(os.path.dirname(file) for file in replaced):
+                fsync_path(folder)
+        self.seconds += time.perf_counter() - start
+        return replaced
+
+
+def file_mode(file):
+    """
+    :return: permission bits of file, or the default mode of new files (0666 minus the umask) if it does not exist
+    """
+    try:
+        return stat.S_IMODE(os.stat(file).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def anonymize_file(file, pseudonymizer, writer, series='', timings=None):
+    """
+    Fast path: only the header is parsed, the pixel data is copied as raw bytes
+    :param file: DICOM file, anonymized in place
+    :param pseudonymizer: Pseudonymizer
+    :param writer: AtomicWriter
+    :param series: identity of the files without PatientID and StudyInstanceUID
+    :param timings: optional dict, seconds spent reading and rewriting are added to it
+    :return: sha1 of the anonymized file, pseudonym
+    """
+    with open(file, 'rb') as src:
+        data, raw_pixels, patient_name = anonymize_stream(src, pseudonymizer, series, timings)
+        return writer.write(file, data, src if raw_pixels else None), patient_name
+
+
+def anonymize_stream(src, pseudonymizer, series='', timings=None):
+    """
+    :return: anonymized header (whole dataset if raw_pixels is False), raw_pixels: the rest of src has to be
+    copied as is, pseudonym
+    """
+    start = time.perf_counter()
+    ds = pydicom.dcmread(src, stop_before_pixels=True)
+    check_not_pseudonymized(ds)
+    raw_pixels = ds.file_meta.get('TransferSyntaxUID') != DEFLATED
+    if raw_pixels:
+        start = lap(timings, 'read', start)
+        patient_name = anonymize_header(ds, pseudonymizer, series)
+    else:
+        src.seek(0)
+        ds = pydicom.dcmread(src)
+        start = lap(timings, 'read', start)
+        patient_name = anonymize_dataset(ds, pseudonymizer, series)
+
+    header = BytesIO()
+    ds.save_as(header)
+    lap(timings, 'rewrite', start)
+    return header.getvalue(), raw_pixels, patient_name
+
+
+def anonymize_header(ds, pseudonymizer, series=''):
+    """
+    Rewrite only the elements matching the rule tables, the other elements are not converted
+    """
+    patient_name = pseudonymizer.patient_name(ds, series)
+    rewrite_vrs(ds, pseudonymizer)
+    remap_media_storage_uid(ds, pseudonymizer)
+    apply_tag_rules(ds, patient_name)
+    return patient_name
+
+
+def apply_tag_rules(ds, patient_name):
+    """
+    Apply the tag tables shared by every anonymization path, the elements missing from ds are left out
+    """
+    for tag in DELETED_TAGS.intersection(ds.keys()):
+        del ds[tag]
+    if PATIENT_NAME in ds:
+        ds[PATIENT_NAME] = DataElement(PATIENT_NAME, 'PN', patient_name)
+    for tag, value in TAG_RULES.items():
+        if tag in ds:
+            ds[tag] = DataElement(tag, element_vr(ds, tag), value)
+    ds[PATIENT_IDENTITY_REMOVED] = DataElement(PATIENT_IDENTITY_REMOVED, 'CS', 'YES')
+    ds[DEIDENTIFICATION_METHOD] = DataElement(DEIDENTIFICATION_METHOD, 'LO', METHOD)
+
+
+class AlreadyPseudonymized(Exception):
+    """
+    The dataset was anonymized by this tool: pseudonymizing it again would give new pseudonyms and UIDs, and
+    break the links with the files anonymized before
+    """
+
+
+def check_not_pseudonymized(ds):
+    """
+    :raise AlreadyPseudonymized: ds carries the mark of this tool, or the placeholders of its versions without mark
+    """
+    if ds.get(DEIDENTIFICATION_METHOD) is not None and ds[DEIDENTIFICATION_METHOD].value == METHOD or \
+            ds.get('PatientID') in PLACEHOLDERS:
+        raise AlreadyPseudonymized()
+
+
+def rewrite_vrs(ds, pseudonymizer):
+    for tag in list(ds.keys()):
+        vr = element_vr(ds, tag)
+        if vr == 'SQ':
+            for item in ds[tag].value:
+                rewrite_vrs(item, pseudonymizer)
+        elif vr in VR_RULES:
+            ds[tag] = DataElement(tag, vr, VR_RULES[vr])
+        elif vr == 'UI' and pseudonymizer.remap_uids and tag not in CLASS_UID_TAGS:
+            remap_uid(ds[tag], pseudonymizer)
+
+
+def remap_uid(data_element, pseudonymizer):
+    if data_element.VM > 1:
+        data_element.value = [pseudonymizer.uid(uid) for uid in data_element.value]
+    else:
+        data_element.value = pseudonymizer.uid(data_element.value)
+
+
+def remap_media_storage_uid(ds, pseudonymizer):
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is not None and MEDIA_STORAGE_SOP_INSTANCE_UID in file_meta:
+        remap_uid(file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID], pseudonymizer)
+
+
+def element_vr(ds, tag):
+    vr = ds.get_item(tag).VR
+    if vr:
+        return vr
+    try:
+        return dictionary_VR(tag)
+    except KeyError:
+        return 'UN'
+
+
+def anonymize_file_full(file, pseudonymizer, writer, series='', timings=None):
+    start = time.perf_counter()
+    ds = pydicom.dcmread(file)
+    check_not_pseudonymized(ds)
+    start = lap(timings, 'read', start)
+
+    patient_name = anonymize_dataset(ds, pseudonymizer, series)
+
+    data = BytesIO()
+    ds.save_as(data)
+    lap(timings, 'rewrite', start)
+    return writer.write(file, data.getvalue()), patient_name
+
+
+def anonymize_dataset(ds, pseudonymizer, series=''):
+    patient_name = pseudonymizer.patient_name(ds, series)
+
+    ds.walk(del_callback)
+    if pseudonymizer.remap_uids:
+        ds.walk(lambda _, data_element: uid_callback(data_element, pseudonymizer))
+        remap_media_storage_uid(ds, pseudonymizer)
+
+    apply_tag_rules(ds, patient_name)
+    return patient_name
+
 
 def del_callback(ds, data_element):
-    if data_element.VR == 'PN':
-        data_element.value = 'ANONYMOUS'
-    if data_element.VR == 'DA':
-        data_element.value = "20000101"
-    if data_element.VR == 'TM':
-        data_element.value = "000000"
-    if data_element.VR == 'SH':
-        data_element.value = "(??)"
+    if data_element.VR in VR_RULES:
+        data_element.value = VR_RULES[data_element.VR]
+
+
+def uid_callback(data_element, pseudonymizer):
+    if data_element.VR == 'UI' and data_element.tag not in CLASS_UID_TAGS:
+        remap_uid(data_element, pseudonymizer)
 
 
 def setup():
     parser = argparse.ArgumentParser()
-    parser.add_argument('DICOM_Folder', help='Database to anonimyze', type=check_folder)
+    parser.add_argument('DICOM_Folder', help='Database to anonimyze (folder, or zip/tar archive with --output)',
+                        type=check_input)
+    parser.add_argument('-o', '--output', help='Output archive (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz): the input '
+                                               'archive is anonymized in memory, without unpacking it')
     parser.add_argument('-q', '--quiet', help='Suppress output', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of workers (default: all cores)', type=check_positive,
+                        default=cpu_count())
+    parser.add_argument('-b', '--backend', help='Parallel backend (default: loky)', default='loky',
+                        choices=['loky', 'multiprocessing', 'threading'])
+    parser.add_argument('-c', '--chunk-size', help='Maximum number of files per task (default: 16)',
+                        type=check_positive, default=16)
+    parser.add_argument('--chunk-mb', help='Maximum size of a task in MB (default: 64)', type=check_positive,
+                        default=64)
+    parser.add_argument('--full', help='Decode the whole dataset, pixel data included (slow path)',
+                        action='store_true')
+    parser.add_argument('-m', '--manifest', help='SQLite manifest of the anonymized files, re-runs skip them and '
+                                                 'reuse the same pseudonyms (folders only). Without --key-file it '
+                                                 'stores the pseudonymization key: keep it private, out of the '
+                                                 'anonymized folder')
+    parser.add_argument('--fsync-batch', help='Flush the written files to disk by batches of N before replacing '
+                                              'the originals (default: 0, no fsync)', type=check_positive_or_zero,
+                        default=0)
+    parser.add_argument('--max-writers', help='Maximum number of workers writing at the same time (default: no '
+                                              'limit)', type=check_positive)
+    parser.add_argument('-k', '--key-file', help='Pseudonymization key, created if missing: the same key gives the '
+                                                 'same pseudonyms and UIDs across runs')
+    parser.add_argument('--pseudonym-store', help='SQLite table of the original identifiers and UIDs with their '
+                                                  'pseudonyms (re-identification table, keep it private)')
+    parser.add_argument('--keep-uids', help='Do not remap the instance UIDs', action='store_true')
+    parser.add_argument('--stats', help='Write the run statistics (throughput, errors, stage timings) to a JSON '
+                                        'file')
 
     args = parser.parse_args()
-
-    return args.DICOM_Folder, args.quiet
+    if os.path.isdir(args.DICOM_Folder) == bool(args.output):
+        parser.error('--output is required for archives and only supported for them')
+    if args.output and args.backend == 'multiprocessing':
+        parser.error('--output requires the loky or threading backend')
+    return args
 
 
-def check_folder(value):
-    if not os.path.isdir(value):
-        raise argparse.ArgumentTypeError('Path is not a directory: %s' % value)
-    else:
+def check_input(value):
+    if os.path.isdir(value) or zipfile.is_zipfile(value) or (os.path.isfile(value) and tarfile.is_tarfile(value)):
         return value
+    else:
+        raise argparse.ArgumentTypeError('Path is not a directory nor a zip/tar archive: %s' % value)
+
+
+def check_positive(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('Must be a positive integer: %s' % value)
+    return value
+
+
+def check_positive_or_zero(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 0:
+        raise argparse.ArgumentTypeError('Must be a positive integer or zero: %s' % value)
+    return value
 
 
 if __name__ == '__main__':
-    main()
+    #run from the importable module: loky then pickles the tasks by reference instead of by value, and the workers
+    #keep their module state (WORKER) from one task to the next
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import DICOM_anonymizer
+    DICOM_anonymizer.main()
     sys.exit()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from benchmark_runner import run_script, check_positive
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+ANONYMIZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DICOM_anonymizer.py')
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+
+def main():
+    args = setup()
+
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    source = os.path.join(work_dir, 'source')
+    try:
+        print('Generating {} files...'.format(args.files))
+        generate_tree(source, args.files, args.files_per_series, args.frames, args.size, args.depth,
+                      args.private_tags)
+
+        results = []
+        for backend in args.backends:
+            for n_jobs in args.jobs:
+                for repeat in range(args.repeat):
+                    target = os.path.join(work_dir, 'run')
+                    shutil.copytree(source, target)
+                    result = run_anonymizer(target, n_jobs, backend, args.extra)
+                    shutil.rmtree(target)
+
+                    result.update({'backend': backend, 'jobs': n_jobs, 'repeat': repeat})
+                    results.append(result)
+                    print('{:>15} {:>3} jobs: {:8.1f} files/s {:8.1f} MB/s {:8.1f} MB peak RSS, {} errors | '
+                          'read {:.2f} s, rewrite {:.2f} s, write {:.2f} s'.format(
+                              backend, n_jobs, result['files_per_s'], result['mb_per_s'], result['peak_rss_mb'],
+                              result['errors'], result['timings']['read'], result['timings']['rewrite'],
+                              result['timings']['write']))
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'files': args.files, 'frames': args.frames, 'size': args.size, 'depth': args.depth,
+                           'private_tags': args.private_tags, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def generate_tree(root, n_files, files_per_series, frames, size, depth, private_tags):
+    """
+    Synthetic MR tree: root/level_0/.../level_<depth-1>/series_<n>/image_<n>.dcm, 3 series per study
+    """
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 4096, (frames, size, size), dtype=np.uint16).tobytes()
+    studies = {}
+    for i in range(n_files):
+        series = i // files_per_series
+        folder = os.path.join(root, *['level_{}'.format(series % (l + 2)) for l in range(depth)])
+        folder = os.path.join(folder, 'series_{}'.format(series))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            series_uid = generate_uid()
+        patient_id = 'PAT{:04d}'.format(series // 3)
+        study_uid = studies.setdefault(patient_id, generate_uid())
+        ds = make_dataset(patient_id, study_uid, series_uid, frames, size, private_tags)
+        ds.PixelData = pixels
+        ds.save_as(os.path.join(folder, 'image_{}.dcm'.format(i)), enforce_file_format=True)
+
+
+def make_dataset(patient_id, study_uid, series_uid, frames, size, private_tags):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.FrameOfReferenceUID = generate_uid()
+    ds.Modality = 'MR'
+    ds.PatientName = 'Doe^John'
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = '19800101'
+    ds.PatientWeight = 70
+    ds.AdditionalPatientHistory = 'History'
+    ds.StudyDate = ds.SeriesDate = '20200101'
+    ds.StudyTime = ds.SeriesTime = '120000'
+    ds.InstitutionName = 'Hospital'
+    ds.StationName = 'MR1'
+    ds.SeriesDescription = 'T1'
+    ds.ProtocolName = 'T1 3D'
+    ds.ReferringPhysicianName = 'Doe^Jane'
+
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = MR_IMAGE_STORAGE
+    reference.ReferencedSOPInstanceUID = generate_uid()
+    ds.ReferencedImageSequence = Sequence([reference])
+
+    if private_tags:
+        block = ds.private_block(0x0029, 'BENCHMARK', create=True)
+        for offset in range(min(private_tags, 0xFF)):
+            block.add_new(offset, 'LO', 'private value {}'.format(offset))
+
+    ds.Rows = ds.Columns = size
+    ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    return ds
+
+
+def run_anonymizer(dir_path, n_jobs, backend, extra=()):
+    """
+    Run DICOM_anonymizer.py in a subprocess
+    :return: statistics of the run, with the peak RSS of the largest process
+    """
+    stats_file = os.path.join(os.path.dirname(dir_path), 'stats.json')
+    rss_file = os.path.join(os.path.dirname(dir_path), 'peak_rss')
+    command = [ANONYMIZER, dir_path, '-j', str(n_jobs), '-b', backend, '--stats', stats_file]
+    command.extend(extra)
+
+    returncode, wall, peak_rss = run_script(command, rss_file)
+    if returncode:
+        raise RuntimeError('Anonymizer failed: ' + ' '.join(command))
+    with open(stats_file) as f:
+        stats = json.load(f)
+    os.remove(stats_file)
+    stats['wall_seconds'] = wall
+    stats['peak_rss_mb'] = peak_rss / 2 ** 20
+    return stats
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Benchmark of DICOM_anonymizer.py on a synthetic DICOM tree')
+    parser.add_argument('-n', '--files', help='Number of files (default: 1000)', type=check_positive, default=1000)
+    parser.add_argument('--files-per-series', help='Files per series folder (default: 100)', type=check_positive,
+                        default=100)
+    parser.add_argument('--frames', help='Frames per file (default: 1)', type=check_positive, default=1)
+    parser.add_argument('--size', help='Rows and columns of each frame (default: 256)', type=check_positive,
+                        default=256)
+    parser.add_argument('--depth', help='Nesting depth of the series folders (default: 2)', type=int, default=2)
+    parser.add_argument('--private-tags', help='Private elements per file (default: 10)', type=int, default=10)
+    parser.add_argument('-j', '--jobs', help='Worker counts to compare (default: 1 2 4)', type=check_positive,
+                        nargs='+', default=[1, 2, 4])
+    parser.add_argument('-b', '--backends', help='Backends to compare (default: loky threading)', nargs='+',
+                        default=['loky', 'threading'], choices=['loky', 'multiprocessing', 'threading'])
+    parser.add_argument('-r', '--repeat', help='Runs per configuration (default: 1)', type=check_positive,
+                        default=1)
+    parser.add_argument('-o', '--output', help='JSON file of the results')
+    parser.add_argument('--work-dir', help='Folder of the synthetic tree (default: system temporary folder)')
+    parser.add_argument('extra', help='Options passed to the anonymizer, after --', nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.extra and args.extra[0] == '--':
+        args.extra = args.extra[1:]
+    return args
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
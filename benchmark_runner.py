@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+#runs a script, writes the peak RSS (bytes) of its largest process to a file: python -c PEAK_RSS rss_file script args...
+PEAK_RSS = """import sys, runpy, resource
+rss_file = sys.argv.pop(1)
+sys.argv.pop(0)
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    try:
+        with open('/proc/self/status') as f:
+            rss = [int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:')]
+        #the worker processes that have exited
+        rss.append(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+        with open(rss_file, 'w') as f:
+            f.write(str(max(rss)))
+    except OSError:
+        pass
+"""
+
+
+def run_script(command, rss_file):
+    """
+    Run a Python script in a subprocess, its output is discarded
+    :param command: script and its arguments
+    :param rss_file: temporary file where the subprocess writes its peak RSS
+    :return: exit code, wall time (s), peak RSS (bytes) of the largest process of the script
+    """
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', PEAK_RSS, rss_file] + list(command), stdout=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else:
+        returncode = process.wait()
+        peak_rss = float('nan')
+    wall = time.time() - start
+
+    #the child inherits the peak RSS of the benchmark through fork, its own high water mark is exact
+    if os.path.isfile(rss_file):
+        with open(rss_file) as f:
+            peak_rss = int(f.read())
+        os.remove(rss_file)
+    return returncode, wall, peak_rss
+
+
+def check_positive(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('Must be a positive integer: %s' % value)
+    return value
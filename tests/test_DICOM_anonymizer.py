@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import stat
+import sqlite3
+import tarfile
+import zipfile
+import threading
+import subprocess
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+import pytest
+from pydicom.uid import DeflatedExplicitVRLittleEndian, generate_uid
+
+import DICOM_anonymizer as anonymizer
+from DICOM_benchmark import make_dataset
+
+KEY = b'0123456789abcdef'
+
+
+def write_dicom(filename, transfer_syntax=None, **elements):
+    ds = make_dataset('PAT0001', generate_uid(), generate_uid(), 1, 4, 0)
+    if transfer_syntax:
+        ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.PixelData = bytes(32)
+    for keyword, value in elements.items():
+        if value is None:
+            delattr(ds, keyword)
+        else:
+            setattr(ds, keyword, value)
+    ds.save_as(filename, enforce_file_format=True)
+    return filename
+
+
+@pytest.mark.parametrize('full', [False, True])
+@pytest.mark.parametrize('mode', [0o644, 0o640, 0o604])
+def test_file_mode_preserved(tmp_path, full, mode):
+    filename = write_dicom(str(tmp_path / 'image.dcm'))
+    os.chmod(filename, mode)
+    records, errors, _, _ = anonymizer.anonymize([filename], str(tmp_path), KEY, full)
+    assert not errors and len(records) == 1
+    assert stat.S_IMODE(os.stat(filename).st_mode) == mode
+
+
+def test_new_file_mode_follows_umask(tmp_path):
+    writer = anonymizer.AtomicWriter()
+    filename = str(tmp_path / 'new.dcm')
+    writer.write(filename, b'data')
+    writer.flush()
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o666 & ~anonymizer.UMASK
+
+
+@pytest.mark.parametrize('full, transfer_syntax', [(False, None), (True, None),
+                                                   (False, DeflatedExplicitVRLittleEndian)])
+@pytest.mark.parametrize('missing', [('PatientID',), ('InstitutionName', 'ProtocolName'),
+                                     ('PatientName', 'PatientWeight', 'SeriesDescription')])
+def test_missing_tags(tmp_path, full, transfer_syntax, missing):
+    filename = write_dicom(str(tmp_path / 'image.dcm'), transfer_syntax, **dict.fromkeys(missing))
+    records, errors, _, _ = anonymizer.anonymize([filename], str(tmp_path), KEY, full)
+    assert not errors and len(records) == 1
+
+    ds = pydicom.dcmread(filename)
+    for keyword in missing:
+        assert keyword not in ds
+    for keyword in ('PatientID', 'InstitutionName', 'SeriesDescription', 'ProtocolName'):
+        if keyword not in missing:
+            assert ds.data_element(keyword).value == '(??)'
+    assert 'PatientWeight' not in ds and 'AdditionalPatientHistory' not in ds
+    if 'PatientName' not in missing:
+        assert str(ds.PatientName) == records[0][4]
+    assert ds.StationName == '(??)' and ds.ReferringPhysicianName == 'ANONYMOUS'
+
+
+@pytest.mark.parametrize('backend', ['loky', 'multiprocessing', 'threading'])
+@pytest.mark.parametrize('archive', [False, True])
+def test_backends(tmp_path, backend, archive):
+    source = tmp_path / 'source'
+    source.mkdir()
+    filenames = [write_dicom(str(source / 'image{}.dcm'.format(i))) for i in range(5)]
+    stats_file = str(tmp_path / 'stats.json')
+    command = [sys.executable, anonymizer.__file__, str(source), '-j', '2', '-b', backend, '-c', '2',
+               '--stats', stats_file]
+    if archive:
+        with zipfile.ZipFile(str(tmp_path / 'in.zip'), 'w') as f:
+            for filename in filenames:
+                f.write(filename, os.path.basename(filename))
+        command[2:3] = [str(tmp_path / 'in.zip'), '-o', str(tmp_path / 'out.zip')]
+    if archive and backend == 'multiprocessing':
+        assert subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 2
+        return
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+    with open(stats_file) as f:
+        stats = json.load(f)
+    assert stats['files'] == 5 and stats['errors'] == 0
+    if archive:
+        with zipfile.ZipFile(str(tmp_path / 'out.zip')) as f:
+            datasets = [pydicom.dcmread(f.open(name)) for name in f.namelist()]
+    else:
+        datasets = [pydicom.dcmread(filename) for filename in filenames]
+    assert len(datasets) == 5
+    assert all(ds.PatientID == '(??)' and 'PatientWeight' not in ds for ds in datasets)
+
+
+def test_pseudonymizer_reused_across_tasks(tmp_path):
+    pseudonymizer = anonymizer.worker_pseudonymizer(KEY, None, True)
+    assert anonymizer.worker_pseudonymizer(KEY, None, True) is pseudonymizer
+    assert anonymizer.worker_pseudonymizer(KEY, None, False) is not pseudonymizer
+    others = []
+    thread = threading.Thread(target=lambda: others.append(anonymizer.worker_pseudonymizer(KEY, None, True)))
+    thread.start()
+    thread.join()
+    assert others[0] is not pseudonymizer
+
+    #the second task finds the patient of the first one in the cache
+    first = write_dicom(str(tmp_path / 'first.dcm'), PatientID='PAT-REUSED')
+    second = write_dicom(str(tmp_path / 'second.dcm'), PatientID='PAT-REUSED')
+    records, _, _, _ = anonymizer.anonymize([first], str(tmp_path), KEY)
+    assert pseudonymizer.cache['patient', 'PAT-REUSED'] == records[0][4]
+    outputs, errors, _, _ = anonymizer.anonymize_members([('second.dcm', open(second, 'rb').read())], KEY)
+    assert not errors and ('patient', 'PAT-REUSED') in pseudonymizer.cache
+    assert str(pydicom.dcmread(BytesIO(outputs[0])).PatientName) == records[0][4]
+
+
+@pytest.mark.parametrize('key_file', [False, True])
+@pytest.mark.parametrize('inside', [False, True])
+def test_manifest_key(tmp_path, key_file, inside):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_dicom(str(source / 'image.dcm'))
+    manifest = str((source if inside else tmp_path) / 'manifest.sqlite')
+    command = [sys.executable, anonymizer.__file__, str(source), '-j', '1', '-m', manifest]
+    if key_file:
+        command += ['-k', str(tmp_path / 'key')]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    assert stat.S_IMODE(os.stat(manifest).st_mode) == 0o600
+    if key_file:
+        assert stat.S_IMODE(os.stat(str(tmp_path / 'key')).st_mode) == 0o600
+    db = sqlite3.connect(manifest)
+    stored = db.execute("SELECT value FROM meta WHERE name = 'key'").fetchall()
+    assert db.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 1
+    db.close()
+    assert bool(stored) != key_file
+    assert ('Warning: {} holds the pseudonymization key'.format(manifest) in output) == (inside and not key_file)
+
+
+@pytest.mark.parametrize('fsync_batch', [0, 2])
+def test_manifest_resume_after_crash(tmp_path, monkeypatch, fsync_batch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    filenames = [write_dicom(str(source / 'image{}.dcm'.format(i)), PatientID='PAT{}'.format(i)) for i in range(5)]
+    manifest = anonymizer.Manifest(str(tmp_path / 'manifest.sqlite'), str(source))
+    anonymize_file = anonymizer.anonymize_file
+
+    def crash(file, *args):
+        if file == filenames[3]:
+            raise KeyboardInterrupt('crash')
+        return anonymize_file(file, *args)
+
+    monkeypatch.setattr(anonymizer, 'anonymize_file', crash)
+    with pytest.raises(KeyboardInterrupt):
+        anonymizer.anonymize(filenames, str(source), manifest.key, fsync_batch=fsync_batch,
+                             manifest=manifest.filename)
+    monkeypatch.setattr(anonymizer, 'anonymize_file', anonymize_file)
+
+    #the files replaced before the crash are recorded one by one, the resume only processes the others
+    files = [(file, os.path.getsize(file), os.stat(file).st_mtime_ns) for file in sorted(filenames)]
+    pending = [file for file, _, _ in manifest.pending(files)]
+    assert pending == filenames[3:] if not fsync_batch else filenames[2:]
+    records, errors, _, _ = anonymizer.anonymize(pending, str(source), manifest.key, manifest=manifest.filename)
+    assert not errors and len(records) == len(pending)
+    files = [(file, os.path.getsize(file), os.stat(file).st_mtime_ns) for file in sorted(filenames)]
+    assert list(manifest.pending(files)) == []
+    assert all(pydicom.dcmread(file).PatientID == '(??)' for file in filenames)
+    manifest.close()
+
+
+@pytest.mark.parametrize('full', [False, True])
+@pytest.mark.parametrize('remap_uids', [False, True])
+def test_uid_remap(tmp_path, full, remap_uids):
+    study = generate_uid()
+    filenames = [write_dicom(str(tmp_path / 'image{}.dcm'.format(i)), StudyInstanceUID=study) for i in range(2)]
+    originals = [pydicom.dcmread(file) for file in filenames]
+    records, errors, _, _ = anonymizer.anonymize(filenames, str(tmp_path), KEY, full, remap_uids=remap_uids)
+    assert not errors and len(records) == 2
+    outputs = [pydicom.dcmread(file) for file in filenames]
+
+    for original, ds in zip(originals, outputs):
+        assert ds.SOPClassUID == original.SOPClassUID
+        assert ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID
+        assert ds.ReferencedImageSequence[0].ReferencedSOPClassUID == original.SOPClassUID
+        for keyword in ('SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID', 'FrameOfReferenceUID'):
+            if remap_uids:
+                assert ds[keyword].value.startswith('2.25.') and ds[keyword].value != original[keyword].value
+            else:
+                assert ds[keyword].value == original[keyword].value
+        reference = ds.ReferencedImageSequence[0].ReferencedSOPInstanceUID
+        assert (reference != original.ReferencedImageSequence[0].ReferencedSOPInstanceUID) == remap_uids
+    #the UIDs shared by the files are remapped the same way, the others to different UIDs
+    assert outputs[0].StudyInstanceUID == outputs[1].StudyInstanceUID
+    assert outputs[0].SOPInstanceUID != outputs[1].SOPInstanceUID
+    again = anonymizer.Pseudonymizer(KEY, remap_uids=remap_uids)
+    assert again.uid(originals[0].SOPInstanceUID) == outputs[0].SOPInstanceUID
+
+
+@pytest.mark.parametrize('full', [False, True])
+def test_already_pseudonymized_left_unchanged(tmp_path, full):
+    filenames = [write_dicom(str(tmp_path / 'image{}.dcm'.format(i)), PatientID='PAT{}'.format(i)) for i in range(2)]
+    records, errors, _, unchanged = anonymizer.anonymize(filenames, str(tmp_path), KEY, full)
+    assert not errors and len(records) == 2 and unchanged == 0
+    names = [record[4] for record in records]
+    assert names[0] != names[1]
+    data = [open(file, 'rb').read() for file in filenames]
+    ds = pydicom.dcmread(filenames[0])
+    assert ds.PatientIdentityRemoved == 'YES' and ds.DeidentificationMethod == anonymizer.METHOD
+
+    #a second run, with any key, keeps the pseudonyms and the UIDs of the first one
+    records, errors, _, unchanged = anonymizer.anonymize(filenames, str(tmp_path), KEY[::-1], full)
+    assert not errors and not records and unchanged == 2
+    assert [open(file, 'rb').read() for file in filenames] == data
+    outputs, errors, _, unchanged = anonymizer.anonymize_members([('image0.dcm', data[0])], KEY[::-1])
+    assert not errors and unchanged == 1 and outputs == [data[0]]
+
+
+def test_placeholders_not_pseudonymized(tmp_path):
+    #files anonymized by the versions without de-identification mark, and placeholders from other tools
+    pseudonymizer = anonymizer.Pseudonymizer(KEY)
+    first = write_dicom(str(tmp_path / 'first.dcm'), PatientID='(??)')
+    records, errors, _, unchanged = anonymizer.anonymize([first], str(tmp_path), KEY)
+    assert not records and not errors and unchanged == 1
+    ds = pydicom.dcmread(write_dicom(str(tmp_path / 'second.dcm')))
+    ds.PatientID = '(??)'
+    other = pydicom.dcmread(write_dicom(str(tmp_path / 'third.dcm')))
+    other.PatientID = '(??)'
+    assert pseudonymizer.patient_name(ds) != pseudonymizer.patient_name(other)
+    assert pseudonymizer.patient_name(ds) == pseudonymizer.lookup('patient', ds.StudyInstanceUID)
+
+
+@pytest.mark.parametrize('backend', ['loky', 'threading'])
+@pytest.mark.parametrize('extension', ['.tar', '.tar.gz', '.zip'])
+def test_tar_archive_input(tmp_path, backend, extension):
+    source = tmp_path / 'source'
+    (source / 'series').mkdir(parents=True)
+    filenames = [write_dicom(str(source / 'series' / 'image{}.dcm'.format(i)), PatientID='PAT{}'.format(i % 2))
+                 for i in range(7)]
+    (source / 'series' / 'notes.txt').write_text('not DICOM')
+    in_file, out_file = str(tmp_path / 'in.tar.gz'), str(tmp_path / ('out' + extension))
+    with tarfile.open(in_file, 'w:gz') as f:
+        f.add(str(source), 'export')
+    subprocess.run([sys.executable, anonymizer.__file__, in_file, '-o', out_file, '-j', '2', '-b', backend,
+                    '-c', '2'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    names = ['export/series/image{}.dcm'.format(i) for i in range(7)]
+    if extension == '.zip':
+        with zipfile.ZipFile(out_file) as f:
+            assert [name for name in f.namelist() if name.endswith('.dcm')] == sorted(names)
+            datasets = {name: pydicom.dcmread(BytesIO(f.read(name))) for name in names}
+    else:
+        with tarfile.open(out_file) as f:
+            members = f.getmembers()
+            #the folders are kept, in the order of the input
+            with tarfile.open(in_file) as original:
+                assert [member.name for member in members] == [member.name for member in original
+                                                              if not member.name.endswith('.txt')]
+            datasets = {name: pydicom.dcmread(f.extractfile(name)) for name in names}
+    for name, filename in zip(names, filenames):
+        original = pydicom.dcmread(filename)
+        ds = datasets[name]
+        assert ds.PatientID == '(??)' and ds.SOPInstanceUID != original.SOPInstanceUID
+        assert ds.PixelData == original.PixelData
+    pseudonyms = [str(datasets[name].PatientName) for name in names]
+    assert pseudonyms[0::2] == [pseudonyms[0]] * 4 and pseudonyms[1::2] == [pseudonyms[1]] * 3
+    assert pseudonyms[0] != pseudonyms[1]
+
+
+def test_bounded_map_window():
+    taken = []
+
+    def tasks():
+        for i in range(10):
+            taken.append(i)
+            yield pow, i, 2
+
+    with ThreadPoolExecutor(2) as executor:
+        results = anonymizer.bounded_map(executor, tasks(), 3)
+        for i, result in enumerate(results):
+            assert result == i ** 2
+            #the task i is being consumed, at most 2 more are submitted
+            assert len(taken) == min(i + 3, 10)
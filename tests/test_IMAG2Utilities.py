@@ -0,0 +1,203 @@
+import json
+
+import numpy as np
+import pytest
+import nibabel as nib
+
+import IMAG2Utilities
+from IMAG2Utilities import IMAG2UtilitiesLogic as Logic
+
+
+def random_masks(shape, seed, labels=2):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, labels, shape), rng.integers(0, labels, shape)
+
+
+def brute_confusion(m1, m2):
+    labels = np.union1d(np.unique(m1), np.unique(m2))
+    return labels, np.array([[np.count_nonzero((m1 == l1) & (m2 == l2)) for l2 in labels] for l1 in labels])
+
+
+@pytest.mark.parametrize('shape', [(9, 7, 5), (1, 4, 4), (12, 1, 3)])
+@pytest.mark.parametrize('block', [1, 7, 2 ** 22])
+def test_overlap_counts_brute_force(shape, block):
+    m1, m2 = random_masks(shape, 0, 3)
+    a, b = m1 != 0, m2 != 0
+    counts = Logic.overlap_counts(m1, m2, block)
+    assert counts == {'tp': np.count_nonzero(a & b), 'fp': np.count_nonzero(~a & b), 'fn': np.count_nonzero(a & ~b),
+                      'tn': np.count_nonzero(~a & ~b)}
+
+
+@pytest.mark.parametrize('cut, margin', [(False, 0), (True, 0), (True, 2)])
+def test_overlap_metrics_brute_force(cut, margin):
+    m1 = np.zeros((20, 18, 16), dtype=np.uint8)
+    m2 = np.zeros_like(m1)
+    m1[4:12, 5:10, 3:9] = 1
+    m1[4, 5, 3:5] = 0
+    m2[6:14, 5:11, 2:9] = 1
+    m2[0, 0, 0] = 1
+    metrics = Logic.overlap_metrics(m1, m2, cut, margin)
+
+    if cut:
+        bbox = tuple(slice(max(start - margin, 0), min(stop + margin, size))
+                     for (start, stop), size in zip([(4, 12), (5, 10), (3, 9)], m1.shape))
+        m1, m2 = m1[bbox], m2[bbox]
+    a, b = m1 != 0, m2 != 0
+    tp, fp, fn, tn = (np.count_nonzero(x) for x in (a & b, ~a & b, a & ~b, ~a & ~b))
+    assert metrics['dice'] == pytest.approx(200. * tp / (2 * tp + fp + fn))
+    assert metrics['iou'] == pytest.approx(100. * tp / (tp + fp + fn))
+    assert metrics['sensitivity'] == pytest.approx(100. * tp / (tp + fn))
+    assert metrics['specificity'] == pytest.approx(100. * tn / (tn + fp))
+    assert metrics['volume_difference'] == pytest.approx(100. * (fp - fn) / (tp + fn))
+    assert Logic.dice(m1, m2) == pytest.approx(metrics['dice'])
+
+
+@pytest.mark.parametrize('dtype', [np.bool_, np.uint8, np.int16, np.uint32, np.int64, np.uint64, np.float32])
+@pytest.mark.parametrize('scale', [1, 1000, 2 ** 25])
+@pytest.mark.parametrize('block', [5, 2 ** 22])
+def test_label_confusion_brute_force(dtype, scale, block):
+    #small label values take the direct codes, larger ones the lookup tables, the largest np.unique
+    n_labels = 2 if dtype == np.bool_ else 6
+    if scale > np.iinfo(np.int16).max and dtype in (np.int16, np.float32) or scale > 1 and dtype == np.bool_:
+        pytest.skip('labels not representable')
+    m1, m2 = random_masks((6, 5, 4), 1, n_labels)
+    m1, m2 = (m1 * scale).astype(dtype), (m2 * scale).astype(dtype)
+    m2[0] = m1[0]
+    labels, confusion = Logic.label_confusion(m1, m2, block)
+    expected_labels, expected = brute_confusion(m1.astype(np.int64), m2.astype(np.int64))
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_array_equal(confusion, expected)
+
+
+def test_label_metrics_brute_force():
+    m1, m2 = random_masks((10, 8, 6), 2, 5)
+    m2[m2 == 4] = 7
+    metrics = Logic.label_metrics(m1, m2)
+    assert sorted(metrics) == [1, 2, 3, 4, 7]
+    for label, values in metrics.items():
+        a, b = m1 == label, m2 == label
+        tp, fp, fn = np.count_nonzero(a & b), np.count_nonzero(~a & b), np.count_nonzero(a & ~b)
+        assert (values['tp'], values['fp'], values['fn']) == (tp, fp, fn)
+        if tp + fp + fn:
+            assert values['dice'] == pytest.approx(200. * tp / (2 * tp + fp + fn))
+
+
+def test_label_values_out_of_range():
+    with pytest.raises(ValueError):
+        Logic.label_confusion(np.array([2 ** 63], dtype=np.uint64), np.array([1], dtype=np.uint64))
+    with pytest.raises(ValueError):
+        Logic.label_confusion(np.array([-1, 1]), np.array([1, 1]))
+
+
+def save_nii(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([1.5, 1., 2., 1.]), dtype=data.dtype), str(path))
+    return str(path)
+
+
+def test_score_uint64_label_maps(tmp_path):
+    m1, m2 = random_masks((8, 7, 6), 3, 4)
+    reference = save_nii(tmp_path / 'reference.nii', m1.astype(np.uint64))
+    segmentation = save_nii(tmp_path / 'segmentation.nii.gz', m2.astype(np.uint64))
+    options = {'cut': False, 'margin': 0, 'surface': False, 'labels': True, 'slab': None, 'threads': 1}
+    rows = IMAG2Utilities.score_pair(reference, segmentation, options)
+    assert [row['error'] for row in rows] == [''] * 3
+    assert [row['label'] for row in rows] == [1, 2, 3]
+
+
+def test_self_test():
+    IMAG2Utilities.IMAG2UtilitiesTest().run_test()
+
+
+def brute_surface_distances(m1, m2, spacing):
+    def surface_points(mask):
+        padded = np.pad(mask != 0, 1)
+        points = []
+        for index in np.argwhere(mask != 0):
+            neighbors = [padded[tuple(index + 1 + offset)] for offset in np.vstack([np.eye(3, dtype=int),
+                                                                                  -np.eye(3, dtype=int)])]
+            if not all(neighbors):
+                points.append(index * spacing)
+        return np.array(points)
+
+    points1, points2 = surface_points(m1), surface_points(m2)
+    distances = np.linalg.norm(points1[:, None] - points2[None], axis=-1)
+    distances12, distances21 = distances.min(axis=1), distances.min(axis=0)
+    return {'hausdorff': max(distances12.max(), distances21.max()),
+            'hd95': max(np.percentile(distances12, 95), np.percentile(distances21, 95)),
+            'assd': np.concatenate([distances12, distances21]).mean()}
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('spacing', [None, (1.5, 1., 2.)])
+def test_surface_distances_brute_force(seed, spacing):
+    rng = np.random.default_rng(seed)
+    m1 = np.zeros((14, 12, 10), dtype=np.uint8)
+    m2 = np.zeros_like(m1)
+    m1[2:9, 3:10, 1:8] = 1
+    m2[4:12, 2:8, 3:9] = 1
+    #holes, islands and voxels on the edges of the volume
+    m1[rng.random(m1.shape) < 0.05] = 0
+    m2[rng.random(m2.shape) < 0.02] = 1
+    m2[0, :, 0] = 1
+    metrics = Logic.surface_distances(m1, m2, spacing)
+    expected = brute_surface_distances(m1, m2, np.ones(3) if spacing is None else np.asarray(spacing))
+    for key in ('hausdorff', 'hd95', 'assd'):
+        assert metrics[key] == pytest.approx(expected[key])
+
+
+def test_surface_distances_empty_mask():
+    m1 = np.zeros((4, 4, 4), dtype=np.uint8)
+    m1[1, 1, 1] = 1
+    metrics = Logic.surface_distances(m1, np.zeros_like(m1))
+    assert all(np.isnan(value) for value in metrics.values())
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('slab, threads', [(1, 1), (3, 2), (16, 1), (5, 4)])
+@pytest.mark.parametrize('labels', [False, True])
+def test_slab_scoring_matches_in_memory(tmp_path, extension, slab, threads, labels):
+    m1, m2 = random_masks((9, 8, 11), 4, 5 if labels else 2)
+    #a label only present in some slabs
+    m2[..., 7] = np.where(m2[..., 7] == 1, 9, m2[..., 7])
+    dtype = np.uint64 if labels else np.uint8
+    reference = save_nii(tmp_path / ('reference' + extension), m1.astype(dtype))
+    segmentation = save_nii(tmp_path / ('segmentation' + extension), m2.astype(dtype))
+    metrics = Logic.file_metrics(reference, segmentation, labels, slab, threads)
+    expected = Logic.label_metrics(m1, m2) if labels else Logic.overlap_metrics(m1, m2)
+    if labels:
+        assert sorted(metrics) == sorted(expected)
+        for label, values in expected.items():
+            assert metrics[label] == pytest.approx(values, nan_ok=True)
+    else:
+        assert metrics == pytest.approx(expected, nan_ok=True)
+
+
+def test_slab_scoring_checks_geometry(tmp_path):
+    m1, m2 = random_masks((6, 6, 6), 5)
+    reference = save_nii(tmp_path / 'reference.nii', m1.astype(np.uint8))
+    segmentation = str(tmp_path / 'segmentation.nii')
+    nib.save(nib.Nifti1Image(m2.astype(np.uint8), np.eye(4)), segmentation)
+    with pytest.raises(ValueError):
+        Logic.file_metrics(reference, segmentation)
+
+
+def test_json_results_without_nan(tmp_path):
+    filename = str(tmp_path / 'scores.json')
+    with IMAG2Utilities.ResultWriter(filename, ['reference', 'dice', 'hausdorff', 'label']) as writer:
+        writer.write({'reference': 'a.nii', 'dice': np.float64(50.), 'hausdorff': np.nan, 'label': 1})
+        writer.write({'reference': 'b.nii', 'dice': float('nan'), 'hausdorff': np.float32(np.inf)})
+
+    def reject(constant):
+        raise ValueError(constant)
+
+    with open(filename) as f:
+        rows = json.load(f, parse_constant=reject)
+    assert rows == [{'reference': 'a.nii', 'dice': 50., 'hausdorff': None, 'label': 1},
+                    {'reference': 'b.nii', 'dice': None, 'hausdorff': None, 'label': None}]
+
+
+@pytest.mark.parametrize('options', [['--surface', '--labels'], ['--slab', '2', '--surface'], ['--slab', '2', '--cut']])
+def test_setup_rejects_incompatible_options(monkeypatch, options):
+    monkeypatch.setattr('sys.argv', ['IMAG2Utilities.py', 'reference.nii', 'segmentation.nii'] + options)
+    with pytest.raises(SystemExit):
+        IMAG2Utilities.setup()
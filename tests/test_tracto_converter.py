@@ -0,0 +1,471 @@
+import os
+
+import numpy as np
+import pytest
+import nibabel as nib
+from nibabel.streamlines.tractogram import Tractogram
+
+import tracto_converter as tc
+
+FORMATS = ('tck', 'trk', 'vtk', 'vtp')
+
+
+def make_tractogram(lengths, step=1.):
+    """
+    Straight streamlines along x with a scalar, a vector per point and a weight per streamline
+    """
+    lengths = np.asarray(lengths)
+    starts = np.cumsum(lengths) - lengths
+    local = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    points = np.zeros((lengths.sum(), 3), dtype=np.float32)
+    points[:, 0] = local * step
+    points[:, 1] = np.repeat(np.arange(len(lengths)), lengths)
+    fa = np.linspace(0, 1, lengths.sum(), dtype=np.float32)[:, None]
+    rgb = np.random.default_rng(0).random((lengths.sum(), 3)).astype(np.float32)
+    return Tractogram(tc.array_sequence(points, starts, lengths),
+                      {'weight': np.arange(len(lengths), dtype=np.float32)[:, None]},
+                      {'fa': tc.array_sequence(fa, starts, lengths), 'rgb': tc.array_sequence(rgb, starts, lengths)},
+                      affine_to_rasmm=np.eye(4))
+
+
+def load(filename):
+    _, chunks = tc.iter_tractogram(filename)
+    chunks = [chunk for chunk in chunks if len(chunk)]
+    points = np.concatenate([tc.packed_data(chunk.streamlines) for chunk in chunks])
+    lengths = np.concatenate([chunk.streamlines._lengths for chunk in chunks])
+    data = {}
+    for chunk in chunks:
+        for key, values in chunk.data_per_point.items():
+            data.setdefault(key, []).append(tc.as_rows(tc.packed_data(values), values.total_nb_rows))
+        for key, values in chunk.data_per_streamline.items():
+            data.setdefault(key, []).append(tc.as_rows(values, len(values)))
+    return points, lengths, {key: np.concatenate(values) for key, values in data.items()}
+
+
+def assert_same(tractogram, filename):
+    points, lengths, data = load(filename)
+    np.testing.assert_array_equal(lengths, tractogram.streamlines._lengths)
+    np.testing.assert_allclose(points, tc.packed_data(tractogram.streamlines), atol=1e-4)
+    if 'rgb' not in data:
+        #.tck sidecars split the vectors into components
+        data['rgb'] = np.hstack([data.pop('rgb_{}'.format(i)) for i in range(3)])
+    np.testing.assert_allclose(data['fa'], tc.packed_data(tractogram.data_per_point['fa']), atol=1e-6)
+    np.testing.assert_allclose(data['rgb'], tc.packed_data(tractogram.data_per_point['rgb']), atol=1e-6)
+    np.testing.assert_allclose(data['weight'], tractogram.data_per_streamline['weight'], atol=1e-6)
+
+
+@pytest.mark.parametrize('out_format', FORMATS)
+def test_writer_round_trip_with_empty_chunks(tmp_path, out_format):
+    tractogram = make_tractogram([5, 2, 7, 3])
+    filename = str(tmp_path / ('out.' + out_format))
+    with tc.open_writer(filename) as writer:
+        writer.write(tractogram[:0])
+        writer.write(tractogram[:2])
+        writer.write(tractogram[2:2])
+        writer.write(tractogram[2:])
+    assert_same(tractogram, filename)
+
+
+@pytest.mark.parametrize('in_format', FORMATS)
+@pytest.mark.parametrize('out_format', FORMATS + ('xml',))
+def test_convert_round_trip(tmp_path, in_format, out_format):
+    if in_format == out_format:
+        pytest.skip('same format')
+    tractogram = make_tractogram([4, 9, 2, 6, 3])
+    in_file = str(tmp_path / ('in.' + in_format))
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    out_file = str(tmp_path / ('in.' + out_format))
+    _, stats, error = tc.convert(in_file, out_file, chunk_size=2)
+    assert error is None
+    assert stats['streamlines_out'] == 5
+    assert_same(tractogram, out_file)
+
+
+@pytest.mark.parametrize('out_format', FORMATS)
+def test_length_filter_empties_whole_chunks(tmp_path, out_format):
+    #the first chunk (4 short streamlines) is removed entirely
+    tractogram = make_tractogram([3, 3, 2, 3, 20, 25, 3, 30])
+    in_file = str(tmp_path / 'in.trk')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    out_file = str(tmp_path / ('in.' + out_format if out_format != 'trk' else 'out.trk'))
+    _, stats, error = tc.convert(in_file, out_file, chunk_size=4, processing={'min_length': 10})
+    assert error is None
+    assert stats['streamlines'] == 8
+    assert stats['streamlines_out'] == 3
+    assert_same(tractogram[np.array([4, 5, 7])], out_file)
+
+
+def test_all_streamlines_filtered_out(tmp_path):
+    tractogram = make_tractogram([3, 3, 2])
+    in_file = str(tmp_path / 'in.tck')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    out_file = str(tmp_path / 'in.vtk')
+    _, stats, error = tc.convert(in_file, out_file, chunk_size=2, processing={'min_length': 100})
+    assert error is None
+    assert stats['streamlines_out'] == 0
+
+
+def roi(tmp_path, name, voxels):
+    mask = np.zeros((40, 12, 2), dtype=np.uint8)
+    mask[tuple(np.transpose(voxels))] = 1
+    filename = str(tmp_path / (name + '.nii.gz'))
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), filename)
+    return tc.load_roi(filename)
+
+
+@pytest.mark.parametrize('out_format', FORMATS)
+@pytest.mark.parametrize('key, voxels, kept', [
+    #streamline i runs along x at y = i, the first chunk is streamlines 0-3
+    ('include', [(1, 5, 0), (0, 7, 0)], [5, 7]),
+    ('exclude', [(0, y, 0) for y in range(4)], [4, 5, 6, 7]),
+    ('start', [(0, 6, 0), (2, 4, 0)], [6]),
+    ('end', [(9, 4, 0), (0, 5, 0)], [4]),
+])
+def test_roi_filter_empties_whole_chunks(tmp_path, out_format, key, voxels, kept):
+    tractogram = make_tractogram([3, 4, 2, 3, 10, 6, 8, 5])
+    in_file = str(tmp_path / 'in.trk')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    out_file = str(tmp_path / ('in.' + out_format if out_format != 'trk' else 'out.trk'))
+    _, stats, error = tc.convert(in_file, out_file, chunk_size=4, processing={key: [roi(tmp_path, key, voxels)]})
+    assert error is None
+    assert stats['streamlines_out'] == len(kept)
+    assert_same(tractogram[np.array(kept)], out_file)
+
+
+def test_stray_sidecars_are_skipped(tmp_path, capsys):
+    tractogram = make_tractogram([4, 9, 2, 6, 3])
+    in_file = str(tmp_path / 'sub.tck')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    #sidecars of another tractogram, with the same or other streamlines
+    for name, lengths in (('sub.left.tck', [4, 9, 2, 6, 3]), ('other.tck', [4, 9, 2, 6])):
+        with tc.open_writer(str(tmp_path / name)) as writer:
+            writer.write(make_tractogram(lengths))
+    (tmp_path / 'other.fa.tsf').rename(tmp_path / 'sub.short.tsf')
+    (tmp_path / 'sub.notes.txt').write_text('acquired on the new scanner\n')
+    (tmp_path / 'sub.counts.txt').write_text('1\n2\n3\n')
+
+    out_file = str(tmp_path / 'sub.trk')
+    _, stats, error = tc.convert(in_file, out_file)
+    assert error is None
+    assert_same(tractogram, out_file)
+    _, _, data = load(out_file)
+    assert sorted(data) == ['fa', 'rgb_0', 'rgb_1', 'rgb_2', 'weight']
+    output = capsys.readouterr().out
+    for name in ('sub.left.fa.tsf', 'sub.left.weight.txt', 'sub.short.tsf', 'sub.notes.txt', 'sub.counts.txt'):
+        assert 'ignoring {}'.format(tmp_path / name) in output
+
+
+def test_trk_header_limits(tmp_path, capsys):
+    tractogram = make_tractogram([4, 9, 2])
+    lengths = tractogram.streamlines._lengths
+    long_name = 'fractional_anisotropy_mean'
+    scalars = {'{}{}'.format(long_name if i == 0 else 's', i): tractogram.data_per_point['fa'] for i in range(12)}
+    scalars['rgb'] = tractogram.data_per_point['rgb']
+    properties = {'weight_of_the_streamline': np.tile(tractogram.data_per_streamline['weight'], (1, 2))}
+    filename = str(tmp_path / 'out.trk')
+    with tc.open_writer(filename) as writer:
+        writer.write(Tractogram(tractogram.streamlines, properties, scalars, affine_to_rasmm=np.eye(4)))
+
+    points, found_lengths, data = load(filename)
+    np.testing.assert_array_equal(found_lengths, lengths)
+    np.testing.assert_allclose(points, tc.packed_data(tractogram.streamlines), atol=1e-4)
+    assert sorted(data) == sorted([long_name[:20]] + ['s{}'.format(i) for i in range(1, 10)] +
+                                  ['weight_of_the_stre'])
+    np.testing.assert_allclose(data[long_name[:20]], tc.packed_data(tractogram.data_per_point['fa']), atol=1e-6)
+    np.testing.assert_allclose(data['weight_of_the_stre'], properties['weight_of_the_streamline'], atol=1e-6)
+    output = capsys.readouterr().out
+    assert 'dropping s10, s11, rgb' in output and 'truncated' in output
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr('sys.argv', ['tracto_converter.py'] + [str(arg) for arg in argv])
+    tc.main()
+
+
+@pytest.mark.parametrize('update', ['mtime', 'hash'])
+def test_processing_options_make_outputs_stale(tmp_path, monkeypatch, update):
+    tractogram = make_tractogram([3, 3, 2, 3, 20, 25, 3, 30])
+    in_file = str(tmp_path / 'in.trk')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    out_file = str(tmp_path / 'in.vtk')
+    hash_file = tmp_path / 'hashes.json'
+    options = ['-u', update, '--hash-file', hash_file]
+
+    run_main(monkeypatch, in_file, 'vtk', *options)
+    assert len(load(out_file)[1]) == 8
+    run_main(monkeypatch, in_file, 'vtk', '--min-length', 10, *options)
+    assert len(load(out_file)[1]) == 3
+    run_main(monkeypatch, in_file, 'vtk', '--min-length', 22, *options)
+    assert len(load(out_file)[1]) == 2
+
+    #the same options again: skipped with -u hash only
+    mtime = os.path.getmtime(out_file)
+    os.utime(out_file, (mtime - 10, mtime - 10))
+    run_main(monkeypatch, in_file, 'vtk', '--min-length', 22, *options)
+    assert (os.path.getmtime(out_file) == mtime - 10) == (update == 'hash')
+
+    #a changed mask is a changed option
+    roi(tmp_path, 'include', [(0, 4, 0)])
+    run_main(monkeypatch, in_file, 'vtk', '--include', tmp_path / 'include.nii.gz', *options)
+    assert len(load(out_file)[1]) == 1
+    roi(tmp_path, 'include', [(0, 4, 0), (0, 5, 0)])
+    run_main(monkeypatch, in_file, 'vtk', '--include', tmp_path / 'include.nii.gz', *options)
+    assert len(load(out_file)[1]) == 2
+
+
+@pytest.mark.parametrize('update', ['mtime', 'hash'])
+def test_failed_conversion_leaves_no_output(tmp_path, monkeypatch, update):
+    tractogram = make_tractogram([4, 9, 2, 6, 3])
+    in_file = str(tmp_path / 'in.trk')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    options = ['-u', update, '--hash-file', tmp_path / 'hashes.json', '-c', 2]
+    iter_tractogram = tc.iter_tractogram
+
+    def broken(filename, chunk_size):
+        header, chunks = iter_tractogram(filename, chunk_size)
+
+        def chunks_then_error():
+            yield next(chunks)
+            raise ValueError('truncated input')
+        return header, chunks_then_error()
+
+    monkeypatch.setattr(tc, 'iter_tractogram', broken)
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, in_file, 'tck', *options)
+    #neither the .tck nor its sidecars are left after the first chunk was written
+    assert [f for f in os.listdir(str(tmp_path)) if f != 'hashes.json'] == ['in.trk']
+
+    #the next run converts the file again
+    monkeypatch.setattr(tc, 'iter_tractogram', iter_tractogram)
+    run_main(monkeypatch, in_file, 'tck', *options)
+    assert_same(tractogram, str(tmp_path / 'in.tck'))
+
+
+def curved_tractogram(lengths, seed=0):
+    """
+    Random walks with uneven steps and a scalar per point
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.asarray(lengths)
+    starts = np.cumsum(lengths) - lengths
+    steps = rng.normal(size=(lengths.sum(), 3)) * rng.uniform(0.2, 3, (lengths.sum(), 1))
+    steps[starts] = rng.uniform(-50, 50, (len(lengths), 3))
+    points = np.vstack([np.cumsum(steps[start:start + length], axis=0) for start, length in zip(starts, lengths)])
+    fa = rng.random((lengths.sum(), 1))
+    return Tractogram(tc.array_sequence(points.astype(np.float32), starts, lengths), {},
+                      {'fa': tc.array_sequence(fa.astype(np.float32), starts, lengths)}, affine_to_rasmm=np.eye(4))
+
+
+def reference_resampling(points, values, count):
+    arc = np.r_[0, np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))]
+    target = np.linspace(0, arc[-1], count)
+    return (np.column_stack([np.interp(target, arc, column) for column in points.T]),
+            np.column_stack([np.interp(target, arc, column) for column in values.T]))
+
+
+def distances_to_segment(points, a, b):
+    return tc.segment_distance(points, np.tile(a, (len(points), 1)), np.tile(b, (len(points), 1)))
+
+
+def reference_douglas_peucker(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    segments = [(0, len(points) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        distances = distances_to_segment(points[first + 1:last], points[first], points[last])
+        farthest = first + 1 + np.argmax(distances)
+        if distances.max() > tolerance:
+            keep[farthest] = True
+            segments += [(first, farthest), (farthest, last)]
+    return keep
+
+
+@pytest.mark.parametrize('option, value', [('--points', 12), ('--step', 2.5), ('--step', 40)])
+@pytest.mark.parametrize('threads', [1, 3])
+def test_resampling_matches_reference(tmp_path, monkeypatch, option, value, threads):
+    lengths = [2, 30, 7, 2, 51, 18, 3]
+    tractogram = curved_tractogram(lengths)
+    in_file = str(tmp_path / 'in.trk')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    run_main(monkeypatch, in_file, 'tck', option, value, '-t', threads, '-c', 2)
+    points, out_lengths, data = load(str(tmp_path / 'in.tck'))
+
+    starts = np.cumsum(out_lengths) - out_lengths
+    for i, (streamline, fa) in enumerate(zip(tractogram.streamlines, tractogram.data_per_point['fa'])):
+        streamline = streamline.astype(np.float64)
+        arc_length = np.linalg.norm(np.diff(streamline, axis=0), axis=1).sum()
+        count = value if option == '--points' else max(int(np.rint(arc_length / value)) + 1, 2)
+        assert out_lengths[i] == count
+        expected_points, expected_fa = reference_resampling(streamline, fa, count)
+        np.testing.assert_allclose(points[starts[i]:starts[i] + count], expected_points, atol=1e-3)
+        np.testing.assert_allclose(data['fa'][starts[i]:starts[i] + count], expected_fa, atol=1e-5)
+
+
+@pytest.mark.parametrize('tolerance', [0.01, 0.5, 3, 1000])
+@pytest.mark.parametrize('threads', [1, 3])
+def test_compression_matches_reference(tmp_path, monkeypatch, tolerance, threads):
+    lengths = [2, 30, 7, 3, 51, 18, 1]
+    tractogram = curved_tractogram(lengths, 1)
+    in_file = str(tmp_path / 'in.tck')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    run_main(monkeypatch, in_file, 'vtk', '--tolerance', tolerance, '-t', threads, '-c', 2)
+    points, out_lengths, data = load(str(tmp_path / 'in.vtk'))
+
+    starts = np.cumsum(out_lengths) - out_lengths
+    for i, (streamline, fa) in enumerate(zip(tractogram.streamlines, tractogram.data_per_point['fa'])):
+        keep = reference_douglas_peucker(streamline.astype(np.float64), tolerance)
+        kept = points[starts[i]:starts[i] + out_lengths[i]]
+        np.testing.assert_array_equal(kept, streamline[keep])
+        np.testing.assert_array_equal(data['fa'][starts[i]:starts[i] + out_lengths[i]], fa[keep])
+        #the endpoints are kept and the removed points are within tolerance of the compressed streamline
+        np.testing.assert_array_equal(kept[[0, -1]], streamline[[0, -1]])
+        indices = np.flatnonzero(keep)
+        streamline = streamline.astype(np.float64)
+        for first, last in zip(indices[:-1], indices[1:]):
+            distances = distances_to_segment(streamline[first + 1:last], streamline[first], streamline[last])
+            assert np.all(distances <= tolerance + 1e-9)
+
+
+@pytest.mark.parametrize('out_format', ['vtk', 'vtp'])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_cells_written_by_chunks(tmp_path, monkeypatch, out_format, reverse):
+    monkeypatch.setattr(tc, 'CELL_CHUNK', 3)
+    tractogram = make_tractogram([4, 9, 2, 6, 3, 1, 5])
+    filename = str(tmp_path / ('out.' + out_format))
+    lengths = tractogram.streamlines._lengths
+    starts = np.cumsum(lengths) - lengths
+    #each line given by its points in reverse order
+    lines_indices = [np.arange(start, start + length)[::-1] for start, length in zip(starts, lengths)]
+    tc.save_vtk(filename, tractogram, lines_indices if reverse else None)
+    points, out_lengths, _ = load(filename)
+    np.testing.assert_array_equal(out_lengths, lengths)
+    expected = tc.packed_data(tractogram.streamlines)
+    np.testing.assert_allclose(points, expected[np.concatenate(lines_indices)] if reverse else expected, atol=1e-6)
+
+
+def test_tck_sidecars_share_the_timestamp(tmp_path, capsys):
+    tractogram = make_tractogram([4, 9, 2, 6, 3])
+    in_file = str(tmp_path / 'sub.tck')
+    with tc.open_writer(in_file) as writer:
+        writer.write(tractogram)
+    timestamps = {name: tc.read_mrtrix_header(str(tmp_path / name))['timestamp']
+                  for name in ('sub.tck', 'sub.fa.tsf', 'sub.rgb_0.tsf')}
+    assert len(set(timestamps.values())) == 1
+
+    #sidecars with the same timestamp are checked on the counts, then chunk by chunk on the lengths
+    for name, lengths in (('short', [4, 9, 2, 6]), ('moved', [9, 4, 2, 6, 3])):
+        with tc.TckWriter(str(tmp_path / 'sub.{}.tsf'.format(name)), 'track scalars', timestamps['sub.tck']) as writer:
+            writer.write_rows(make_tractogram(lengths).data_per_point['fa'])
+    (tmp_path / 'sub.moved.tsf').rename(tmp_path / 'sub.moved.tsf.keep')
+    _, _, error = tc.convert(in_file, str(tmp_path / 'sub.vtk'), chunk_size=2)
+    assert error is None
+    assert 'ignoring {} (4 streamlines, 21 points instead of 5, 24)'.format(tmp_path / 'sub.short.tsf') in \
+        capsys.readouterr().out
+    (tmp_path / 'sub.moved.tsf.keep').rename(tmp_path / 'sub.moved.tsf')
+    _, _, error = tc.convert(in_file, str(tmp_path / 'sub.vtk'), chunk_size=2)
+    assert error == 'ValueError: moved: the scalars do not match the streamlines'
+
+
+def test_inputs_hashed_by_the_workers(tmp_path, monkeypatch, capsys):
+    in_files = []
+    for name in ('a', 'b'):
+        in_files.append(str(tmp_path / (name + '.trk')))
+        with tc.open_writer(in_files[-1]) as writer:
+            writer.write(make_tractogram([4, 9, 2]))
+    events = []
+    file_hash, convert = tc.file_hash, tc.convert
+
+    def logged_hash(filename):
+        events.append(('hash', os.path.basename(filename)))
+        return file_hash(filename)
+
+    def logged_convert(in_file, *args):
+        events.append(('convert', os.path.basename(in_file)))
+        return convert(in_file, *args)
+
+    monkeypatch.setattr(tc, 'file_hash', logged_hash)
+    monkeypatch.setattr(tc, 'convert', logged_convert)
+    options = ['-u', 'hash', '--hash-file', tmp_path / 'hashes.json']
+    run_main(monkeypatch, *(in_files + ['tck'] + options))
+    #each input is hashed right before its conversion, not all of them up front
+    assert events == [('hash', 'a.trk'), ('convert', 'a.trk'), ('hash', 'b.trk'), ('convert', 'b.trk')]
+    assert capsys.readouterr().out.startswith('2 files converted, 0 skipped')
+
+    events.clear()
+    os.remove(str(tmp_path / 'b.tck'))
+    run_main(monkeypatch, *(in_files + ['tck'] + options))
+    assert events == [('hash', 'a.trk'), ('hash', 'b.trk'), ('convert', 'b.trk')]
+    assert capsys.readouterr().out.startswith('1 files converted, 1 skipped')
+
+
+def brute_legacy_cells(lines, number_of_lines):
+    connectivity, offsets, position = [], [0], 0
+    for _ in range(number_of_lines):
+        size = lines[position]
+        connectivity.extend(lines[position + 1:position + 1 + size])
+        offsets.append(offsets[-1] + size)
+        position += size + 1
+    return np.array(connectivity, dtype=lines.dtype), np.array(offsets)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('number_of_lines', [0, 1, 2, 7, 64, 1000])
+@pytest.mark.parametrize('ordered', [False, True])
+def test_legacy_cells_brute_force(seed, number_of_lines, ordered):
+    rng = np.random.default_rng(seed)
+    #the points in order take the vectorised walk (unless a cell is empty), the others the sequential one
+    sizes = rng.integers(1 if ordered and seed else 0, 12, number_of_lines)
+    offsets = np.cumsum(sizes) - sizes
+    cells = [np.r_[size, np.arange(offset, offset + size) if ordered else rng.integers(0, 50, size)]
+             for size, offset in zip(sizes, offsets)]
+    lines = np.array([value for cell in cells for value in cell], dtype=np.int64)
+    #cells after the lines (polygons, strips) are ignored
+    lines = np.r_[lines, 3, 1, 2, 3]
+    if ordered and seed and number_of_lines:
+        assert tc.ordered_cell_headers(lines, number_of_lines) is not None
+    connectivity, offsets = tc.legacy_cells(lines, number_of_lines)
+    expected_connectivity, expected_offsets = brute_legacy_cells(lines, number_of_lines)
+    np.testing.assert_array_equal(connectivity, expected_connectivity)
+    np.testing.assert_array_equal(offsets, expected_offsets)
+
+
+def test_legacy_cells_truncated():
+    with pytest.raises(ValueError):
+        tc.legacy_cells(np.array([2, 0, 1, 3, 2, 3]), 3)
+    with pytest.raises(ValueError):
+        tc.legacy_cells(np.array([2, 0, 1, 3, 2, 3]), 2)
+
+
+@pytest.mark.parametrize('manifest', [False, True])
+def test_invalid_input_is_a_usage_error(tmp_path, monkeypatch, capsys, manifest):
+    bad = str(tmp_path / 'notes.txt')
+    argv = ['-m', str(tmp_path / 'list.txt')] if manifest else [bad]
+    (tmp_path / 'list.txt').write_text(bad + '\n')
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(monkeypatch, *(argv + ['vtk']))
+    assert exit_info.value.code == 2
+    assert 'Invalid file extension' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('in_format', ['VTK', 'Vtp', 'XML'])
+def test_upper_case_vtk_extensions(tmp_path, in_format):
+    tractogram = make_tractogram([4, 9, 2])
+    in_file = str(tmp_path / ('in.' + in_format))
+    with tc.open_writer(str(tmp_path / 'in.') + in_format.lower()) as writer:
+        writer.write(tractogram)
+    os.rename(str(tmp_path / 'in.') + in_format.lower(), in_file)
+    _, _, error = tc.convert(in_file, str(tmp_path / 'out.tck'))
+    assert error is None
+    assert_same(tractogram, str(tmp_path / 'out.tck'))
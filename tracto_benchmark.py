@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import numpy as np
+from nibabel.streamlines.tractogram import Tractogram
+
+import tracto_converter as tc
+from benchmark_runner import run_script, check_positive
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+CONVERTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tracto_converter.py')
+FORMATS = ('tck', 'trk', 'vtk', 'vtp', 'xml')
+
+
+def main():
+    args = setup()
+
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        print('Generating {} streamlines...'.format(args.streamlines))
+        tractogram = generate_tractogram(args.streamlines, args.min_points, args.max_points, args.step, args.dtype,
+                                         args.scalars)
+        sources = {}
+        for in_format in args.formats:
+            sources[in_format] = os.path.join(work_dir, in_format, 'synthetic.' + in_format)
+            os.makedirs(os.path.dirname(sources[in_format]))
+            start = time.time()
+            save_tractogram(sources[in_format], tractogram)
+            print('{:>4}: written in {:.2f} s, {:.1f} MB'.format(in_format, time.time() - start,
+                                                              os.path.getsize(sources[in_format]) / 2 ** 20))
+
+        results = []
+        for in_format, out_format in itertools.permutations(args.formats, 2):
+            for repeat in range(args.repeat):
+                wall, peak_rss = run_converter(sources[in_format], out_format, args.extra)
+                size = os.path.getsize(sources[in_format])
+                result = {'wall_seconds': wall, 'bytes': size, 'mb_per_s': size / 2 ** 20 / wall,
+                          'streamlines_per_s': args.streamlines / wall, 'peak_rss_mb': peak_rss / 2 ** 20}
+                out_file = tc.output_name(sources[in_format], out_format)
+                result['max_error'] = max_error(tractogram, out_file)
+                result['lossless'] = result['max_error'] <= args.tolerance
+                remove_output(out_file)
+
+                result.update({'input': in_format, 'output': out_format, 'repeat': repeat})
+                results.append(result)
+                print('{:>4} -> {:<4} {:8.2f} s {:8.1f} MB/s {:10.0f} streamlines/s {:8.1f} MB peak RSS, '
+                      'max error {:.2e} mm{}'.format(in_format, out_format, result['wall_seconds'],
+                                                     result['mb_per_s'], result['streamlines_per_s'],
+                                                     result['peak_rss_mb'], result['max_error'],
+                                                     '' if result['lossless'] else ' (LOSSY)'))
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'streamlines': args.streamlines, 'min_points': args.min_points,
+                           'max_points': args.max_points, 'step': args.step, 'dtype': args.dtype,
+                           'scalars': args.scalars, 'results': results}, f, indent=2)
+        if not all(result['lossless'] for result in results):
+            sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def generate_tractogram(n_streamlines, min_points, max_points, step, dtype, scalars=False):
+    """
+    Synthetic tractogram: random walks with a fixed step length, in a 200 mm cube centered on the origin
+    :param scalars: add per point (fa, rgb) and per streamline (weight) data
+    """
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(min_points, max_points + 1, n_streamlines)
+    directions = rng.normal(size=(lengths.sum(), 3))
+    directions *= step / np.linalg.norm(directions, axis=1, keepdims=True)
+    #smooth walks: each direction is averaged with the previous ones
+    directions = np.cumsum(directions, axis=0)
+    directions -= np.repeat(directions[np.cumsum(lengths) - lengths], lengths, axis=0)
+    directions *= step / np.maximum(np.linalg.norm(directions, axis=1, keepdims=True), 1e-6)
+    points = np.cumsum(directions, axis=0)
+    points -= np.repeat(points[np.cumsum(lengths) - lengths] - rng.uniform(-60, 60, (n_streamlines, 3)), lengths,
+                        axis=0)
+    streamlines = tc.array_sequence(points.astype(dtype), np.cumsum(lengths) - lengths, lengths)
+
+    data_per_point, data_per_streamline = {}, {}
+    if scalars:
+        data_per_point = {'fa': tc.array_sequence(rng.random((lengths.sum(), 1), dtype=np.float32),
+                                                  np.cumsum(lengths) - lengths, lengths),
+                          'rgb': tc.array_sequence(rng.random((lengths.sum(), 3), dtype=np.float32),
+                                                   np.cumsum(lengths) - lengths, lengths)}
+        data_per_streamline = {'weight': rng.random((n_streamlines, 1), dtype=np.float32)}
+    return Tractogram(streamlines, data_per_streamline, data_per_point, affine_to_rasmm=np.eye(4))
+
+
+def save_tractogram(filename, tractogram):
+    with tc.open_writer(filename) as writer:
+        writer.write(tractogram)
+
+
+def run_converter(in_file, out_format, extra=()):
+    """
+    Run tracto_converter.py in a subprocess
+    :return: wall time (s), peak RSS (bytes) of the conversion
+    """
+    command = [CONVERTER, in_file, out_format, '-u', 'all']
+    command.extend(extra)
+
+    returncode, wall, peak_rss = run_script(command, in_file + '.rss')
+    if returncode:
+        raise RuntimeError('Conversion failed: ' + ' '.join(command))
+    return wall, peak_rss
+
+
+def max_error(reference, filename):
+    """
+    :return: largest difference between the points (mm) and the data of the reference and of the tractogram file,
+    inf if the numbers of streamlines or points differ or if some data is missing
+    """
+    _, chunks = tc.iter_tractogram(filename)
+    chunks = list(chunks)
+    lengths = np.concatenate([chunk.streamlines._lengths for chunk in chunks]) if chunks else np.empty(0)
+    if not np.array_equal(lengths, reference.streamlines._lengths):
+        return float('inf')
+
+    error = 0.
+    for first, chunk in zip(np.cumsum([0] + [len(chunk) for chunk in chunks]), chunks):
+        expected = reference[first:first + len(chunk)]
+        error = max(error, array_error(tc.packed_data(expected.streamlines), tc.packed_data(chunk.streamlines)))
+        for key, values in expected.data_per_point.items():
+            actual = data_columns({k: tc.packed_data(v) for k, v in chunk.data_per_point.items()}, key)
+            error = max(error, array_error(tc.packed_data(values), actual))
+        for key, values in expected.data_per_streamline.items():
+            error = max(error, array_error(values, data_columns(chunk.data_per_streamline, key)))
+    return error
+
+
+def data_columns(data, key):
+    """
+    :return: data array key, or its components key_0, key_1... (.tck sidecars) stacked, None if missing
+    """
+    if key in data:
+        return data[key]
+    components = list(itertools.takewhile(lambda k: k in data, ('{}_{}'.format(key, i) for i in itertools.count())))
+    if not components:
+        return None
+    return np.hstack([np.reshape(data[k], (len(data[k]), -1)) for k in components])
+
+
+def array_error(expected, actual):
+    if actual is None or np.size(expected) != np.size(actual):
+        return float('inf')
+    expected = np.asarray(expected, dtype=np.float64).ravel()
+    return float(np.abs(expected - np.asarray(actual, dtype=np.float64).ravel()).max(initial=0))
+
+
+def remove_output(out_file):
+    """
+    Remove a converted tractogram, with its .tsf and .txt sidecars
+    """
+    if out_file.endswith('.tck'):
+        for extension in ('.tsf', '.txt'):
+            for sidecar in tc.find_sidecars(out_file, extension).values():
+                os.remove(sidecar)
+    os.remove(out_file)
+
+
+def setup():
+    parser = argparse.ArgumentParser(description='Benchmark of tracto_converter.py on synthetic tractograms')
+    parser.add_argument('-n', '--streamlines', help='Number of streamlines (default: 100000)', type=check_positive,
+                        default=100000)
+    parser.add_argument('--min-points', help='Minimum points per streamline (default: 20)', type=check_positive,
+                        default=20)
+    parser.add_argument('--max-points', help='Maximum points per streamline (default: 200)', type=check_positive,
+                        default=200)
+    parser.add_argument('--step', help='Step length in mm (default: 0.5)', type=tc.check_positive_float, default=0.5)
+    parser.add_argument('--dtype', help='Type of the coordinates (default: float32)',
+                        choices=['float32', 'float64'], default='float32')
+    parser.add_argument('--scalars', help='Add per point and per streamline data', action='store_true')
+    parser.add_argument('-f', '--formats', help='Formats to compare (default: all)', nargs='+', choices=FORMATS,
+                        default=list(FORMATS))
+    parser.add_argument('-r', '--repeat', help='Runs per conversion (default: 1)', type=check_positive, default=1)
+    parser.add_argument('--tolerance', help='Largest error of a lossless round trip, in mm (default: 1e-4)',
+                        type=float, default=1e-4)
+    parser.add_argument('-o', '--output', help='JSON file of the results')
+    parser.add_argument('--work-dir', help='Folder of the synthetic tractograms (default: system temporary folder)')
+    parser.add_argument('extra', help='Options passed to the converter, after --', nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.min_points > args.max_points:
+        parser.error('--min-points must not be larger than --max-points')
+    if args.extra and args.extra[0] == '--':
+        args.extra = args.extra[1:]
+    return args
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
@@ -3,137 +3,679 @@
 
 import os
 import sys
-import vtk
+import glob
+import zlib
+import shutil
+import tempfile
+import json
+import time
+import hashlib
 import argparse
+import itertools
 import numpy as np
-from vtk.util import numpy_support as ns
-from nibabel.streamlines.tck import TckFile as Tck
+import nibabel as nib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
 from nibabel.streamlines.tractogram import Tractogram
 from nibabel.streamlines.trk import TrkFile as Trk
+from nibabel.streamlines.trk import (header_2_dtype, get_affine_rasmm_to_trackvis, get_affine_trackvis_to_rasmm,
+                                     encode_value_in_name, decode_value_from_name, MAX_NB_NAMED_SCALARS_PER_POINT,
+                                     MAX_NB_NAMED_PROPERTIES_PER_STREAMLINE)
+from nibabel.streamlines.header import Field
+from nibabel.streamlines.array_sequence import ArraySequence
+from joblib import Parallel, delayed
 
 __author__ = 'Alessandro Delmonte'
 __email__ = 'delmonte.ale92@gmail.com'
 
+HEADER_BLOCK = 4096
+SCAN_ROWS = 2 ** 20
+CHUNK_SIZE = 100000
+EXTENSIONS = ('.tck', '.trk', '.vtk', '.xml', '.vtp')
+HASH_BLOCK = 2 ** 20
+VTP_BLOCK = 2 ** 16
+CELL_CHUNK = 2 ** 20
+TRK_NAME_LENGTH = 20
+
 
 def main():
-    in_file, out_format = setup()
-    filename, file_extension = os.path.splitext(in_file)
-    if file_extension == '.vtk':
-        streamlines = read_vtk(in_file)[0]
+    args = setup()
+    out_format = args.Output_Format.lower()
+
+    processing = {'min_length': args.min_length, 'max_length': args.max_length, 'points': args.points,
+                  'step': args.step, 'tolerance': args.tolerance}
+    rois = {key: getattr(args, key) for key in ('include', 'exclude', 'start', 'end') if getattr(args, key)}
+    options = options_hash(processing, rois)
+    processing.update({key: [load_roi(filename) for filename in filenames] for key, filenames in rois.items()})
+    if all(value is None for value in processing.values()):
+        processing, options = None, None
+
+    hashes = read_hashes(args.hash_file) if args.update == 'hash' else {}
+    tasks, skipped, outputs = [], 0, {}
+    for in_file in args.in_files:
+        out_file = output_name(in_file, out_format)
+        if os.path.abspath(out_file) == os.path.abspath(in_file):
+            print('{}: already in the {} format'.format(in_file, out_format))
+            skipped += 1
+        elif os.path.abspath(out_file) in outputs:
+            print('{}: same output as {}'.format(in_file, outputs[os.path.abspath(out_file)]))
+            skipped += 1
+        elif args.update == 'mtime' and not processing and is_up_to_date(in_file, out_file):
+            skipped += 1
+        else:
+            tasks.append((in_file, out_file))
+        outputs.setdefault(os.path.abspath(out_file), in_file)
+
+    def task(in_file, out_file):
+        arguments = (in_file, out_file, args.chunk_size, args.compress, processing, args.threads)
+        if args.update == 'hash':
+            #the inputs are hashed by the workers, as they come
+            return delayed(convert_if_changed)(hashes.get(os.path.abspath(in_file)), options, *arguments)
+        return delayed(convert)(*arguments)
+
+    start = time.time()
+    totals, errors, converted = {}, [], 0
+    with Parallel(n_jobs=min(args.jobs, max(len(tasks), 1)), batch_size=1, return_as='generator') as parallel:
+        for in_file, stats, error, *digest in parallel(task(in_file, out_file) for in_file, out_file in tasks):
+            if error:
+                errors.append((in_file, error))
+                continue
+            if stats is None:
+                skipped += 1
+                continue
+            converted += 1
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+            if args.update == 'hash':
+                hashes[os.path.abspath(in_file)] = digest[0]
+    elapsed = max(time.time() - start, 1e-9)
+
+    if args.update == 'hash':
+        write_hashes(args.hash_file, hashes)
+
+    print('{} files converted, {} skipped, {} failed in {:.1f} s: {:.1f} files/s, {:.0f} streamlines/s, '
+          '{:.1f} MB/s'.format(converted, skipped, len(errors), elapsed, converted / elapsed,
+                               totals.get('streamlines', 0) / elapsed, totals.get('bytes', 0) / 2 ** 20 / elapsed))
+    if processing and converted:
+        print('Processing: {} -> {} streamlines, {} -> {} points ({:.1%}), {:.1f} -> {:.1f} MB ({:.1%}) in {:.1f} s'
+              .format(totals['streamlines'], totals['streamlines_out'], totals['points'], totals['points_out'],
+                      totals['points_out'] / max(totals['points'], 1), totals['bytes'] / 2 ** 20,
+                      totals['bytes_out'] / 2 ** 20, totals['bytes_out'] / max(totals['bytes'], 1),
+                      totals['processing_seconds']))
+    for in_file, error in errors:
+        print('{}: {}'.format(in_file, error))
+    if errors:
+        sys.exit(1)
+
+
+def collect_inputs(paths, manifest=None, out_format=None):
+    """
+    :param paths: files, glob patterns or folders (searched recursively for tractograms)
+    :param manifest: text file with one input path per line
+    :param out_format: the tractograms already in this format are left out of the folders and patterns
+    :return: list of input tractograms, without duplicates
+    """
+    extensions = [e for e in EXTENSIONS if e != '.' + str(out_format)]
+    if manifest:
+        with open(manifest) as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    in_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                in_files.extend(os.path.join(root, f) for f in sorted(files)
+                                if os.path.splitext(f)[1].lower() in extensions)
+        elif glob.has_magic(path):
+            in_files.extend(f for f in sorted(glob.glob(path, recursive=True))
+                            if os.path.splitext(f)[1].lower() in extensions)
+        else:
+            in_files.append(check_ext(path))
+
+    unique = {}
+    for in_file in in_files:
+        unique.setdefault(os.path.abspath(in_file), in_file)
+    return list(unique.values())
+
+
+def output_name(in_file, out_format):
+    return os.path.splitext(in_file)[0] + '.' + out_format
+
+
+def is_up_to_date(in_file, out_file):
+    return os.path.isfile(out_file) and os.path.getmtime(out_file) >= os.path.getmtime(in_file)
+
+
+def convert(in_file, out_file, chunk_size=CHUNK_SIZE, compress=False, processing=None, threads=1):
+    """
+    Streamed conversion of a tractogram, the format of the output is given by its extension
+    :param processing: options of process_chunk, the chunks are processed in parallel by threads
+    :return: input file, statistics (streamlines and points in input and output, sizes in bytes, processing time),
+    error message (None on success)
+    """
+    stats = dict.fromkeys(('streamlines', 'streamlines_out', 'points', 'points_out', 'bytes', 'bytes_out',
+                           'processing_seconds'), 0)
+    writer = None
+    try:
+        header, chunks = iter_tractogram(in_file, chunk_size)
+        if processing:
+            chunks = iter_processed(chunks, processing, threads, stats)
+        with open_writer(out_file, header, compress) as writer:
+            for tractogram in chunks:
+                #the filters can remove all the streamlines of a chunk
+                if not len(tractogram):
+                    continue
+                writer.write(tractogram)
+                stats['streamlines_out'] += len(tractogram)
+                stats['points_out'] += tractogram.streamlines._lengths.sum()
+                if not processing:
+                    stats['streamlines'], stats['points'] = stats['streamlines_out'], stats['points_out']
+        stats['bytes'] = os.path.getsize(in_file)
+        stats['bytes_out'] = os.path.getsize(out_file)
+        return in_file, stats, None
+    except BaseException as e:
+        #the writers complete the file on close: a partial output would be taken for an up to date one
+        remove_outputs(writer.outputs() if writer is not None else [out_file])
+        if not isinstance(e, Exception):
+            raise
+        return in_file, stats, '{}: {}'.format(type(e).__name__, e)
+
+
+def remove_outputs(filenames):
+    for filename in filenames:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def convert_if_changed(known_digest, options, in_file, out_file, *args):
+    """
+    convert for --update hash: the conversion is skipped when the output exists and the digest of the input and of
+    the processing options is known_digest (an output written with other processing options is out of date)
+    :param options: options_hash of the processing options, None without processing
+    :return: input file, statistics (None when skipped), error message, digest of the input and options
+    """
+    try:
+        digest = file_hash(in_file) + (':' + options if options else '')
+    except OSError as e:
+        return in_file, None, '{}: {}'.format(type(e).__name__, e), None
+    if digest == known_digest and os.path.isfile(out_file):
+        return in_file, None, None, digest
+    return convert(in_file, out_file, *args) + (digest,)
+
+
+def iter_processed(chunks, options, threads, stats):
+    """
+    Process the chunks on a thread pool, in order: the next chunk is only read when the writer has taken a processed
+    one, so at most 2 * threads chunks are in memory
+    """
+    def timed(chunk):
+        start = time.perf_counter()
+        return len(chunk), process_chunk(chunk, options), time.perf_counter() - start
+
+    def result(future):
+        count, (tractogram, n_points), seconds = future.result()
+        stats['streamlines'] += count
+        stats['points'] += n_points
+        stats['processing_seconds'] += seconds
+        return tractogram
+
+    futures = deque()
+    with ThreadPoolExecutor(threads) as executor:
+        try:
+            for chunk in chunks:
+                futures.append(executor.submit(timed, chunk))
+                if len(futures) >= 2 * threads:
+                    yield result(futures.popleft())
+            while futures:
+                yield result(futures.popleft())
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def options_hash(options, rois):
+    """
+    :param options: processing options
+    :param rois: ROI mask filenames, by option
+    :return: hash of the options and of the content of the masks
+    """
+    digest = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for key in sorted(rois):
+        digest.update('{}:{}'.format(key, ','.join(file_hash(filename) for filename in rois[key])).encode())
+    return digest.hexdigest()
+
+
+def file_hash(file):
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_hashes(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_hashes(filename, hashes):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def iter_tractogram(filename, chunk_size=CHUNK_SIZE):
+    """
+    Streamed tractogram loading, only one chunk is kept in memory (except for VTK files, loaded at once)
+    :param filename: filename
+    :param chunk_size: number of streamlines per chunk
+    :return: header (TRK only, None otherwise), generator of Tractogram (streamlines with their per point and
+    per streamline data, in RAS+ mm)
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension in ('.vtk', '.vtp', '.xml'):
+        return None, split_chunks(as_tractogram(*read_vtk(filename)), chunk_size)
     elif file_extension == '.trk':
-        streamlines, _ = read_trk(in_file)
+        return iter_trk(filename, chunk_size)
     else:
-        streamlines, _ = read_tck(in_file)
-
-    file_name, _ = os.path.splitext(in_file)
-    if out_format == 'vtk':
-        save_vtk(file_name + '.vtk', streamlines)
-    elif out_format == 'trk':
-        header = None
-        save_trk(file_name + '.trk', streamlines, header)
+        return None, iter_tck(filename, chunk_size)
+
+
+def split_chunks(tractogram, chunk_size):
+    for start in range(0, len(tractogram), chunk_size):
+        yield tractogram[start:start + chunk_size]
+
+
+def as_tractogram(tracts, data=None):
+    """
+    :param tracts: streamlines or Tractogram
+    :param data: per point (ArraySequence) and per streamline (array) data, by name
+    :return: Tractogram
+    """
+    if isinstance(tracts, Tractogram):
+        return tracts
+    data = data or {}
+    return Tractogram(as_array_sequence(tracts),
+                      {k: v for k, v in data.items() if not isinstance(v, ArraySequence)},
+                      {k: v for k, v in data.items() if isinstance(v, ArraySequence)}, affine_to_rasmm=np.eye(4))
+
+
+def iter_tck(filename, chunk_size=CHUNK_SIZE):
+    """
+    TCK streamlines by chunks of chunk_size, with the per point data of the <name>.<key>.tsf sidecars and the per
+    streamline data of the <name>.<key>.txt sidecars (one line per streamline). The sidecars that do not match the
+    header of the streamlines are skipped with a warning, the lengths of the scalars are checked chunk by chunk.
+    """
+    sidecars = {extension: find_sidecars(filename, extension) for extension in ('.tsf', '.txt')}
+    if any(sidecars.values()):
+        header = read_mrtrix_header(filename)
+        sidecars = {extension: {key: path for key, path in found.items()
+                                if sidecar_matches(filename, key, path, header)}
+                    for extension, found in sidecars.items()}
+    scalars = {key: iter_mrtrix(path, chunk_size) for key, path in sidecars['.tsf'].items()}
+    properties = {key: open(path) for key, path in sidecars['.txt'].items()}
+    try:
+        for streamlines in iter_mrtrix(filename, chunk_size):
+            data_per_point = {key: next(chunks, ArraySequence()) for key, chunks in scalars.items()}
+            for key, values in data_per_point.items():
+                if not np.array_equal(values._lengths, streamlines._lengths):
+                    raise ValueError('{}: the scalars do not match the streamlines'.format(key))
+            data_per_streamline = {key: np.loadtxt(itertools.islice(f, len(streamlines)), ndmin=2)
+                                   for key, f in properties.items()}
+            for key, values in data_per_streamline.items():
+                if len(values) != len(streamlines):
+                    raise ValueError('{}: the properties do not match the streamlines'.format(key))
+            yield Tractogram(streamlines, data_per_streamline, data_per_point, affine_to_rasmm=np.eye(4))
+    finally:
+        for f in properties.values():
+            f.close()
+
+
+def find_sidecars(filename, extension):
+    """
+    :return: sidecar files <name>.<key><extension> of filename, by key
+    """
+    prefix = os.path.splitext(filename)[0] + '.'
+    return {path[len(prefix):-len(extension)]: path
+            for path in sorted(glob.glob(glob.escape(prefix) + '*' + extension))}
+
+
+def sidecar_matches(filename, key, path, header):
+    """
+    Only the headers and the file sizes are compared, the .tck is not scanned
+    :param header: MRtrix header of filename
+    :return: whether path holds one value per point (.tsf) or one line per streamline (.txt) of filename, a warning
+    is printed otherwise
+    """
+    #<name>.<other>.<key>.tsf belongs to the <name>.<other> tractogram when it exists
+    owner = [os.path.splitext(filename)[0] + '.' + key.split('.')[0] + extension for extension in EXTENSIONS]
+    owner = [other for other in owner if '.' in key and os.path.isfile(other)]
+    if owner:
+        reason = 'sidecar of {}'.format(owner[0])
+    elif path.endswith('.tsf'):
+        try:
+            scalars = read_mrtrix_header(path)
+            #the rows hold the points, a delimiter after each streamline and the end marker
+            points = len(map_mrtrix_vertices(filename, header)) - header['count'] - 1
+            found = len(map_mrtrix_vertices(path, scalars, 1)) - scalars['count'] - 1
+            if scalars.get('timestamp', header.get('timestamp')) != header.get('timestamp'):
+                reason = 'timestamp {} instead of {}'.format(scalars['timestamp'], header['timestamp'])
+            elif (scalars['count'], found) != (header['count'], points):
+                reason = '{} streamlines, {} points instead of {}, {}'.format(scalars['count'], found,
+                                                                             header['count'], points)
+            else:
+                reason = None
+        except (KeyError, ValueError) as e:
+            reason = 'unreadable header: {}'.format(e)
     else:
-        header = None
-        save_tck(file_name + '.tck', streamlines, header)
+        with open(path) as f:
+            first = f.readline()
+            count = (1 if first else 0) + sum(1 for _ in f)
+        try:
+            [float(value) for value in first.split()]
+            reason = None if count == header['count'] else '{} lines instead of {}'.format(count, header['count'])
+        except ValueError:
+            reason = 'not numeric'
+    if reason:
+        print('{}: ignoring {} ({})'.format(filename, path, reason))
+    return reason is None
+
+
+def iter_mrtrix(filename, chunk_size=CHUNK_SIZE):
+    """
+    Scan the memory-mapped vertices (.tck) or scalars (.tsf) by blocks and yield them by chunks of chunk_size
+    streamlines
+    """
+    header = read_mrtrix_header(filename)
+    vtx = map_mrtrix_vertices(filename, header, 1 if 'scalars' in header['magic'] else 3)
+    first = 0
+    delimiters = np.empty(0, dtype=np.intp)
+    for block_start in range(0, len(vtx), SCAN_ROWS):
+        block = vtx[block_start:block_start + SCAN_ROWS, 0]
+        delimiters = np.r_[delimiters, np.flatnonzero(~np.isfinite(block)) + block_start]
+        while len(delimiters) >= chunk_size:
+            last = delimiters[chunk_size - 1] + 1
+            yield mrtrix_chunk(vtx[first:last])
+            first, delimiters = last, delimiters[chunk_size:]
+    if first < len(vtx):
+        chunk = mrtrix_chunk(vtx[first:])
+        if len(chunk):
+            yield chunk
+
+
+def mrtrix_chunk(rows):
+    """
+    :param rows: vertices (or scalars) and delimiters of whole streamlines
+    :return: ArraySequence over a compact, native float copy of the vertices
+    """
+    rows = np.asarray(rows, dtype=rows.dtype.newbyteorder('='))
+    line_starts, line_lengths = split_streamlines(rows[:, 0])
+    return array_sequence(rows[np.isfinite(rows[:, 0])], np.cumsum(line_lengths) - line_lengths, line_lengths)
 
 
 def read_tck(filename):
     """
     MRTrix3 tractogram loading
     :param filename: filename
-    :return: tractogram, header
+    :return: tractogram (ArraySequence over the memory-mapped file), header
     """
 
     header = read_mrtrix_header(filename)
 
-    vertices, line_starts, line_ends = read_mrtrix_streamlines(filename, header)
-    streamlines = []
-    for s, e in zip(line_starts, line_ends):
-        streamlines.append(vertices[s:e, :])
+    vertices, line_starts, line_lengths = read_mrtrix_streamlines(filename, header)
 
-    return streamlines, header
+    return array_sequence(vertices, line_starts, line_lengths), header
 
 
 def read_mrtrix_header(in_file):
-    fileobj = open(in_file, "rb")
+    block = b''
+    with open(in_file, "rb") as fileobj:
+        while b"\nEND\n" not in block:
+            chunk = fileobj.read(HEADER_BLOCK)
+            if not chunk:
+                break
+            block += chunk
+
     header = {}
-    #iflogger.info("Reading header data...")
-    for line in fileobj:
-        line = line.decode()
-        if line == "END\n":
-            #iflogger.info("Reached the end of the header!")
-            break
-        elif ": " in line:
-            line = line.replace("\n", "")
+    header["magic"] = block.split(b"\n", 1)[0].decode(errors='replace')
+    for line in block.split(b"\nEND\n")[0].decode(errors='replace').split("\n"):
+        if ": " in line:
             line = line.replace("'", "")
-            key = line.split(": ")[0]
-            value = line.split(": ")[1]
+            key, value = line.split(": ", 1)
             header[key] = value
-            #iflogger.info('...adding "%s" to header for key "%s"', value, key)
-    fileobj.close()
-    header["count"] = int(header["count"].replace("\n", ""))
+    header["count"] = int(header["count"])
     header["offset"] = int(header["file"].replace(".", ""))
     return header
 
 
 def read_mrtrix_streamlines(in_file, header):
+    """
+    :return: memory-mapped vertices (delimiters included), first vertex and number of vertices of each streamline
+    """
+    vtx = map_mrtrix_vertices(in_file, header)
+    line_starts, line_lengths = split_streamlines(vtx[:, 0])
+    if header["count"] != line_lengths.size:
+        print('expected {} streamlines, found {}'.format(header["count"], line_lengths.size))
+
+    return vtx, line_starts, line_lengths
+
+
+def map_mrtrix_vertices(in_file, header, columns=3):
     byte_offset = header["offset"]
-    stream_count = header["count"]
     datatype = header["datatype"]
     dt = 4
     if datatype.startswith( 'Float64' ):
         dt = 8
     elif not datatype.startswith( 'Float32' ):
-        print('Unsupported datatype: ' + datatype)
-        return
-    #tck format stores three floats (x/y/z) for each vertex
-    num_triplets = (os.path.getsize(in_file) - byte_offset) // (dt * 3)
+        raise ValueError('Unsupported datatype: ' + datatype)
+    #tck format stores three floats (x/y/z) for each vertex, tsf format one
+    num_triplets = (os.path.getsize(in_file) - byte_offset) // (dt * columns)
     dt = 'f' + str(dt)
     if datatype.endswith( 'LE' ):
         dt = '<'+dt
     if datatype.endswith( 'BE' ):
         dt = '>'+dt
-    vtx = np.fromfile(in_file, dtype=dt, count=(num_triplets*3), offset=byte_offset)
-    vtx = np.reshape(vtx, (-1,3))
+    if num_triplets == 0:
+        return np.empty((0, columns), dtype=dt)
+    return np.memmap(in_file, dtype=dt, mode='r', offset=byte_offset, shape=(num_triplets, columns))
+
+
+def split_streamlines(x):
+    """
+    :param x: first coordinate of the vertices, streamlines are delimited by a NaN triplet and the file ends with
+    an Inf triplet
+    :return: first vertex and number of vertices of each streamline
+    """
+    delimiters = np.flatnonzero(~np.isfinite(x))
     #make sure last streamline delimited...
-    if not np.isnan(vtx[-2,1]):
-        vtx[-1,:] = np.nan
-    line_ends, = np.where(np.all(np.isnan(vtx), axis=1))
-    if stream_count != line_ends.size:
-        print('expected {} streamlines, found {}'.format(stream_count, line_ends.size))
-    line_starts = line_ends + 0
-    line_starts[1:line_ends.size] = line_ends[0:line_ends.size-1]
-    #the first line starts with the first vertex (index 0), so preceding NaN at -1
-    line_starts[0] = -1
-    #first vertex of line is the one after a NaN
-    line_starts = line_starts + 1
-    #last vertex of line is the one before NaN
-    line_ends = line_ends - 1
-
-    return vtx, line_starts, line_ends
+    if delimiters.size == 0 or delimiters[-1] != len(x) - 1:
+        delimiters = np.r_[delimiters, len(x)]
+    line_starts = np.r_[0, delimiters[:-1] + 1]
+    line_lengths = delimiters - line_starts
+    non_empty = line_lengths > 0
+    return line_starts[non_empty], line_lengths[non_empty]
 
 
-def read_trk(filename):
-    trk_object = tv.load(filename)
-    streamlines = trk_object.streamlines
-    header = trk_object.header
+def array_sequence(data, offsets, lengths):
+    """
+    ArraySequence view over a packed buffer, without copy: element i is data[offsets[i]:offsets[i] + lengths[i]]
+    """
+    sequence = ArraySequence()
+    sequence._data = data
+    sequence._offsets = np.asarray(offsets, dtype=np.intp)
+    sequence._lengths = np.asarray(lengths, dtype=np.intp)
+    return sequence
 
+
+def as_array_sequence(tracts):
+    if isinstance(tracts, ArraySequence):
+        return tracts
+    return ArraySequence(tracts)
+
+
+def packed_data(sequence):
+    """
+    Contiguous buffer of the elements of an ArraySequence, without copy when they are already contiguous
+    """
+    offsets, lengths = sequence._offsets, sequence._lengths
+    starts = np.cumsum(lengths) - lengths
+    if np.array_equal(offsets, starts) and len(sequence._data) == lengths.sum():
+        return sequence._data
+    return sequence._data[np.repeat(offsets - starts, lengths) + np.arange(lengths.sum())]
+
+
+def as_rows(values, count):
+    """
+    :return: values as a 2D array of count rows (one per point or per streamline), also when count is 0
+    """
+    values = np.asarray(values)
+    return values.reshape(count, int(np.prod(values.shape[1:], dtype=np.intp)))
+
+
+def read_trk(filename):
+    """
+    TrackVis tractogram loading
+    :param filename: filename
+    :return: tractogram (ArraySequence, RAS+ mm), header
+    """
+    header, chunks = iter_trk(filename, chunk_size=None)
+    streamlines = ArraySequence()
+    for tractogram in chunks:
+        streamlines = tractogram.streamlines
     return streamlines, header
 
 
-def save_tck(filename, tracts, header):
-    tractogram = Tractogram(tracts, affine_to_rasmm=np.eye(4))
-    tck_obj = Tck(tractogram, header)
-    tck_obj.save(filename)
+def iter_trk(filename, chunk_size=CHUNK_SIZE):
+    """
+    TRK streamlines by chunks of chunk_size (all at once if None), with their scalars and properties, decoded from
+    the memory-mapped records: number of points (int32), points (x, y, z and the scalars of each point), properties
+    :return: header (nibabel), generator of Tractogram in RAS+ mm
+    """
+    header = Trk._read_header(filename)
+    byte_order = '>' if header[Field.ENDIANNESS] == '>' else '<'
+    n_scalars = int(header[Field.NB_SCALARS_PER_POINT])
+    n_properties = int(header[Field.NB_PROPERTIES_PER_STREAMLINE])
+    offset = header['_offset_data']
+    n_words = (os.path.getsize(filename) - offset) // 4
+    if n_words:
+        words = np.memmap(filename, dtype=byte_order + 'i4', mode='r', offset=offset, shape=(n_words,))
+    else:
+        words = np.empty(0, dtype=byte_order + 'i4')
+
+    def chunks():
+        starts = trk_record_starts(words, 3 + n_scalars, n_properties, header[Field.NB_STREAMLINES])
+        step = chunk_size or max(len(starts), 1)
+        affine = get_affine_trackvis_to_rasmm(header)
+        for first in range(0, len(starts), step):
+            yield trk_chunk(words, starts[first:first + step], n_scalars, n_properties, affine, header)
+
+    return header, chunks()
+
+
+def trk_record_starts(words, point_size, n_properties, count=0):
+    """
+    Follow the chain of records: each record starts with its number of points, which gives the start of the next.
+    Only one integer is read per streamline, the points are not touched.
+    :param count: number of streamlines of the header (0 if unknown)
+    :return: position (in words) of each record
+    """
+    if not len(words):
+        return np.empty(0, dtype=np.intp)
+    native = words.dtype.isnative
+    view = memoryview(words) if native else None
+    starts = np.empty(count or 1024, dtype=np.intp)
+    position, n = 0, 0
+    while position < len(words):
+        if n == len(starts):
+            starts = np.resize(starts, 2 * n)
+        starts[n] = position
+        n_points = view[position] if native else int(words[position])
+        if n_points < 0:
+            raise ValueError('Invalid TRK record at word {}: {} points'.format(position, n_points))
+        position += 1 + n_points * point_size + n_properties
+        n += 1
+    if position != len(words):
+        raise ValueError('Truncated TRK file: the last record ends at word {} of {}'.format(position, len(words)))
+    if count and n != count:
+        print('expected {} streamlines, found {}'.format(count, n))
+    return starts[:n]
+
+
+def trk_chunk(words, starts, n_scalars, n_properties, affine, header):
+    """
+    Decode the records starting at starts
+    :return: Tractogram in RAS+ mm, with the scalars and properties named after the header
+    """
+    values = words.view(words.dtype.str[0] + 'f4')
+    lengths = np.asarray(words[starts], dtype=np.intp)
+    point_size = 3 + n_scalars
+    property_starts = starts + 1 + point_size * lengths
+    if not len(starts):
+        rows, properties = np.empty((0, point_size), dtype=np.float32), np.empty((0, n_properties), dtype=np.float32)
+    else:
+        #the records of the chunk are contiguous: drop the point counts and the properties, the points remain
+        first = starts[0]
+        span = values[first:property_starts[-1] + n_properties]
+        property_words = (property_starts - first)[:, None] + np.arange(n_properties)
+        is_point = np.ones(len(span), dtype=bool)
+        is_point[starts - first] = False
+        is_point[property_words.ravel()] = False
+        rows = np.asarray(span[is_point], dtype=np.float32).reshape(-1, point_size)
+        properties = np.asarray(span[property_words], dtype=np.float32)
+
+    offsets = np.cumsum(lengths) - lengths
+    points = rows[:, :3].dot(affine[:3, :3].T) + affine[:3, 3]
+    data_per_point = {name: array_sequence(rows[:, 3 + first:3 + last], offsets, lengths)
+                      for name, first, last in data_names(header['scalar_name'], n_scalars, 'scalars')}
+    data_per_streamline = {name: properties[:, first:last]
+                           for name, first, last in data_names(header['property_name'], n_properties,
+                                                               'properties')}
+    return Tractogram(array_sequence(points.astype(np.float32), offsets, lengths), data_per_streamline,
+                      data_per_point, affine_to_rasmm=np.eye(4))
+
+
+def data_names(encoded_names, total, default):
+    """
+    :return: name, first and last column of each data field of a TRK header (the columns without a name are
+    grouped under default)
+    """
+    fields, first = [], 0
+    for encoded_name in encoded_names:
+        name, columns = decode_value_from_name(encoded_name)
+        if not columns or first + columns > total:
+            break
+        fields.append((name, first, first + columns))
+        first += columns
+    if first < total:
+        fields.append((default, first, total))
+    return fields
+
+
+def save_tck(filename, tracts, header=None):
+    """
+    :param tracts: streamlines or Tractogram, in RAS+ mm
+    :param header: unused, TCK files are always in RAS+ mm
+    """
+    with TckWriter(filename) as writer:
+        writer.write(tracts)
 
 
-def save_trk(filename, tracts, header):
-    tractogram = Tractogram(tracts, affine_to_rasmm=np.eye(4))
-    trk_obj = Trk(tractogram, header)
-    trk_obj.save(filename)
+def save_trk(filename, tracts, header=None):
+    """
+    :param tracts: streamlines or Tractogram, in RAS+ mm
+    :param header: TRK header (voxel to RAS+ mm affine, dimensions, voxel sizes), default: identity
+    """
+    with TrkWriter(filename, header) as writer:
+        writer.write(tracts)
 
 
 def read_vtk(filename):
-    if filename.endswith('xml') or filename.endswith('vtp'):
+    import vtk
+
+    if os.path.splitext(filename)[1].lower() in ('.xml', '.vtp'):
         polydata_reader = vtk.vtkXMLPolyDataReader()
     else:
         polydata_reader = vtk.vtkPolyDataReader()
@@ -147,8 +689,15 @@ def read_vtk(filename):
 
 
 def vtkPolyData_to_tracts(polydata):
-    result = {'lines': ns.vtk_to_numpy(polydata.GetLines().GetData()),
-              'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    from vtk.util import numpy_support as ns
+
+    lines = polydata.GetLines()
+    result = {'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    if hasattr(lines, 'GetOffsetsArray'):
+        result['offsets'] = ns.vtk_to_numpy(lines.GetOffsetsArray())
+        result['connectivity'] = ns.vtk_to_numpy(lines.GetConnectivityArray())
+    else:
+        result['lines'] = ns.vtk_to_numpy(lines.GetData())
 
     data = {}
     if polydata.GetPointData().GetScalars():
@@ -167,84 +716,808 @@ def vtkPolyData_to_tracts(polydata):
 
     result['pointData'] = data
 
+    #cells are numbered vertices first, then lines
+    first_line = polydata.GetNumberOfVerts()
+    cell_data = {}
+    for i in range(polydata.GetCellData().GetNumberOfArrays()):
+        array = polydata.GetCellData().GetArray(i)
+        if array is None:
+            continue
+        np_array = ns.vtk_to_numpy(array)[first_line:first_line + result['numberOfLines']]
+        cell_data[polydata.GetCellData().GetArrayName(i)] = np_array.reshape(len(np_array), -1)
+
+    result['cellData'] = cell_data
+
     tracts, data = vtkPolyData_dictionary_to_tracts_and_data(result)
     return tracts, data
 
 
 def vtkPolyData_dictionary_to_tracts_and_data(dictionary):
-    dictionary_keys = {'lines', 'points', 'numberOfLines'}
+    """
+    :param dictionary: points, numberOfLines and either the legacy cell array (lines: n0, i0, ..., n1, ...) or
+    the VTK 9 cell array (offsets, connectivity), optional pointData and cellData (one row per line)
+    :return: tracts (ArraySequence), dict of per point data (ArraySequence sharing the offsets of the tracts) and
+    per line data (array)
+    """
+    if 'offsets' in dictionary and 'connectivity' in dictionary:
+        dictionary_keys = {'offsets', 'connectivity', 'points', 'numberOfLines'}
+    else:
+        dictionary_keys = {'lines', 'points', 'numberOfLines'}
     if not dictionary_keys.issubset(dictionary.keys()):
         raise ValueError("Dictionary must have the keys lines and points" + repr(dictionary.keys()))
 
+    if 'lines' in dictionary:
+        connectivity, offsets = legacy_cells(dictionary['lines'], dictionary['numberOfLines'])
+    else:
+        connectivity = np.asarray(dictionary['connectivity'])
+        offsets = np.asarray(dictionary['offsets'], dtype=np.intp)
+    lengths = np.diff(offsets)
+    offsets = offsets[:-1]
+
+    #the points of the lines are usually stored in order, then no gather is needed
+    ordered = len(connectivity) == len(dictionary['points']) and np.array_equal(connectivity,
+                                                                                 np.arange(len(connectivity)))
+    tracts = array_sequence(gather_points(dictionary['points'], connectivity, ordered), offsets, lengths)
+
     tract_data = {}
-    tracts = []
-
-    lines = np.asarray(dictionary['lines']).squeeze()
-    points = dictionary['points']
-
-    actual_line_index = 0
-    number_of_tracts = dictionary['numberOfLines']
-    original_lines = []
-    for l in range(number_of_tracts):
-        tracts.append(points[lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1]])
-        original_lines.append(
-            np.array(lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1], copy=True))
-        actual_line_index += lines[actual_line_index] + 1
-
-    if 'pointData' in dictionary:
-        point_data_keys = [it[0] for it in dictionary['pointData'].items() if isinstance(it[1], np.ndarray)]
-
-        for k in point_data_keys:
-            array_data = dictionary['pointData'][k]
-            if k not in tract_data:
-                tract_data[k] = [array_data[f] for f in original_lines]
-            else:
-                np.vstack(tract_data[k])
-                tract_data[k].extend([array_data[f] for f in original_lines[-number_of_tracts:]])
+    for k, array_data in dictionary.get('pointData', {}).items():
+        if isinstance(array_data, np.ndarray):
+            tract_data[k] = array_sequence(gather_points(array_data, connectivity, ordered), offsets, lengths)
+    for k, array_data in dictionary.get('cellData', {}).items():
+        tract_data[k] = np.asarray(array_data)
 
     return tracts, tract_data
 
 
-def save_vtk(filename, tracts, lines_indices=None):
-    lengths = [len(p) for p in tracts]
-    line_starts = ns.numpy.r_[0, ns.numpy.cumsum(lengths)]
-    if lines_indices is None:
-        lines_indices = [ns.numpy.arange(length) + line_start for length, line_start in zip(lengths, line_starts)]
+def legacy_cells(lines, number_of_lines):
+    """
+    :param lines: legacy VTK cell array, the number of points of each cell followed by the point indices
+    :return: point indices of all the cells (connectivity), first index of each cell and end of the last one
+    """
+    lines = np.ascontiguousarray(lines).ravel()
+    headers = ordered_cell_headers(lines, number_of_lines)
+    if headers is None:
+        #only the cell sizes are read sequentially (plain integers), the indices are then gathered at once
+        sizes = memoryview(lines)
+        headers = np.empty(number_of_lines, dtype=np.intp)
+        position = 0
+        for l in range(number_of_lines):
+            if position >= len(lines):
+                raise ValueError('The cell array holds less than {} cells'.format(number_of_lines))
+            headers[l] = position
+            position += sizes[position] + 1
+    lengths = lines[headers].astype(np.intp)
+    if len(headers) and headers[-1] + lengths[-1] >= len(lines):
+        raise ValueError('The cell array holds less than {} cells'.format(number_of_lines))
+    offsets = np.r_[0, np.cumsum(lengths)]
+    starts = headers + 1
+    connectivity = lines[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])]
+    return connectivity, offsets
 
-    ids = ns.numpy.hstack([ns.numpy.r_[c[0], c[1]] for c in zip(lengths, lines_indices)])
-    vtk_ids = ns.numpy_to_vtkIdTypeArray(ids.astype('int64'), deep=True)
 
-    cell_array = vtk.vtkCellArray()
-    cell_array.SetCells(len(tracts), vtk_ids)
-    points = ns.numpy.vstack(tracts).astype(ns.get_vtk_to_numpy_typemap()[vtk.VTK_DOUBLE])
-    points_array = ns.numpy_to_vtk(points, deep=True)
+def ordered_cell_headers(lines, number_of_lines, max_repairs=64):
+    """
+    Vectorised walk of the cell sizes when the cells list the points in order (0, 1, 2, ... across the cells, the
+    layout of the VTK writers): a size is then the only value between two consecutive indices. The guess is checked
+    against the sizes, and repaired where a size happens to continue the sequence of indices.
+    :return: position of the size of each cell, None for the other layouts
+    """
+    if not number_of_lines or len(lines) < 3:
+        return None
+    headers = np.r_[0, np.flatnonzero(lines[2:] == lines[:-2] + 1) + 1]
+    for _ in range(max_repairs):
+        guess = headers[:number_of_lines]
+        following = guess + lines[guess] + 1
+        wrong = np.flatnonzero(guess[1:] != following[:-1])
+        if len(wrong):
+            cell = wrong[0]
+        elif len(guess) < number_of_lines:
+            cell = len(guess) - 1
+        else:
+            return guess
+        #the cells up to cell are right, the next one starts after it
+        if following[cell] >= len(lines):
+            return None
+        headers = np.r_[headers[:cell + 1], following[cell], headers[headers > following[cell]]]
+    return None
 
-    poly_data = vtk.vtkPolyData()
-    vtk_points = vtk.vtkPoints()
-    vtk_points.SetData(points_array)
-    poly_data.SetPoints(vtk_points)
-    poly_data.SetLines(cell_array)
 
-    poly_data.BuildCells()
+def gather_points(array, connectivity, ordered):
+    if ordered:
+        return array
+    return array[connectivity]
 
-    if filename.endswith('.xml') or filename.endswith('.vtp'):
-        writer = vtk.vtkXMLPolyDataWriter()
-        writer.SetDataModeToBinary()
-    else:
-        writer = vtk.vtkPolyDataWriter()
-        writer.SetFileTypeToBinary()
 
-    writer.SetFileName(filename)
-    if hasattr(vtk, 'VTK_MAJOR_VERSION') and vtk.VTK_MAJOR_VERSION > 5:
-        writer.SetInputData(poly_data)
+def save_vtk(filename, tracts, lines_indices=None, compress=False):
+    """
+    :param tracts: streamlines
+    :param lines_indices: point indices of each line, in the points of all the streamlines (default: in order)
+    :param compress: zlib compression (.vtp and .xml only)
+    """
+    with open_writer(filename, compress=compress) as writer:
+        writer.write(tracts)
+        if lines_indices is not None:
+            writer.connectivity = np.concatenate(lines_indices)
+
+
+def process_chunk(tractogram, options):
+    """
+    Length and ROI filtering, then resampling or linearized compression of the streamlines, with their per point
+    data
+    :param tractogram: chunk
+    :param options: dict of min_length, max_length, points, step, tolerance (mm), None when not used, and lists of
+    ROIs (load_roi) the streamlines must cross (include), must not cross (exclude), start in (start) or end in (end)
+    :return: processed chunk, number of points of the input chunk
+    """
+    n_points = tractogram.streamlines._lengths.sum()
+    points, starts, lengths = packed_streamlines(tractogram.streamlines)
+    arc, arc_lengths = arc_length(points, starts, lengths)
+
+    keep = np.ones(len(lengths), dtype=bool)
+    if options.get('min_length') is not None:
+        keep &= arc_lengths >= options['min_length']
+    if options.get('max_length') is not None:
+        keep &= arc_lengths <= options['max_length']
+    keep &= roi_selection(points, starts, lengths, options)
+    if not keep.all():
+        tractogram = tractogram[keep]
+        points, starts, lengths = packed_streamlines(tractogram.streamlines)
+        arc, arc_lengths = arc_length(points, starts, lengths)
+
+    if options.get('points') or options.get('step'):
+        if options.get('points'):
+            counts = np.full(len(lengths), options['points'], dtype=np.intp)
+        else:
+            counts = np.maximum(np.rint(arc_lengths / options['step']).astype(np.intp) + 1, 2)
+        left, right, fraction = resampling_weights(starts, lengths, arc, arc_lengths, counts)
+
+        def resample(values):
+            weights = fraction.reshape((-1,) + (1,) * (values.ndim - 1))
+            return (values[left] + weights * (values[right] - values[left])).astype(values.dtype)
+        return rebuilt_tractogram(tractogram, points, resample, counts), n_points
+    elif options.get('tolerance') is not None:
+        keep = linearize(points, starts, lengths, options['tolerance'])
+        kept = np.r_[0, np.cumsum(keep)]
+        counts = kept[starts + lengths] - kept[starts]
+        return rebuilt_tractogram(tractogram, points, lambda values: values[keep], counts), n_points
+    return tractogram, n_points
+
+
+def load_roi(filename):
+    """
+    :param filename: NIfTI mask, the non-zero voxels belong to the ROI
+    :return: mask, RAS+ mm to voxel affine, lower and upper corners of the bounding box of the ROI in RAS+ mm
+    """
+    img = nib.load(filename)
+    mask = np.asanyarray(img.dataobj) != 0
+    while mask.ndim > 3:
+        mask = mask.any(axis=-1)
+    voxels = np.argwhere(mask)
+    if not len(voxels):
+        return mask, np.linalg.inv(img.affine), np.full(3, np.inf), np.full(3, -np.inf)
+    corners = np.array(list(itertools.product(*zip(voxels.min(axis=0) - 0.5, voxels.max(axis=0) + 0.5))))
+    corners = corners.dot(img.affine[:3, :3].T) + img.affine[:3, 3]
+    return mask, np.linalg.inv(img.affine), corners.min(axis=0), corners.max(axis=0)
+
+
+def roi_hits(points, roi):
+    """
+    :return: mask of the points in the ROI (nearest voxel), only the points in its bounding box are looked up in the
+    voxel grid
+    """
+    mask, inverse, lower, upper = roi
+    candidates = np.flatnonzero(np.all((points >= lower) & (points <= upper), axis=1))
+    voxels = np.rint(points[candidates].dot(inverse[:3, :3].T) + inverse[:3, 3]).astype(np.intp)
+    inside = np.all((voxels >= 0) & (voxels < mask.shape), axis=1)
+    hits = np.zeros(len(points), dtype=bool)
+    hits[candidates[inside]] = mask[voxels[inside, 0], voxels[inside, 1], voxels[inside, 2]]
+    return hits
+
+
+def roi_selection(points, starts, lengths, options):
+    """
+    :return: mask of the streamlines crossing the include ROIs, not crossing the exclude ROIs, starting in the
+    start ROIs and ending in the end ROIs
+    """
+    keep = np.ones(len(lengths), dtype=bool)
+    non_empty = lengths > 0
+    ends = np.maximum(starts + lengths - 1, 0)
+    for key in ('include', 'exclude', 'start', 'end'):
+        for roi in options.get(key) or []:
+            hits = roi_hits(points, roi)
+            if key in ('include', 'exclude'):
+                cumulated = np.r_[0, np.cumsum(hits)]
+                crossing = cumulated[starts + lengths] > cumulated[starts]
+                keep &= crossing if key == 'include' else ~crossing
+            else:
+                endpoints = starts if key == 'start' else ends
+                keep &= non_empty & (hits[endpoints] if len(hits) else False)
+    return keep
+
+
+def packed_streamlines(streamlines):
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    return packed_data(streamlines), np.cumsum(lengths) - lengths, lengths
+
+
+def rebuilt_tractogram(tractogram, points, select, counts):
+    """
+    :param select: function mapping the packed per point values of the input to the packed values of the output
+    :param counts: number of points of each output streamline
+    """
+    starts = np.cumsum(counts) - counts
+    data_per_point = {k: array_sequence(select(packed_data(v)), starts, counts)
+                      for k, v in tractogram.data_per_point.items()}
+    return Tractogram(array_sequence(select(points), starts, counts), dict(tractogram.data_per_streamline),
+                      data_per_point, affine_to_rasmm=np.eye(4))
+
+
+def arc_length(points, starts, lengths):
+    """
+    :return: curvilinear abscissa of each point along its streamline, length of each streamline
+    """
+    segments = np.sqrt(np.sum(np.diff(points, axis=0).astype(np.float64) ** 2, axis=1))
+    #segments between two streamlines do not count
+    segments[starts[1:][starts[1:] > 0] - 1] = 0
+    cumulated = np.r_[0, np.cumsum(segments)]
+    arc = cumulated - np.repeat(cumulated[starts], lengths)
+    arc_lengths = np.where(lengths > 0, arc[np.maximum(starts + lengths - 1, 0)] if len(arc) else 0, 0)
+    return arc, arc_lengths
+
+
+def resampling_weights(starts, lengths, arc, arc_lengths, counts):
+    """
+    Points equally spaced along each streamline, by linear interpolation between two input points
+    :param counts: number of points of each resampled streamline
+    :return: index of the input points before and after each new point, interpolation weight of the point after
+    """
+    new_starts = np.cumsum(counts) - counts
+    local_index = np.arange(counts.sum()) - np.repeat(new_starts, counts)
+    target = np.repeat(arc_lengths / np.maximum(counts - 1, 1), counts) * local_index
+
+    #the streamlines are laid end to end on a single increasing abscissa, to search all the targets at once
+    shifts = np.cumsum(arc_lengths + 1) - (arc_lengths + 1)
+    abscissa = arc + np.repeat(shifts, lengths)
+    target += np.repeat(shifts, counts)
+    first = np.repeat(starts, counts)
+    last = np.repeat(starts + np.maximum(lengths, 1) - 1, counts)
+    left = np.clip(np.searchsorted(abscissa, target, side='right') - 1, first, np.maximum(last - 1, first))
+    right = np.minimum(left + 1, last)
+    span = abscissa[right] - abscissa[left]
+    fraction = np.clip(np.where(span > 0, (target - abscissa[left]) / np.where(span > 0, span, 1), 0), 0, 1)
+    return left, right, fraction
+
+
+def linearize(points, starts, lengths, tolerance):
+    """
+    Linearized compression (Douglas-Peucker), all the segments of all the streamlines refined at once: a point is
+    kept when it is the farthest from the segment between the kept points around it, farther than tolerance
+    :return: mask of the kept points
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    non_empty = lengths > 0
+    keep[starts[non_empty]] = True
+    keep[(starts + lengths - 1)[non_empty]] = True
+    #points of the segments already within tolerance, their kept points around them do not change anymore
+    settled = keep.copy()
+    points = points.astype(np.float64)
+    while True:
+        kept = np.flatnonzero(keep)
+        candidates = np.flatnonzero(~settled)
+        if not len(candidates):
+            break
+        position = np.searchsorted(kept, candidates)
+        a, b = points[kept[position - 1]], points[kept[position]]
+        distances = segment_distance(points[candidates], a, b)
+
+        #farthest candidate of each segment, the candidates of a segment are consecutive
+        segment_starts = np.flatnonzero(np.r_[True, position[1:] != position[:-1]])
+        segment = np.repeat(np.arange(len(segment_starts)), np.diff(np.r_[segment_starts, len(candidates)]))
+        max_distances = np.maximum.reduceat(distances, segment_starts)[segment]
+        farthest = np.flatnonzero((distances == max_distances) & (distances > tolerance))
+        farthest = farthest[np.diff(segment[farthest], prepend=-1) != 0]
+        keep[candidates[farthest]] = True
+        settled[candidates[farthest]] = True
+        settled[candidates[max_distances <= tolerance]] = True
+    return keep
+
+
+def segment_distance(p, a, b):
+    """
+    :return: distance of each point of p to the segment [a, b]
+    """
+    ab, ap = b - a, p - a
+    norm = np.einsum('ij,ij->i', ab, ab)
+    t = np.clip(np.einsum('ij,ij->i', ap, ab) / np.where(norm > 0, norm, 1), 0, 1)
+    ap -= t[:, None] * ab
+    return np.sqrt(np.einsum('ij,ij->i', ap, ap))
+
+
+def open_writer(filename, header=None, compress=False):
+    """
+    Streamed tractogram writer, chosen by extension
+    :param filename: .tck, .trk, .vtk, .vtp or .xml
+    :param header: TRK header of the input, if any (voxel to RAS+ mm affine, dimensions, voxel sizes)
+    :param compress: zlib compression of the VTP data arrays
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension == '.trk':
+        return TrkWriter(filename, header)
+    elif file_extension == '.tck':
+        return TckWriter(filename)
+    elif file_extension == '.vtk':
+        return VtkWriter(filename)
     else:
-        writer.SetInput(poly_data)
-    writer.Write()
+        return VtpWriter(filename, compress)
+
+
+class TckWriter:
+    """
+    Incremental MRtrix3 .tck writer (Float32LE), the streamline count is patched in the header on close. The per
+    point data goes to <name>.<key>.tsf sidecars (<name>.<key>_<component>.tsf for vectors), the per streamline data
+    to <name>.<key>.txt sidecars, the .tsf headers have the timestamp of the .tck one (MRtrix matches them).
+    """
+    header_template = 'mrtrix {}\ntimestamp: {}\ncount: {:010d}\ndatatype: Float32LE\nfile: . {:010d}\nEND\n'
+
+    def __init__(self, filename, file_type='tracks', timestamp=None):
+        self.filename = filename
+        self.file_type = file_type
+        self.timestamp = timestamp or '{:.10f}'.format(time.time())
+        self.columns = 3 if file_type == 'tracks' else 1
+        self.count = 0
+        self.scalars = None
+        self.properties = None
+        self.fileobj = open(filename, 'wb')
+        self.offset = len(self.header_template.format(file_type, self.timestamp, 0, 0))
+        self.fileobj.write(self.header_template.format(file_type, self.timestamp, 0, self.offset).encode())
+
+    def __repr__(self):
+        return 'TckWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def outputs(self):
+        """
+        :return: the .tck file and its sidecars
+        """
+        return [self.filename] + [filename for writer in (self.scalars or {}).values()
+                                  for filename in writer.outputs()] + [f.name for f in (self.properties or {}).values()]
+
+    def write(self, streamlines):
+        tractogram = as_tractogram(streamlines)
+        self.write_rows(tractogram.streamlines)
+
+        if self.scalars is None:
+            name = os.path.splitext(self.filename)[0]
+            self.scalars, self.properties = {}, {}
+            for key, values in tractogram.data_per_point.items():
+                for component in component_names(key, values._data):
+                    self.scalars[component] = TckWriter('{}.{}.tsf'.format(name, component), 'track scalars',
+                                                          self.timestamp)
+            for key in tractogram.data_per_streamline:
+                self.properties[key] = open('{}.{}.txt'.format(name, key), 'w')
+
+        for key, values in tractogram.data_per_point.items():
+            packed = as_rows(packed_data(values), values.total_nb_rows)
+            for i, component in enumerate(component_names(key, packed)):
+                starts = np.cumsum(values._lengths) - values._lengths
+                self.scalars[component].write_rows(array_sequence(packed[:, i:i + 1], starts, values._lengths))
+        for key, values in tractogram.data_per_streamline.items():
+            np.savetxt(self.properties[key], as_rows(values, len(values)), fmt='%.9g')
+
+    def write_rows(self, sequence):
+        lengths = sequence._lengths
+        packed = packed_data(sequence)
+        delimiters = np.cumsum(lengths) + np.arange(len(lengths))
+        rows = np.full((lengths.sum() + len(lengths), self.columns), np.nan, dtype='<f4')
+        is_vertex = np.ones(len(rows), dtype=bool)
+        is_vertex[delimiters] = False
+        rows[is_vertex] = packed.reshape(len(packed), self.columns)
+        rows.tofile(self.fileobj)
+        self.count += len(lengths)
+
+    def close(self):
+        np.full((1, self.columns), np.inf, dtype='<f4').tofile(self.fileobj)
+        self.fileobj.seek(0)
+        self.fileobj.write(self.header_template.format(self.file_type, self.timestamp, self.count,
+                                                       self.offset).encode())
+        self.fileobj.close()
+        for writer in (self.scalars or {}).values():
+            writer.close()
+        for f in (self.properties or {}).values():
+            f.close()
+
+
+def component_names(key, values):
+    """
+    :return: one name per column of values: key for scalars, key_<i> for vectors
+    """
+    columns = as_rows(values, len(values)).shape[1]
+    if columns == 1:
+        return [key]
+    return ['{}_{}'.format(key, i) for i in range(columns)]
+
+
+class TrkWriter:
+    """
+    Incremental TrackVis .trk writer, the streamline count is patched in the header on close. The per point data
+    is written as scalars, the per streamline data as properties.
+    """
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.header = trk_header(header)
+        self.affine = get_affine_rasmm_to_trackvis(self.header)
+        self.count = 0
+        self.kept = None
+        self.fileobj = open(filename, 'wb')
+        self.fileobj.write(self.header.tobytes())
+
+    def __repr__(self):
+        return 'TrkWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def outputs(self):
+        return [self.filename]
+
+    def write(self, streamlines):
+        tractogram = as_tractogram(streamlines)
+        streamlines = tractogram.streamlines
+        lengths = streamlines._lengths
+        n_points = lengths.sum()
+        points = packed_data(streamlines).dot(self.affine[:3, :3].T) + self.affine[:3, 3]
+        scalars = [as_rows(packed_data(values), n_points) for values in tractogram.data_per_point.values()]
+        properties = [as_rows(values, len(lengths)) for values in tractogram.data_per_streamline.values()]
+        if self.kept is None:
+            self.kept = self.set_data_names(tractogram.data_per_point.keys(), scalars,
+                                            tractogram.data_per_streamline.keys(), properties)
+        scalars, properties = scalars[:self.kept[0]], properties[:self.kept[1]]
+        rows = np.hstack([points] + scalars)
+        properties = np.hstack(properties) if properties else np.empty((len(lengths), 0))
+
+        #each record is the number of points (int32), the points with their scalars, then the properties
+        point_size, property_size = rows.shape[1], properties.shape[1]
+        record_sizes = 1 + point_size * lengths + property_size
+        record_starts = np.cumsum(record_sizes) - record_sizes
+        words = np.empty(record_sizes.sum(), dtype='<f4')
+        local_index = np.arange(n_points) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        point_starts = np.repeat(record_starts + 1, lengths) + point_size * local_index
+        words[(point_starts[:, None] + np.arange(point_size)).ravel()] = rows.ravel()
+        property_starts = record_starts + 1 + point_size * lengths
+        words[(property_starts[:, None] + np.arange(property_size)).ravel()] = properties.ravel()
+        words.view('<i4')[record_starts] = lengths
+        words.tofile(self.fileobj)
+        self.count += len(lengths)
+
+    def set_data_names(self, scalar_names, scalars, property_names, properties):
+        """
+        Name the scalars and properties in the header. The arrays beyond the limits of the format are dropped and the
+        names too long for the header are truncated, with a warning.
+        :return: number of scalar and property arrays kept
+        """
+        kept = []
+        for kind, names, arrays, limit in (('scalar', scalar_names, scalars, MAX_NB_NAMED_SCALARS_PER_POINT),
+                                           ('property', property_names, properties,
+                                            MAX_NB_NAMED_PROPERTIES_PER_STREAMLINE)):
+            names = list(names)
+            if len(names) > limit:
+                print('{}: TRK files store at most {} named {} arrays, dropping {}'.format(
+                    self.filename, limit, kind, ', '.join(names[limit:])))
+            for i, (name, values) in enumerate(zip(names[:limit], arrays)):
+                #the name shares the field with the number of columns (after a NUL) when there are several
+                width = TRK_NAME_LENGTH - (len(str(values.shape[1])) + 1 if values.shape[1] > 1 else 0)
+                if len(name) > width:
+                    print('{}: {} name {} truncated to {}'.format(self.filename, kind, name, name[:width]))
+                self.header[kind + '_name'][i] = encode_value_in_name(values.shape[1], name[:width], TRK_NAME_LENGTH)
+            kept.append(min(len(names), limit))
+        self.header['nb_scalars_per_point'] = sum(values.shape[1] for values in scalars[:kept[0]])
+        self.header['nb_properties_per_streamline'] = sum(values.shape[1] for values in properties[:kept[1]])
+        return kept
+
+    def close(self):
+        self.header['nb_streamlines'] = self.count
+        self.fileobj.seek(0)
+        self.fileobj.write(self.header.tobytes())
+        self.fileobj.close()
+
+
+def trk_header(header=None):
+    """
+    :param header: dict of TRK header fields (nibabel), missing fields take the default values
+    :return: little endian TRK header structure
+    """
+    structure = np.zeros((), dtype=header_2_dtype.newbyteorder('<'))
+    for fields in (Trk.create_empty_header(), header or {}):
+        for key, value in fields.items():
+            if key in header_2_dtype.fields:
+                structure[key] = value
+    structure['nb_streamlines'] = 0
+    structure['nb_scalars_per_point'] = 0
+    structure['nb_properties_per_streamline'] = 0
+    structure['scalar_name'] = b''
+    structure['property_name'] = b''
+    structure['hdr_size'] = header_2_dtype.itemsize
+    return structure
+
+
+class VtkWriter:
+    """
+    Incremental legacy binary .vtk writer: the points are written as they come (float32 inputs stay float32), the
+    lines only depend on the streamline lengths and are written on close, then the point count is patched. The per
+    point and per streamline data are spilled to temporary files and written as POINT_DATA and CELL_DATA fields.
+    Set connectivity before closing to write other point indices than the points in order.
+    """
+    points_line = 'POINTS {:<20d} {:6s}\n'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connectivity = None
+        self.lengths = []
+        self.count = 0
+        self.dtype = None
+        self.point_data = {}
+        self.cell_data = {}
+        self.fileobj = open(filename, 'wb')
+        self.fileobj.write(b'# vtk DataFile Version 3.0\nvtk output\nBINARY\nDATASET POLYDATA\n')
+        self.points_offset = self.fileobj.tell()
+        self.fileobj.write(self.points_line.format(0, 'float').encode())
+
+    def __repr__(self):
+        return 'VtkWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def outputs(self):
+        return [self.filename]
+
+    def write(self, streamlines):
+        tractogram = as_tractogram(streamlines)
+        points = packed_data(tractogram.streamlines)
+        if self.dtype is None:
+            self.dtype = '>f4' if points.dtype == np.float32 else '>f8'
+        np.asarray(points, dtype=self.dtype).tofile(self.fileobj)
+        self.lengths.append(np.asarray(tractogram.streamlines._lengths, dtype=np.int64))
+        self.count += len(points)
+        spill_data(self.point_data, {k: packed_data(v) for k, v in tractogram.data_per_point.items()},
+                   self.filename, '>')
+        spill_data(self.cell_data, tractogram.data_per_streamline, self.filename, '>')
+
+    def close(self):
+        lengths = np.concatenate(self.lengths) if self.lengths else np.empty(0, dtype=np.int64)
+        #the points in order: the indices are generated by chunks, never all at once
+        n_indices = self.count if self.connectivity is None else len(self.connectivity)
+        if not len(lengths):
+            version = b'3.0'
+        elif n_indices + len(lengths) >= 2 ** 31:
+            #VTK 9 layout, 64 bit offsets and connectivity
+            self.fileobj.write('\nLINES {} {}\nOFFSETS vtktypeint64\n'.format(len(lengths) + 1, n_indices).encode())
+            np.r_[0, np.cumsum(lengths)].astype('>i8').tofile(self.fileobj)
+            self.fileobj.write(b'\nCONNECTIVITY vtktypeint64\n')
+            for start in range(0, n_indices, CELL_CHUNK):
+                np.asarray(connectivity_slice(self.connectivity, start, min(start + CELL_CHUNK, n_indices)),
+                           dtype='>i8').tofile(self.fileobj)
+            version = b'5.1'
+        else:
+            self.fileobj.write('\nLINES {} {}\n'.format(len(lengths), n_indices + len(lengths)).encode())
+            first = 0
+            for start in range(0, len(lengths), CELL_CHUNK):
+                cells, first = legacy_cell_chunk(self.connectivity, lengths[start:start + CELL_CHUNK], first)
+                cells.astype('>i4').tofile(self.fileobj)
+            version = b'3.0'
+        self.fileobj.write(b'\n')
+
+        for section, count, arrays in (('POINT_DATA', self.count, self.point_data),
+                                       ('CELL_DATA', len(lengths), self.cell_data)):
+            if arrays and count:
+                self.fileobj.write('{} {}\nFIELD FieldData {}\n'.format(section, count, len(arrays)).encode())
+                for name, array in arrays.items():
+                    self.fileobj.write('{} {} {} {}\n'.format(name.replace(' ', '_'), array.components, count,
+                                                              'double' if array.dtype == '>f8' else 'float').encode())
+                    array.copy_to(self.fileobj, header=False)
+                    self.fileobj.write(b'\n')
+
+        self.fileobj.seek(len(b'# vtk DataFile Version '))
+        self.fileobj.write(version)
+        self.fileobj.seek(self.points_offset)
+        self.fileobj.write(self.points_line.format(self.count, 'double' if self.dtype == '>f8' else 'float').encode())
+        self.fileobj.close()
+
+
+def legacy_cell_chunk(connectivity, lengths, first):
+    """
+    :param connectivity: point indices of the cells, None for the points in order
+    :return: legacy cell array (n0, i0, ..., n1, ...) of consecutive cells whose indices start at
+    connectivity[first], position of the indices of the next cell in connectivity
+    """
+    last = first + lengths.sum()
+    cell_starts = np.cumsum(lengths) - lengths + np.arange(len(lengths))
+    cells = np.empty(last - first + len(lengths), dtype=np.int64)
+    cells[cell_starts] = lengths
+    is_index = np.ones(len(cells), dtype=bool)
+    is_index[cell_starts] = False
+    cells[is_index] = connectivity_slice(connectivity, first, last)
+    return cells, last
+
+
+def connectivity_slice(connectivity, start, stop):
+    """
+    :param connectivity: point indices of the cells, None for the points in order
+    """
+    return np.arange(start, stop) if connectivity is None else connectivity[start:stop]
+
+
+def spill_data(arrays, data, filename, byte_order, compress=False):
+    """
+    Append each data array to its AppendedArray, created on first use (float64 stays float64, other types are
+    written as float32)
+    :param arrays: dict of AppendedArray, by name
+    :param data: dict of arrays (one row per point or per streamline), by name
+    """
+    for key, values in data.items():
+        values = as_rows(values, len(values))
+        if key not in arrays:
+            dtype = byte_order + ('f8' if values.dtype == np.float64 else 'f4')
+            arrays[key] = AppendedArray(filename, dtype, compress, values.shape[1])
+        arrays[key].write(values)
+
+
+class VtpWriter:
+    """
+    Incremental VTK XML PolyData writer (appended raw data, optionally zlib compressed): the data arrays, including
+    the per point and per streamline data, are spilled to temporary files next to the output and written on close,
+    after the XML header whose offsets depend on their sizes. Set connectivity before closing to write other point
+    indices than the points in order.
+    """
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.compress = compress
+        self.connectivity = None
+        self.lengths = []
+        self.count = 0
+        self.points = None
+        self.point_data = {}
+        self.cell_data = {}
+
+    def __repr__(self):
+        return 'VtpWriter(filename={})'.format(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def outputs(self):
+        return [self.filename]
+
+    def write(self, streamlines):
+        tractogram = as_tractogram(streamlines)
+        points = packed_data(tractogram.streamlines)
+        if self.points is None:
+            dtype = '<f4' if points.dtype == np.float32 else '<f8'
+            self.points = AppendedArray(self.filename, dtype, self.compress, 3)
+        self.points.write(points)
+        self.lengths.append(np.asarray(tractogram.streamlines._lengths, dtype=np.int64))
+        self.count += len(points)
+        spill_data(self.point_data, {k: packed_data(v) for k, v in tractogram.data_per_point.items()},
+                   self.filename, '<', self.compress)
+        spill_data(self.cell_data, tractogram.data_per_streamline, self.filename, '<', self.compress)
+
+    def close(self):
+        lengths = np.concatenate(self.lengths) if self.lengths else np.empty(0, dtype=np.int64)
+        if self.points is None:
+            self.points = AppendedArray(self.filename, '<f4', self.compress, 3)
+        connectivity = AppendedArray(self.filename, '<i8', self.compress)
+        if self.connectivity is None:
+            for start in range(0, self.count, CELL_CHUNK):
+                connectivity.write(np.arange(start, min(start + CELL_CHUNK, self.count)))
+        else:
+            connectivity.write(self.connectivity)
+        offsets = AppendedArray(self.filename, '<i8', self.compress)
+        offsets.write(np.cumsum(lengths))
+
+        arrays = [self.points, connectivity, offsets] + list(self.point_data.values()) + list(self.cell_data.values())
+        positions = iter(np.cumsum([0] + [array.size() for array in arrays]))
+        compressor = ' compressor="vtkZLibDataCompressor"' if self.compress else ''
+        xml = ['<?xml version="1.0"?>',
+               '<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian" header_type="UInt64"{}>'.format(
+                   compressor),
+               '  <PolyData>',
+               '    <Piece NumberOfPoints="{}" NumberOfVerts="0" NumberOfLines="{}" NumberOfStrips="0" '
+               'NumberOfPolys="0">'.format(self.count, len(lengths)),
+               '      <Points>',
+               self.points.xml_element('Points', next(positions)),
+               '      </Points>',
+               '      <Lines>',
+               connectivity.xml_element('connectivity', next(positions)),
+               offsets.xml_element('offsets', next(positions)),
+               '      </Lines>']
+        for section, data in (('PointData', self.point_data), ('CellData', self.cell_data)):
+            xml.append('      <{}>'.format(section))
+            xml.extend(array.xml_element(name, next(positions)) for name, array in data.items())
+            xml.append('      </{}>'.format(section))
+        xml += ['    </Piece>', '  </PolyData>', '  <AppendedData encoding="raw">', '   _']
+
+        with open(self.filename, 'wb') as fileobj:
+            fileobj.write('\n'.join(xml).encode())
+            for array in arrays:
+                array.copy_to(fileobj)
+            fileobj.write(b'\n  </AppendedData>\n</VTKFile>\n')
+
+
+class AppendedArray:
+    """
+    Data array of the appended section of a VTK XML file, spilled to a temporary file. Raw: UInt64 byte count
+    followed by the data. Compressed: UInt64 header (number of blocks, block size, size of the last partial block,
+    compressed size of each block) followed by the zlib blocks.
+    """
+    vtk_types = {'f4': 'Float32', 'f8': 'Float64', 'i4': 'Int32', 'i8': 'Int64'}
+
+    def __init__(self, filename, dtype, compress=False, components=1):
+        self.dtype = dtype
+        self.compress = compress
+        self.components = components
+        self.nbytes = 0
+        self.pending = b''
+        self.block_sizes = []
+        self.spill = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+
+    def xml_element(self, name, offset):
+        return '        <DataArray type="{}" Name={} NumberOfComponents="{}" format="appended" offset="{}"/>'.format(
+            self.vtk_types[self.dtype[1:]], quoteattr(name), self.components, offset)
+
+    def write(self, array):
+        data = np.ascontiguousarray(array, dtype=self.dtype)
+        self.nbytes += data.nbytes
+        if not self.compress:
+            data.tofile(self.spill)
+            return
+        data = self.pending + data.tobytes()
+        full = len(data) - len(data) % VTP_BLOCK
+        for start in range(0, full, VTP_BLOCK):
+            self.add_block(data[start:start + VTP_BLOCK])
+        self.pending = data[full:]
+
+    def add_block(self, block):
+        block = zlib.compress(block)
+        self.block_sizes.append(len(block))
+        self.spill.write(block)
+
+    def header(self):
+        if not self.compress:
+            return np.array([self.nbytes], dtype='<u8').tobytes()
+        if self.pending:
+            self.add_block(self.pending)
+            self.pending = b''
+        return np.array([len(self.block_sizes), VTP_BLOCK, self.nbytes % VTP_BLOCK] + self.block_sizes,
+                        dtype='<u8').tobytes()
+
+    def size(self):
+        return len(self.header()) + self.spill.seek(0, os.SEEK_END)
+
+    def copy_to(self, fileobj, header=True):
+        if header:
+            fileobj.write(self.header())
+        self.spill.seek(0)
+        shutil.copyfileobj(self.spill, fileobj)
+        self.spill.close()
 
 
 def check_ext(value):
     filename, file_extension = os.path.splitext(value)
-    if file_extension in ('.tck', '.trk', '.vtk', '.xml', '.vtp'):
+    if file_extension.lower() in EXTENSIONS:
         return value
     else:
         raise argparse.ArgumentTypeError(
@@ -259,13 +1532,79 @@ def check_format(value):
             "Invalid file extension (file format supported: tck,trk,vtk,xml,vtp): %r" % value)
 
 
+def check_nii(value):
+    if not os.path.isfile(value):
+        raise argparse.ArgumentTypeError('File not found: %s' % value)
+    if value.endswith('.nii') or value.endswith('.nii.gz'):
+        return value
+    raise argparse.ArgumentTypeError('Invalid file extension (file format supported: nii, nii.gz): %r' % value)
+
+
+def check_positive(value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not an integer: %s' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('Must be a positive integer: %s' % value)
+    return value
+
+
+def check_positive_float(value):
+    try:
+        value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not a number: %s' % value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('Must be positive: %s' % value)
+    return value
+
+
 def setup():
     parser = argparse.ArgumentParser()
-    parser.add_argument('Input_Tractogram', help='Name of the input file', type=check_ext)
+    parser.add_argument('Input_Tractogram', help='Input files, glob patterns or folders', nargs='*')
     parser.add_argument('Output_Format', help='File format of the output file', type=check_format)
-    args = parser.parse_args()
+    parser.add_argument('-m', '--manifest', help='Text file listing the input files, one per line')
+    parser.add_argument('-j', '--jobs', help='Number of parallel conversions (default: 1)', type=check_positive,
+                        default=1)
+    parser.add_argument('-u', '--update', help='Skip the outputs newer than their input (mtime, default, not with '
+                        'processing options), whose input and processing options are unchanged since the last '
+                        'conversion (hash) or convert all (all)',
+                        choices=['mtime', 'hash', 'all'], default='mtime')
+    parser.add_argument('--hash-file', help='Input hashes of the converted files, for --update hash (default: '
+                        'tracto_hashes.json)', default='tracto_hashes.json')
+    parser.add_argument('-z', '--compress', help='zlib compression of the .vtp and .xml outputs', action='store_true')
+    parser.add_argument('--min-length', help='Remove the streamlines shorter than this length (mm)',
+                        type=check_positive_float)
+    parser.add_argument('--max-length', help='Remove the streamlines longer than this length (mm)',
+                        type=check_positive_float)
+    vertices = parser.add_mutually_exclusive_group()
+    vertices.add_argument('--points', help='Resample the streamlines to this number of points', type=check_positive)
+    vertices.add_argument('--step', help='Resample the streamlines to this step length (mm)', type=check_positive_float)
+    vertices.add_argument('--tolerance', help='Linearized compression: remove the points closer than this distance '
+                          '(mm) to the compressed streamline', type=check_positive_float)
+    parser.add_argument('--include', help='Keep the streamlines crossing this NIfTI mask (repeatable)',
+                        action='append', type=check_nii)
+    parser.add_argument('--exclude', help='Remove the streamlines crossing this NIfTI mask (repeatable)',
+                        action='append', type=check_nii)
+    parser.add_argument('--start', help='Keep the streamlines starting in this NIfTI mask (repeatable)',
+                        action='append', type=check_nii)
+    parser.add_argument('--end', help='Keep the streamlines ending in this NIfTI mask (repeatable)',
+                        action='append', type=check_nii)
+    parser.add_argument('-t', '--threads', help='Threads processing the chunks of a file (default: 1)',
+                        type=check_positive, default=1)
+    parser.add_argument('-c', '--chunk-size', help='Streamlines read and written at once (default: {})'.format(
+        CHUNK_SIZE), type=check_positive, default=CHUNK_SIZE)
+    args = parser.parse_intermixed_args()
+    if not args.Input_Tractogram and not args.manifest:
+        parser.error('No input tractogram')
+    #the inputs listed in the manifest are checked as the command line ones
+    try:
+        args.in_files = collect_inputs(args.Input_Tractogram, args.manifest, args.Output_Format.lower())
+    except (argparse.ArgumentTypeError, OSError) as e:
+        parser.error(str(e))
 
-    return args.Input_Tractogram, args.Output_Format
+    return args
 
 
 if __name__ == "__main__":